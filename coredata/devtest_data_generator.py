@@ -8,7 +8,7 @@ from coredata.models import Person, Unit, Role, Semester, CourseOffering, Course
     CAMPUS_CHOICES, SemesterWeek
 from courselib.testing import TEST_COURSE_SLUG
 import itertools, random, string
-import datetime
+import datetime, decimal
 
 from dashboard.models import UserConfig
 from grades.models import NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity, Activity
@@ -708,6 +708,71 @@ def create_reminders():
     return Reminder.all_objects.all()
 
 
+def create_benchmark_offering(students=2000, numeric_activities=20, calculated_activities=3, seed=0,
+                              subject='BENC', number='999'):
+    """
+    Create a large offering full of grades, for benchmarking the grades code: the students, numeric activities
+    (with a grade for almost every student), a chain of calculated numeric activities (each the total of the
+    activities before it), and a calculated letter grade on the last of those.
+
+    Not used for the fixtures: run inside a transaction that's rolled back.
+    """
+    from grades.models import NumericGrade
+    rand = random.Random(seed)
+    semester = Semester.objects.order_by('-name').first()
+    course = Course(subject=subject, number=number, title='Benchmark Course')
+    course.save()
+    offering = CourseOffering(
+        semester=semester, subject=subject, number=number, section='D100', title='Benchmark Course',
+        owner=Unit.objects.order_by('id').first(), component='LEC', instr_mode='P', crse_id=99999, class_nbr=99999,
+        campus='BRNBY', enrl_cap=students, enrl_tot=students, wait_tot=0, units=3, course=course)
+    offering.save()
+
+    # people and members in bulk: per-object saves would take longer than anything being benchmarked
+    base_emplid = 900000000 + Person.objects.filter(emplid__gte=900000000).count()
+    Person.objects.bulk_create([
+        Person(emplid=base_emplid + i, userid='b%i' % (base_emplid + i,), last_name='Benchmark',
+               first_name='Student%i' % (i,))
+        for i in range(students + 1)], batch_size=500)
+    people = list(Person.objects.filter(emplid__gte=base_emplid, emplid__lte=base_emplid + students))
+    instructor = people.pop()
+    Member(person=instructor, offering=offering, role='INST', added_reason='UNK').save()
+    Member.objects.bulk_create([
+        Member(person=p, offering=offering, role='STUD', added_reason='AUTO', career='UGRD',
+               labtut_section='D1%02i' % (rand.randint(1, 12),))
+        for p in people], batch_size=500)
+    members = list(Member.objects.filter(offering=offering, role='STUD'))
+
+    position = 1
+    for i in range(numeric_activities):
+        a = NumericActivity(offering=offering, name='Assignment %i' % (i+1,), short_name='A%i' % (i+1,),
+                            status='RLS', position=position, percent=decimal.Decimal(100)/numeric_activities,
+                            max_grade=rand.choice([10, 20, 50, 100]))
+        a.save()
+        position += 1
+        grades = [NumericGrade(activity=a, member=m, flag='GRAD',
+                               value=decimal.Decimal(rand.randint(0, int(a.max_grade)*100)) / 100)
+                  for m in members if rand.random() < 0.97]
+        NumericGrade.objects.bulk_create(grades, batch_size=500)
+
+    total = None
+    for i in range(calculated_activities):
+        if i == 0:
+            formula = '[[activitytotal]]'
+        else:
+            formula = '[%s] * 0.9 + 10' % (total.short_name,)
+        total = CalNumericActivity(offering=offering, name='Calculated %i' % (i+1,), short_name='C%i' % (i+1,),
+                                   status='URLS', position=position, max_grade=100, formula=formula)
+        total.save()
+        position += 1
+
+    if total:
+        CalLetterActivity(offering=offering, name='Letter Grade', short_name='Letter', status='URLS',
+                          position=position, numeric_activity=total).save()
+
+    return offering
+
+
 def serialize_result(data_func, filename):
     print("creating %s.json" % (filename,))
     objs = data_func()
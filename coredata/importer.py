@@ -4,6 +4,8 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'courses.settings'
 
 from coredata.queries import SIMSConn, get_reqmnt_designtn, import_person,\
     userid_to_emplid, cache_by_args, REQMNT_DESIGNTN_FLAGS
+from coredata.queries import get_names_batch, grad_student_info_batch, emplid_to_userid, set_person_data, \
+    SIMS_IN_CHUNK, NAMES_QUERIES, GRAD_INFO_QUERIES
 from coredata.models import Person, Semester, SemesterWeek, Unit,CourseOffering, Member, MeetingTime, Role, Holiday
 from coredata.models import CombinedOffering, EnrolmentHistory, CAMPUSES, COMPONENTS, INSTR_MODE
 from django.db import transaction
@@ -12,10 +14,10 @@ from django.core.cache import cache
 from django.urls import reverse
 from django.core.mail import mail_admins
 from courselib.svn import update_offering_repositories
-from grades.models import LetterActivity
+from grades.models import LetterActivity, ActivityStats, bump_grade_version
 from grad.models import GradStudent, STATUS_ACTIVE, STATUS_APPLICANT, STATUS_GPA
 from ra.models import RAAppointment
-import itertools, random
+import itertools, random, collections, heapq
 
 today = datetime.date.today()
 past_cutoff = today - datetime.timedelta(days=30)
@@ -33,14 +35,24 @@ def fix_emplid():
     """
     Any manually-entered people will have emplid 0000?????.  Update them with the real emplid from the database.
     """
-    people = Person.objects.filter(emplid__lt=100000)
+    people = Person.objects.filter(emplid__lt=100000).exclude(userid__isnull=True)
+    found = {}
     for p in people:
-        if not p.userid:
-            continue
         emplid = userid_to_emplid(p.userid)
         if emplid:
+            found[p] = int(emplid)
+
+    # if the real emplid is already taken, leave it for a human to sort out
+    taken = set(Person.objects.filter(emplid__in=found.values()).values_list('emplid', flat=True))
+    fixed = []
+    for p, emplid in found.items():
+        if emplid not in taken:
             p.emplid = emplid
-            p.save_if_dirty()
+            fixed.append(p)
+    Person.objects.bulk_update(fixed, ['emplid'])
+
+    # ... and fill in their SIMS data
+    get_people([p.emplid for p in fixed], force=True)
 
 
 def import_semester(sems):
@@ -244,6 +256,58 @@ def import_offerings(extra_where='1=1', import_semesters=import_semesters, cance
     return imported_offerings
 
 
+OFFERING_BASE_WEIGHT = 20 # work importing an offering, beyond its students
+
+
+def offering_weight(offering):
+    """
+    Rough estimate of the work of importing this offering: mostly proportional to its enrolment.
+    """
+    return OFFERING_BASE_WEIGHT + (offering.enrl_tot or 0)
+
+
+def partition_offerings(offerings, max_size=None, max_weight=None):
+    """
+    Split the offerings into groups for import tasks: each group is offerings from one unit, with at most max_size
+    offerings and (unless a single offering is bigger) max_weight total offering_weight.
+
+    Returns a list of (unit, [offerings]).
+    """
+    max_size = max_size or settings.OFFERING_IMPORT_GROUP_SIZE
+    max_weight = max_weight or settings.OFFERING_IMPORT_GROUP_WEIGHT
+    offerings = sorted(offerings, key=lambda o: (o.owner_id or 0, o.slug))
+    groups = []
+    for _, unit_offerings in itertools.groupby(offerings, key=lambda o: o.owner_id):
+        group = []
+        weight = 0
+        for o in unit_offerings:
+            w = offering_weight(o)
+            if group and (len(group) >= max_size or weight + w > max_weight):
+                groups.append((group[0].owner, group))
+                group = []
+                weight = 0
+            group.append(o)
+            weight += w
+        if group:
+            groups.append((group[0].owner, group))
+    return groups
+
+
+def schedule_lanes(groups, lanes):
+    """
+    Assign the OfferingImportGroups to this many lanes (chains of tasks that run in parallel), balancing their total
+    weight: biggest groups first, each into the lane with the least work so far.
+    """
+    lane_work = [(0, i) for i in range(lanes)]
+    heapq.heapify(lane_work)
+    assigned = [[] for _ in range(lanes)]
+    for g in sorted(groups, key=lambda g: -g.weight):
+        work, i = heapq.heappop(lane_work)
+        assigned[i].append(g)
+        heapq.heappush(lane_work, (work + g.weight, i))
+    return [lane for lane in assigned if lane]
+
+
 def _person_save(p):
     """
     Save this person object, dealing with duplicate userid as appropriate
@@ -261,28 +325,23 @@ def _person_save(p):
         #p.save()
 
 imported_people = {}
+person_import_stats = collections.Counter() # running totals from get_people, for the import logs
 IMPORT_THRESHOLD = 3600*24*7 # import personal info infrequently
 NO_USERID_IMPORT_THRESHOLD = 3600*24*2 # import if we don't know their userid yet
+PERSON_UPDATE_FIELDS = ['last_name', 'first_name', 'middle_name', 'pref_first_name', 'title', 'userid', 'config']
+
+
 def get_person(emplid, commit=True, force=False, grad_data=False):
     """
     Get/update personal info for this emplid and return (updated & saved) Person object.
     """
-    global imported_people
-    # use imported_people as a cache
-    if emplid in imported_people:
-        return imported_people[emplid]
-
-    # either get old or create new Person object
-    p_old = Person.objects.filter(emplid=emplid)
-    if len(p_old)>1:
-        # should be dead code, since emplid is a unique key in the DB
-        raise KeyError("Already duplicate people: %r" % (p_old))
-    elif len(p_old)==1:
-        p = p_old[0]
-    else:
-        p = Person(emplid=emplid)
-    imported_people[emplid] = p
+    return get_people([emplid], commit=commit, force=force, grad_data=grad_data).get(int(emplid))
 
+
+def _needs_import(p, force):
+    """
+    Is it time to (re-)import this Person's SIMS data?
+    """
     if 'lastimport' in p.config:
         import_age = time.time() - p.config['lastimport']
     else:
@@ -290,24 +349,89 @@ def get_person(emplid, commit=True, force=False, grad_data=False):
 
     # active students with no userid: pay more attention to try to get their userid for login/email.
     if p.userid is None and import_age > NO_USERID_IMPORT_THRESHOLD:
-        new_p = import_person(p, commit=commit, grad_data=grad_data)
-        if new_p:
-            return new_p
-        elif p_old:
-            return p
+        return True
 
     # only import if data is older than IMPORT_THRESHOLD (unless forced)
     # Randomly occasionally import anyway, so new students don't stay bunched-up.
-    elif not force and import_age < IMPORT_THRESHOLD and random.random() < 0.99:
-        return p
+    return force or import_age >= IMPORT_THRESHOLD or random.random() >= 0.99
 
-    # actually import their data
-    else:
-        new_p = import_person(p, commit=commit, grad_data=grad_data)
-        if new_p:
-            return new_p
-        elif p_old:
-            return p
+
+def _chunks(n):
+    return (n + SIMS_IN_CHUNK - 1) // SIMS_IN_CHUNK
+
+
+def get_people(emplids, commit=True, force=False, grad_data=False):
+    """
+    Batched get_person: get/update personal info for these emplids, and return a dict of emplid -> Person for the
+    ones we have or SIMS knows about.
+
+    The Person objects we have are fetched in one query. The ones that need importing get their SIMS data with a
+    few queries for each SIMS_IN_CHUNK people (instead of a few for each person) and are saved in bulk (if commit).
+    The SIMS round-trips that saved are counted in person_import_stats.
+    """
+    global imported_people
+    emplids = set(int(e) for e in emplids)
+    # use imported_people as a cache
+    people = dict((e, imported_people[e]) for e in emplids if e in imported_people)
+    wanted = emplids - set(people)
+    person_import_stats['people'] += len(emplids)
+    if not wanted:
+        return people
+
+    existing = dict((p.emplid, p) for p in Person.objects.filter(emplid__in=wanted))
+    to_import = []
+    for emplid in wanted:
+        p = existing.get(emplid) or Person(emplid=emplid)
+        if _needs_import(p, force):
+            to_import.append(p)
+        else:
+            people[emplid] = p
+    if not to_import:
+        imported_people.update(people)
+        return people
+
+    names = get_names_batch([p.emplid for p in to_import])
+    found = [p for p in to_import if names.get(p.emplid, (None,))[0] is not None]
+    found_emplids = set(p.emplid for p in found)
+    grad_info = grad_student_info_batch(found_emplids) if grad_data else {}
+    new_people = []
+    changed_people = []
+    for p in to_import:
+        if p.emplid not in found_emplids:
+            # no name = no such person: keep what we have (if anything)
+            if p.id:
+                people[p.emplid] = p
+            continue
+        set_person_data(p, names[p.emplid], emplid_to_userid(p.emplid), grad_info.get(p.emplid))
+        people[p.emplid] = p
+        if p.id:
+            changed_people.append(p)
+        else:
+            new_people.append(p)
+
+    if commit:
+        Person.objects.bulk_update(changed_people, PERSON_UPDATE_FIELDS, batch_size=1000)
+        if new_people:
+            Person.objects.bulk_create(new_people, batch_size=1000)
+            # bulk_create doesn't fill in the ids on all backends
+            people.update((p.emplid, p) for p in Person.objects.filter(emplid__in=[p.emplid for p in new_people]))
+
+    queries = NAMES_QUERIES * _chunks(len(to_import))
+    unbatched = NAMES_QUERIES * len(to_import)
+    if grad_data:
+        queries += GRAD_INFO_QUERIES * _chunks(len(found))
+        unbatched += GRAD_INFO_QUERIES * len(found)
+    person_import_stats['imported'] += len(found)
+    person_import_stats['sims_queries'] += queries
+    person_import_stats['sims_queries_saved'] += unbatched - queries
+
+    imported_people.update(people)
+    return people
+
+
+def person_import_summary():
+    return 'resolved %(people)i people, imported %(imported)i from SIMS in %(sims_queries)i queries ' \
+           '(%(sims_queries_saved)i SIMS round-trips saved by batching)' % person_import_stats
 
 
 def get_person_grad(emplid, commit=True, force=False):
@@ -329,8 +453,7 @@ def get_role_people():
     ras = RAAppointment.objects.filter(start_date__lte=cutoff).select_related('person')
     people |= set([ra.person for ra in ras])
 
-    for p in people:
-        get_person(p.emplid, grad_data=True)
+    get_people([p.emplid for p in people], grad_data=True)
 
 
 def fix_mtg_info(section, stnd_mtg_pat):
@@ -414,12 +537,27 @@ def has_letter_activities(offering):
         cache.set(key, res, 12*60*60)
 
 
+# these are: ["Faculty", "Tba", "Sessional"]. Ignore them: they're ugly.
+IGNORE_EMPLIDS = [200133427, 200133425, 200133426]
+
+
+def _members_changed(changes):
+    """
+    Do what the Member signals would have for memberships changed by QuerySet.update or the bulk operations: changes
+    is an iterable of (offering_id, userid) for the changed Members.
+    """
+    changes = list(changes)
+    for offering_id in set(offering_id for offering_id, _ in changes):
+        ActivityStats.invalidate(offering_id=offering_id)
+        bump_grade_version(offering_id)
+    Member.clear_menu_cache(userid for _, userid in changes)
+
+
 def ensure_member(person, offering, role, cred, added_reason, career, labtut_section=None, grade=None, sched_print_instr=None):
     """
     Make sure this member exists with the right properties.
     """
-    if person.emplid in [200133427, 200133425, 200133426]:
-        # these are: ["Faculty", "Tba", "Sessional"]. Ignore them: they're ugly.
+    if person.emplid in IGNORE_EMPLIDS:
         return
     
     m_old = Member.objects.filter(person=person, offering=offering)
@@ -434,6 +572,7 @@ def ensure_member(person, offering, role, cred, added_reason, career, labtut_sec
         
     if len(m_old)>=1:
         m = m_old[0]
+        m.person = person
     else:
         m = Member(person=person, offering=offering)
 
@@ -465,21 +604,27 @@ def ensure_member(person, offering, role, cred, added_reason, career, labtut_sec
 @transaction.atomic
 def import_instructors(offering):
     "Import instructors for this offering"
-    Member.objects.filter(added_reason="AUTO", offering=offering, role="INST").update(role='DROP')
+    dropped = Member.objects.filter(added_reason="AUTO", offering=offering, role="INST")
+    changes = list(dropped.values_list('offering_id', 'person__userid'))
+    dropped.update(role='DROP')
+    _members_changed(changes)
     db = SIMSConn()
     db.execute("SELECT EMPLID, INSTR_ROLE, SCHED_PRINT_INSTR FROM PS_CLASS_INSTR WHERE " \
                "CRSE_ID=%s AND CLASS_SECTION=%s AND STRM=%s AND INSTR_ROLE IN ('PI', 'SI')",
                ("%06i" % (int(offering.crse_id)), offering.section, offering.semester.name))
-    for emplid, _, sched_print_instr in db.rows():
-        if not emplid:
-            continue
-        p = get_person(emplid)
+    rows = [r for r in db.rows() if r[0]]
+    people = get_people(emplid for emplid, _, _ in rows)
+    for emplid, _, sched_print_instr in rows:
+        p = people.get(int(emplid))
         ensure_member(p, offering, "INST", 0, "AUTO", "NONS", sched_print_instr=sched_print_instr)
 
 
 @transaction.atomic
 def import_students(offering):
-    Member.objects.filter(added_reason="AUTO", offering=offering, role="STUD").update(role='DROP')
+    dropped = Member.objects.filter(added_reason="AUTO", offering=offering, role="STUD")
+    changes = list(dropped.values_list('offering_id', 'person__userid'))
+    dropped.update(role='DROP')
+    _members_changed(changes)
     db = SIMSConn()
     # find any lab/tutorial sections
     
@@ -507,8 +652,10 @@ def import_students(offering):
                "ON E.STRM=R.STRM AND E.ACAD_CAREER=R.ACAD_CAREER AND E.EMPLID=R.EMPLID AND E.CLASS_NBR=R.CLASS_NBR "
                "WHERE E.CLASS_NBR=%s AND E.STRM=%s AND E.STDNT_ENRL_STATUS='E' and "
                "E.ENRL_STATUS_REASON IN ('ENRL','EWAT')", (offering.class_nbr, offering.semester.name))
-    for emplid, acad_career, unt_taken, grade_official, grade_roster in db.rows():
-        p = get_person(emplid)
+    rows = db.rows()
+    people = get_people(r[0] for r in rows)
+    for emplid, acad_career, unt_taken, grade_official, grade_roster in rows:
+        p = people.get(int(emplid))
         sec = labtut.get(emplid, None)
         grade = grade_official or grade_roster
         ensure_member(p, offering, "STUD", unt_taken, "AUTO", acad_career, labtut_section=sec, grade=grade)
@@ -573,30 +720,211 @@ def import_all_instructors(strm, extra_where='1=1', offering_map=None):
     if not offering_map:
         offering_map = crseid_offering_map(strm)
 
-    Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="INST").update(role='DROP')
+    dropped = Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="INST")
+    changes = list(dropped.values_list('offering_id', 'person__userid'))
+    dropped.update(role='DROP')
+    _members_changed(changes)
     db = SIMSConn()
     db.execute("SELECT CRSE_ID, CLASS_SECTION, STRM, EMPLID, INSTR_ROLE, SCHED_PRINT_INSTR FROM PS_CLASS_INSTR WHERE " \
                "STRM=%s AND INSTR_ROLE IN ('PI', 'SI') AND " + extra_where,
                (strm,))
 
-    for crse_id, class_section, strm, emplid, instr_role, sched_print_instr in db.rows():
-        if not emplid or (strm, crse_id, class_section) not in offering_map:
-            continue
+    rows = [r for r in db.rows() if r[3] and (r[2], r[0], r[1]) in offering_map]
+    people = get_people(r[3] for r in rows)
+    for crse_id, class_section, strm, emplid, instr_role, sched_print_instr in rows:
         offering = offering_map[(strm, crse_id, class_section)]
-        p = get_person(emplid)
+        p = people.get(int(emplid))
         ensure_member(p, offering, "INST", 0, "AUTO", "NONS", sched_print_instr=sched_print_instr)
 
 
-@transaction.atomic
-def import_all_students(strm, extra_where='1=1', offering_map=None):
+STUDENT_IMPORT_CHUNK = 200 # offerings per round of SIMS queries in import_all_students
+MEMBER_UPDATE_FIELDS = ['role', 'labtut_section', 'credits', 'added_reason', 'career', 'official_grade', 'config']
+
+
+class StudentImportDiff(object):
+    """
+    The changes to Member objects found by import_all_students.
+    """
+    def __init__(self):
+        self.added = [] # (offering, emplid) for new students
+        self.changed = [] # (Member, list of changed fields) for existing members
+        self.labtut_offerings = set() # offerings newly found to have lab/tutorial sections
+        self.new_people = set() # emplids with no Person yet (not created in a dry run)
+
+    def dropped(self):
+        return [m for m, fields in self.changed if 'role' in fields and m.role == 'DROP']
+
+    def summary(self):
+        lines = ['%i students added, %i members changed (%i dropped), %i offerings now with labs/tutorials.'
+                 % (len(self.added), len(self.changed), len(self.dropped()), len(self.labtut_offerings))]
+        lines.extend('add %s to %s' % (emplid, o.slug) for o, emplid in self.added)
+        lines.extend('change %s in %s: %s' % (m.person.emplid, m.offering.slug, ', '.join(fields))
+                     for m, fields in self.changed)
+        lines.extend('set labtut on %s' % (o.slug,) for o in sorted(self.labtut_offerings))
+        return '\n'.join(lines)
+
+
+def _student_changes(diff, offerings, enrolments, labtut, drop_dates, people, letter_offerings, members):
+    """
+    Work out the Member changes for these offerings, following the same rules as import_students and ensure_member,
+    and record them in diff. Returns the Member objects to be created and updated.
+
+    offerings: class_nbr -> CourseOffering
+    enrolments: list of (class_nbr, emplid, acad_career, unt_taken, grade_official, grade_roster) from SIMS
+    labtut: (class_nbr, emplid) -> lab/tutorial section
+    drop_dates: (class_nbr, emplid) -> drop date
+    people: emplid -> Person (missing for people we don't know yet in a dry run)
+    letter_offerings: ids of offerings with letter activities (so official grades are recorded)
+    members: all existing Member objects in the offerings (with .person selected)
+    """
+    by_person = {}
+    originals = {}
+    for m in members:
+        by_person.setdefault((m.offering_id, m.person.emplid), []).append(m)
+        originals[m.id] = [getattr(m, f) for f in MEMBER_UPDATE_FIELDS]
+        m.config = dict(m.config)
+        if m.added_reason == 'AUTO' and m.role == 'STUD':
+            # anyone no longer enrolled is dropped
+            m.role = 'DROP'
+
+    new_members = []
+    for class_nbr, emplid, acad_career, unt_taken, grade_official, grade_roster in enrolments:
+        emplid = int(emplid)
+        if emplid in IGNORE_EMPLIDS:
+            continue
+        offering = offerings[class_nbr]
+        existing = by_person.get((offering.id, emplid), [])
+        current = [m for m in existing if m.role != 'DROP']
+        if len(current) > 1:
+            raise KeyError("Already duplicate entries: %r" % (current))
+        elif current:
+            m = current[0]
+        elif existing:
+            m = existing[0]
+        elif emplid not in people:
+            diff.added.append((offering, emplid))
+            diff.new_people.add(emplid)
+            continue
+        else:
+            m = Member(person=people[emplid], offering=offering)
+            by_person[(offering.id, emplid)] = [m]
+            new_members.append(m)
+            diff.added.append((offering, emplid))
+
+        sec = labtut.get((class_nbr, emplid), None)
+        m.role = 'STUD'
+        m.labtut_section = sec
+        m.credits = int(unt_taken)
+        m.added_reason = 'AUTO'
+        m.career = acad_career
+        if offering.id in letter_offerings:
+            m.official_grade = grade_official or grade_roster or None
+        else:
+            m.official_grade = None
+
+        if sec and not offering.labtut():
+            diff.labtut_offerings.add(offering)
+
+    # Record drop date so the discipline app can display "students who have dropped, but not too long ago".
+    for (class_nbr, emplid), drop_date in drop_dates.items():
+        for m in by_person.get((offerings[class_nbr].id, int(emplid)), []):
+            m.config['drop_date'] = drop_date.isoformat()
+
+    changed_members = []
+    for m in members:
+        fields = [f for f, orig in zip(MEMBER_UPDATE_FIELDS, originals[m.id]) if getattr(m, f) != orig]
+        if fields:
+            diff.changed.append((m, fields))
+            changed_members.append(m)
+
+    return new_members, changed_members
+
+
+def _semester_students_from_sims(strm, class_nbrs):
+    """
+    The enrolment data import_all_students needs from SIMS for these offerings.
+    """
+    db = SIMSConn()
+    # lab/tutorial sections: students in a section of the same course starting with the same two characters
+    db.execute("SELECT C1.CLASS_NBR, S.EMPLID, C2.CLASS_SECTION, C1.CLASS_SECTION "
+               "FROM PS_CLASS_TBL C1, PS_CLASS_TBL C2, PS_STDNT_ENRL S "
+               "WHERE C1.SUBJECT=C2.SUBJECT AND C1.CATALOG_NBR=C2.CATALOG_NBR AND C2.STRM=C1.STRM "
+               "AND S.CLASS_NBR=C2.CLASS_NBR AND S.STRM=C2.STRM AND S.ENRL_STATUS_REASON IN ('ENRL','EWAT') "
+               "AND C1.CLASS_NBR IN %s AND C1.STRM=%s AND LEFT(C2.CLASS_SECTION, 2)=LEFT(C1.CLASS_SECTION, 2)",
+               (class_nbrs, strm))
+    labtut = dict(((int(class_nbr), int(emplid)), section) for class_nbr, emplid, section, lecture in db
+                  if section != lecture)
+
+    db.execute("SELECT E.CLASS_NBR, E.EMPLID, E.ACAD_CAREER, E.UNT_TAKEN, E.CRSE_GRADE_OFF, R.CRSE_GRADE_INPUT "
+               "FROM PS_STDNT_ENRL E LEFT JOIN PS_GRADE_ROSTER R "
+               "ON E.STRM=R.STRM AND E.ACAD_CAREER=R.ACAD_CAREER AND E.EMPLID=R.EMPLID AND E.CLASS_NBR=R.CLASS_NBR "
+               "WHERE E.CLASS_NBR IN %s AND E.STRM=%s AND E.STDNT_ENRL_STATUS='E' and "
+               "E.ENRL_STATUS_REASON IN ('ENRL','EWAT')", (class_nbrs, strm))
+    enrolments = [(int(class_nbr),) + tuple(row) for class_nbr, *row in db.rows()]
+
+    db.execute("SELECT E.CLASS_NBR, E.EMPLID, E.ENRL_DROP_DT FROM PS_STDNT_ENRL E "
+               "WHERE E.CLASS_NBR IN %s AND E.STRM=%s "
+               "AND E.ENRL_STATUS_REASON NOT IN ('ENRL','EWAT') AND E.ENRL_DROP_DT IS NOT NULL", (class_nbrs, strm))
+    drop_dates = dict(((int(class_nbr), int(emplid)), dt) for class_nbr, emplid, dt in db)
+
+    return enrolments, labtut, drop_dates
+
+
+def _people_by_emplid(emplids, dry_run=False):
+    """
+    Person objects for these emplids. In a dry run, only the ones we already have.
+    """
+    if dry_run:
+        return dict((p.emplid, p) for p in Person.objects.filter(emplid__in=emplids))
+    return get_people(emplids)
+
+
+def import_all_students(strm, extra_where='1=1', offering_map=None, dry_run=False, chunk_size=STUDENT_IMPORT_CHUNK):
+    """
+    Import student enrolments for every offering in the semester (or the ones whose PS_CLASS_TBL rows match
+    extra_where): the set-based equivalent of import_students on each of them.
+
+    Offerings are handled in chunks, with three SIMS queries for each. The changes are worked out in memory and
+    saved with bulk inserts/updates (unless dry_run), in a transaction for each chunk. Returns a StudentImportDiff
+    describing them.
+    """
     if not offering_map:
         offering_map = crseid_offering_map(strm)
+    offerings = dict((o.class_nbr, o) for o in offering_map.values())
 
-    Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="STUD").update(role='DROP')
-    db = SIMSConn()
+    if extra_where != '1=1':
+        db = SIMSConn()
+        db.execute("SELECT CLASS_NBR FROM PS_CLASS_TBL WHERE STRM=%s AND " + extra_where, (strm,))
+        wanted = set(int(class_nbr) for class_nbr, in db)
+        offerings = dict((n, o) for n, o in offerings.items() if n in wanted)
+
+    diff = StudentImportDiff()
+    class_nbrs = sorted(offerings.keys())
+    letter_offerings = set(LetterActivity.objects.filter(offering__semester__name=strm, deleted=False)
+                           .values_list('offering_id', flat=True))
+    for start in range(0, len(class_nbrs), chunk_size):
+        chunk = dict((n, offerings[n]) for n in class_nbrs[start:start+chunk_size])
+        # the SIMS queries (and any new people) before the chunk's transaction, so it stays short
+        enrolments, labtut, drop_dates = _semester_students_from_sims(strm, list(chunk.keys()))
+        people = _people_by_emplid(set(int(e[1]) for e in enrolments), dry_run=dry_run)
+
+        with transaction.atomic():
+            members = list(Member.objects.filter(offering__in=list(chunk.values()))
+                           .select_related('person', 'offering').order_by('id'))
+            new_members, changed_members = _student_changes(diff, chunk, enrolments, labtut, drop_dates, people,
+                                                            letter_offerings, members)
+            if not dry_run:
+                Member.objects.bulk_create(new_members, batch_size=1000)
+                Member.objects.bulk_update(changed_members, MEMBER_UPDATE_FIELDS, batch_size=1000)
+                # no signals from the bulk operations
+                _members_changed((m.offering_id, m.person.userid) for m in new_members + changed_members)
+
+    if not dry_run:
+        for offering in diff.labtut_offerings:
+            offering.set_labtut(True)
+            offering.save_if_dirty()
 
-    # TODO: remainder of this function not yet refactored. Needs to be broken up since >200k registrations shouldn't be
-    # processed at once.
+    return diff
 
 
 
@@ -704,8 +1032,7 @@ def update_grads():
                  updated_at__gt=datetime.datetime.now()-datetime.timedelta(days=7)).select_related('person')
     s = Semester.current().offset(1)
     far_applicants = GradStudent.objects.filter(start_semester__name__gte=s.name).select_related('person')
-    for gs in set(itertools.chain(active, applicants, far_applicants)):
-        get_person_grad(gs.person.emplid)
+    get_people(set(gs.person.emplid for gs in itertools.chain(active, applicants, far_applicants)), grad_data=True)
 
 
 def import_one_semester(strm, extra_where='1=1'):
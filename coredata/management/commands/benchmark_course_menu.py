@@ -0,0 +1,117 @@
+import datetime
+import json
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+
+from coredata.models import Course, CourseOffering, Member, Person, Semester, Unit
+from grades.models import Activity
+from pages.models import Page
+
+
+class _Rollback(Exception):
+    pass
+
+
+def annotated_memberships(userid):
+    """
+    The old way to build the menu: count each offering's activities and pages in the membership query.
+    """
+    today = datetime.date.today()
+    memberships = Member.objects.exclude(role="DROP").exclude(offering__component="CAN") \
+            .filter(offering__graded=True, person__userid=userid) \
+            .order_by('-offering__semester', 'offering') \
+            .annotate(num_activities=Count('offering__activity')) \
+            .annotate(num_pages=Count('offering__page')) \
+            .select_related('offering', 'offering__semester')
+    return [m for m in memberships if m.role in ['TA', 'INST', 'APPR']
+            or ((m.num_activities > 0 or m.num_pages > 0) and m.offering.semester.start <= today)]
+
+
+class Command(BaseCommand):
+    help = 'Time building the course menu for a user with many memberships in page-heavy offerings, with the old ' \
+           'Count annotations and with the per-offering counters. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--memberships', type=int, default=100, dest='memberships', help='offerings the user is in')
+        parser.add_argument('--pages', type=int, default=50, dest='pages', help='pages in each offering')
+        parser.add_argument('--activities', type=int, default=10, dest='activities',
+                            help='activities in each offering')
+        parser.add_argument('--iterations', type=int, default=20, dest='iterations', help='menus built of each kind')
+        parser.add_argument('--output', type=str, dest='output', help='file for the JSON report (default stdout)')
+
+    def _measure(self, name, func, iterations=1):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                res = func()
+            elapsed = time.perf_counter() - start
+        self.stderr.write('%-25s %9.3f s %7i queries' % (name, elapsed, len(queries)))
+        return res, {'name': name, 'seconds': round(elapsed, 4), 'queries': len(queries)}
+
+    def _build(self, memberships, pages, activities):
+        """
+        A student in memberships offerings (spread over the past semesters), each with the given pages and
+        activities.
+        """
+        semesters = list(Semester.objects.filter(start__lte=datetime.date.today()).order_by('-name')[:6])
+        unit = Unit.objects.order_by('id').first()
+        student = Person(emplid=999999999, userid='zzbench', last_name='Benchmark', first_name='Student')
+        student.save()
+        for i in range(memberships):
+            course = Course(subject='BENC', number='%03i' % (i,), title='Benchmark Course')
+            course.save()
+            offering = CourseOffering(
+                semester=semesters[i % len(semesters)], subject='BENC', number='%03i' % (i,), section='D100',
+                title='Benchmark Course', owner=unit, component='LEC', instr_mode='P', crse_id=90000 + i,
+                class_nbr=90000 + i, campus='BRNBY', enrl_cap=100, enrl_tot=100, wait_tot=0, units=3, course=course)
+            offering.save()
+            Member(person=student, offering=offering, role='STUD', added_reason='AUTO', career='UGRD').save()
+            # in bulk, so recount afterwards
+            Page.objects.bulk_create([Page(offering=offering, label='Page%i' % (j,)) for j in range(pages)])
+            Activity.objects.bulk_create([
+                Activity(offering=offering, name='Activity %i' % (j,), short_name='A%i' % (j,), slug='a%i' % (j,),
+                         status='RLS', position=j)
+                for j in range(activities)])
+            CourseOffering.update_content_counts(offering.id)
+        return student
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        report = {'database': connection.vendor, 'memberships': options['memberships'], 'pages': options['pages'],
+                  'activities': options['activities'], 'iterations': n}
+        try:
+            with transaction.atomic():
+                userid = self._build(options['memberships'], options['pages'], options['activities']).userid
+                results = []
+
+                old, r = self._measure('annotated (old)', lambda: annotated_memberships(userid), n)
+                results.append(r)
+                new, r = self._measure('counters (uncached)', lambda: Member._get_memberships(userid), n)
+                results.append(r)
+                # get_memberships also hides the student's older offerings
+                past1 = datetime.date.today() - datetime.timedelta(days=365)
+                assert [m.id for m in old if m.offering.semester.end >= past1] == [m.id for m in new[0]]
+
+                Member.clear_menu_cache([userid])
+                _, r = self._measure('counters (cache miss)', lambda: Member.get_memberships(userid))
+                results.append(r)
+                _, r = self._measure('counters (cached)', lambda: Member.get_memberships(userid), n)
+                results.append(r)
+
+                report['results'] = results
+                raise _Rollback()
+        except _Rollback:
+            pass
+        cache.delete(Member._menu_cache_key('zzbench'))
+
+        data = json.dumps(report, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+        else:
+            self.stdout.write(data)
@@ -0,0 +1,61 @@
+import datetime
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from coredata.models import Semester, semester_index
+
+
+def _db_get_semester(date):
+    return Semester.objects.filter(start__lte=date).order_by('-start')[0]
+
+
+def _db_offset(semester, n):
+    if n > 0:
+        return Semester.objects.filter(name__gt=semester.name).order_by('name')[n-1]
+    return Semester.objects.filter(name__lt=semester.name).order_by('-name')[(-n)-1]
+
+
+class Command(BaseCommand):
+    help = 'Time the common Semester lookups with the in-process SemesterIndex against the equivalent queries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=1000, dest='iterations', help='lookups of each kind')
+        parser.add_argument('--output', type=str, dest='output', help='file for the JSON report (default stdout)')
+
+    def _measure(self, name, func, iterations):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for i in range(iterations):
+                func(i)
+            elapsed = time.perf_counter() - start
+        self.stderr.write('%-25s %9.3f s %7i queries %9.1f us/lookup' % (name, elapsed, len(queries),
+                                                                          elapsed / iterations * 1e6))
+        return {'name': name, 'seconds': round(elapsed, 4), 'queries': len(queries),
+                'us_per_lookup': round(elapsed / iterations * 1e6, 2)}
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        index = semester_index()
+        first = index.on_date(datetime.date.today()).offset(-6)
+        dates = [first.start + datetime.timedelta(days=i % 730) for i in range(n)]
+        semester = Semester.current()
+
+        report = {'database': connection.vendor, 'semesters': len(index), 'iterations': n, 'results': [
+            self._measure('current (query)', lambda i: _db_get_semester(datetime.date.today()), n),
+            self._measure('current (index)', lambda i: Semester.current(), n),
+            self._measure('get_semester (query)', lambda i: _db_get_semester(dates[i]), n),
+            self._measure('get_semester (index)', lambda i: Semester.get_semester(dates[i]), n),
+            self._measure('offset (query)', lambda i: _db_offset(semester, -1 - i % 3), n),
+            self._measure('offset (index)', lambda i: semester.offset(-1 - i % 3), n),
+        ]}
+
+        data = json.dumps(report, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+        else:
+            self.stdout.write(data)
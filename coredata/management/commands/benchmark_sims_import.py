@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from coredata import importer, sims_standin
+from coredata.queries import sims_query_stats
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time the semester importer against the SQLite stand-in for the reporting database, filled to match ' \
+           'the offerings we have in the semester. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('strm', type=str, help='semester to import, like 1237')
+        parser.add_argument('--students', type=int, default=None, dest='students',
+                            help='made-up students per offering (default: the existing ones)')
+        parser.add_argument('--output', type=str, dest='output', help='file for the JSON report (default stdout)')
+
+    def _measure(self, name, func):
+        before = sims_query_stats.copy()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        sims = sims_query_stats['queries'] - before['queries']
+        sims_time = sims_query_stats['seconds'] - before['seconds']
+        self.stderr.write('%-20s %9.3f s %7i queries %7i SIMS queries (%.3f s)' % (name, elapsed, len(queries), sims,
+                                                                                   sims_time))
+        return {'name': name, 'seconds': round(elapsed, 4), 'queries': len(queries), 'sims_queries': sims,
+                'sims_seconds': round(sims_time, 4)}
+
+    def handle(self, *args, **options):
+        strm = options['strm']
+        report = {'database': connection.vendor, 'strm': strm, 'students': options['students']}
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                override_settings(SIMS_BACKEND='sqlite', SIMS_STANDIN_DB=os.path.join(tmpdir, 'sims.sqlite')):
+            sims_standin.populate(strm, students_per_offering=options['students'])
+            try:
+                with transaction.atomic():
+                    importer.imported_people = {}
+                    importer.person_import_stats.clear()
+                    report['results'] = [
+                        self._measure('instructors', lambda: importer.import_all_instructors(strm)),
+                        self._measure('students', lambda: importer.import_all_students(strm)),
+                    ]
+                    report['people'] = dict(importer.person_import_stats)
+                    raise _Rollback()
+            except _Rollback:
+                pass
+            finally:
+                importer.imported_people = {}
+                sims_standin.close()
+
+        data = json.dumps(report, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+        else:
+            self.stdout.write(data)
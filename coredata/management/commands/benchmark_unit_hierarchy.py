@@ -0,0 +1,117 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from coredata.models import Unit, UnitClosure
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _label(n):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    return 'Q' + ''.join(digits[(n // 36**i) % 36] for i in (2, 1, 0))
+
+
+def walk_sub_unit_ids(unitids):
+    """
+    The old way to find descendants: a query per level of the hierarchy.
+    """
+    children = unitids
+    descendants = set(children)
+    while True:
+        children = set(Unit.objects.filter(parent__in=children).values_list('id', flat=True))
+        if not children:
+            break
+        descendants |= children
+    return descendants
+
+
+def walk_super_units(unit):
+    """
+    The old way to find ancestors: a query per level of the hierarchy.
+    """
+    res = []
+    while unit.parent:
+        unit = unit.parent
+        res.append(unit)
+    return res
+
+
+class Command(BaseCommand):
+    help = 'Time unit hierarchy lookups, walking the parents and with the UnitClosure table, on a made-up deep ' \
+           'hierarchy. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=30, dest='depth', help='levels in the hierarchy')
+        parser.add_argument('--breadth', type=int, default=10, dest='breadth', help='units at each level')
+        parser.add_argument('--iterations', type=int, default=100, dest='iterations', help='lookups of each kind')
+        parser.add_argument('--output', type=str, dest='output', help='file for the JSON report (default stdout)')
+
+    def _measure(self, name, func, iterations=1):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                res = func()
+            elapsed = time.perf_counter() - start
+        self.stderr.write('%-25s %9.3f s %7i queries' % (name, elapsed, len(queries)))
+        return res, {'name': name, 'seconds': round(elapsed, 4), 'queries': len(queries)}
+
+    def _build(self, depth, breadth):
+        """
+        Each level has breadth units, all children of the first unit on the level above.
+        """
+        labels = iter(_label(n) for n in range(36**3))
+        root = Unit(label=next(labels), name='Benchmark Root')
+        root.save()
+        parent = root
+        for _ in range(depth):
+            level = [Unit(label=next(labels), name='Benchmark Unit', parent=parent) for _ in range(breadth)]
+            Unit.objects.bulk_create(level) # no signals: UnitClosure.rebuild() below
+            parent = Unit.objects.get(label=level[0].label)
+        return root, parent
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        report = {'database': connection.vendor, 'depth': options['depth'], 'breadth': options['breadth'],
+                  'iterations': n}
+        try:
+            with transaction.atomic():
+                root, leaf = self._build(options['depth'], options['breadth'])
+                results = []
+                _, r = self._measure('rebuild', UnitClosure.rebuild)
+                results.append(r)
+                _, r = self._measure('check', UnitClosure.problems)
+                results.append(r)
+
+                old, r = self._measure('sub_unit_ids (walk)', lambda: walk_sub_unit_ids({root.id}), n)
+                results.append(r)
+                new, r = self._measure('sub_unit_ids (closure)', lambda: Unit.sub_unit_ids([root]), n)
+                results.append(r)
+                assert old == new
+
+                leaf = Unit.objects.get(id=leaf.id)
+                old, r = self._measure('super_units (walk)',
+                                       lambda: walk_super_units(Unit.objects.get(id=leaf.id)), n)
+                results.append(r)
+                new, r = self._measure('super_units (closure)', lambda: leaf.super_units(), n)
+                results.append(r)
+                assert old == new
+
+                report['units'] = Unit.objects.filter(label__startswith='Q').count()
+                report['closure_rows'] = UnitClosure.objects.count()
+                report['results'] = results
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        data = json.dumps(report, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+        else:
+            self.stdout.write(data)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from coredata.models import UnitClosure
+
+
+class Command(BaseCommand):
+    help = 'Check that the UnitClosure table matches the Unit hierarchy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', dest='fix', help='rebuild the table if there are problems')
+
+    def handle(self, *args, **options):
+        problems = UnitClosure.problems()
+        for p in problems:
+            self.stdout.write(p)
+        if not problems:
+            self.stdout.write('UnitClosure is consistent.')
+            return
+
+        if not options['fix']:
+            raise CommandError('%i problems found: run with --fix to rebuild.' % (len(problems),))
+        UnitClosure.rebuild()
+        problems = UnitClosure.problems()
+        if problems:
+            raise CommandError('Still %i problems after rebuilding.' % (len(problems),))
+        self.stdout.write('Rebuilt UnitClosure.')
@@ -0,0 +1,29 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from coredata.models import EnrolmentHistory
+
+
+def _date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = 'Remove EnrolmentHistory rows that are the same as the previous snapshot for their offering.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=_date, default=None, dest='start_date', help='first date to consider (YYYY-MM-DD)')
+        parser.add_argument('--end', type=_date, default=None, dest='end_date', help='last date to consider (YYYY-MM-DD)')
+        parser.add_argument('--compact', action='store_true', dest='compact',
+                            help='compare the range with the snapshot before it too, leaving only the changes')
+        parser.add_argument('--chunk-size', type=int, default=EnrolmentHistory.DEDUPLICATE_DELETE_CHUNK,
+                            dest='chunk_size', help='rows per DELETE statement')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='report the changes without making them')
+
+    def handle(self, *args, **options):
+        stats = EnrolmentHistory.deduplicate(start_date=options['start_date'], end_date=options['end_date'],
+                                             dry_run=options['dry_run'], compact=options['compact'],
+                                             chunk_size=options['chunk_size'])
+        self.stdout.write('%(scanned)i rows scanned, %(removed)i removed in %(seconds).3f s' % stats)
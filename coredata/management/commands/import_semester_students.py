@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from coredata import importer
+
+
+class Command(BaseCommand):
+    help = 'Import student enrolments from SIMS for all offerings in a semester.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('strm', type=str, help='semester to import, like 1204')
+        parser.add_argument('--extra-where', type=str, default='1=1', dest='extra_where',
+                            help='SQL condition on PS_CLASS_TBL to restrict the offerings imported')
+        parser.add_argument('--chunk-size', type=int, default=importer.STUDENT_IMPORT_CHUNK, dest='chunk_size',
+                            help='offerings per round of SIMS queries')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='report the changes without making them')
+
+    def handle(self, *args, **options):
+        diff = importer.import_all_students(options['strm'], extra_where=options['extra_where'],
+                                            dry_run=options['dry_run'], chunk_size=options['chunk_size'])
+        if options['dry_run'] or options['verbosity'] > 1:
+            self.stdout.write(diff.summary())
+            self.stdout.write(importer.person_import_summary())
+        else:
+            self.stdout.write(diff.summary().split('\n')[0])
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:19
+
+import courselib.json_fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0025_update_choices'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OfferingImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OfferingImportGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slugs', courselib.json_fields.JSONField(default=list)),
+                ('weight', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('WAIT', 'Waiting'), ('RUN', 'Running'), ('RETR', 'Failed: will retry'), ('DONE', 'Done'), ('FAIL', 'Failed')], default='WAIT', max_length=4)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.DurationField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coredata.offeringimport')),
+                ('unit', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='coredata.unit')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
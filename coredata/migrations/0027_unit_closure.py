@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_closure(apps, schema_editor):
+    Unit = apps.get_model('coredata', 'Unit')
+    UnitClosure = apps.get_model('coredata', 'UnitClosure')
+    parents = dict(Unit.objects.values_list('id', 'parent_id'))
+    closure = []
+    for unit_id in parents:
+        ancestor_id, depth, seen = unit_id, 0, set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            closure.append(UnitClosure(ancestor_id=ancestor_id, descendant_id=unit_id, depth=depth))
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    UnitClosure.objects.bulk_create(closure, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0026_offering_import'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnitClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField(help_text='Steps from ancestor down to descendant')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='coredata.unit')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='coredata.unit')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'descendant')},
+                'index_together': {('descendant', 'depth')},
+            },
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+def count_content(apps, schema_editor):
+    CourseOffering = apps.get_model('coredata', 'CourseOffering')
+    Activity = apps.get_model('grades', 'Activity')
+    Page = apps.get_model('pages', 'Page')
+    # counted separately: counting both in one query would multiply them
+    activities = dict(Activity.objects.filter(deleted=False).exclude(status='INVI').order_by()
+                      .values_list('offering_id').annotate(n=models.Count('id')))
+    pages = dict(Page.objects.order_by().values_list('offering_id').annotate(n=models.Count('id')))
+    for offering_id in set(activities) | set(pages):
+        CourseOffering.objects.filter(id=offering_id) \
+            .update(activity_count=activities.get(offering_id, 0), page_count=pages.get(offering_id, 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0027_unit_closure'),
+        ('grades', '0006_activitystats'),
+        ('pages', '0007_relative_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='courseoffering',
+            name='activity_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of activities visible to students'),
+        ),
+        migrations.AddField(
+            model_name='courseoffering',
+            name='page_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of pages'),
+        ),
+        migrations.RunPython(count_content, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0028_offering_content_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offeringimport',
+            name='lanes',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='offeringimport',
+            name='lanes_finished',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -1,10 +1,10 @@
 from django.core.validators import RegexValidator
 from django.db import models, transaction, IntegrityError
-from django.db.models import Count
+from django.db.models import Count, OuterRef, Q, Subquery
 from autoslug import AutoSlugField
 from courselib.slugs import make_slug
 from django.conf import settings
-import datetime, urllib.parse, decimal
+import datetime, urllib.parse, decimal, time
 from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
@@ -17,7 +17,7 @@ from courselib.branding import product_name, help_email
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 from bitfield import BitField
-import fractions, itertools
+import fractions, itertools, bisect, uuid
 
 def repo_name(offering, slug):
     """
@@ -632,7 +632,7 @@ class Semester(models.Model):
 
         # find the "base": first known week before the given date
         if not weeks:
-            weeks = list(SemesterWeek.objects.filter(semester=self))
+            weeks = semester_index().weeks(self.id)
         weeks.reverse()
         base = None
         for w in weeks:
@@ -656,7 +656,7 @@ class Semester(models.Model):
         Calculate duedate based on week-of-semester and weekday.  Provided argument time can be either datetime.time or datetime.datetime: time is copied from this to new duedate.
         """
         # find the "base": first known week before wk
-        weeks = list(SemesterWeek.objects.filter(semester=self))
+        weeks = semester_index().weeks(self.id)
         weeks.reverse()
         base = None
         for w in weeks:
@@ -683,18 +683,9 @@ class Semester(models.Model):
     
     def offset(self, n):
         "The semester n semesters forward/back in time"
-        if n > 0:
-            try:
-                return Semester.objects.filter(name__gt=self.name).order_by('name')[n-1]
-            except IndexError:
-                return None
-        elif n < 0:
-            try:
-                return Semester.objects.filter(name__lt=self.name).order_by('-name')[(-n)-1]
-            except IndexError:
-                return None
-        else:
+        if n == 0:
             return self
+        return semester_index().offset(self.name, n)
 
     def offset_name(self, n):
         "as offset() but only calculate the semester.name, without querying the DB"
@@ -748,21 +739,14 @@ class Semester(models.Model):
     def get_semester(cls, date=None):
         if not date:
             date = datetime.date.today()
-        return Semester.objects.filter(start__lte=date).order_by('-start')[0]
+        return semester_index().on_date(date)
 
     @classmethod
     def next_starting(cls):
         """
         The next semester that starts after now
         """
-        today = datetime.date.today()
-        sems = Semester.objects.filter(start__gt=today).order_by('start')
-        if sems:
-            return sems[0]
-        else:
-            # just in case there's nothing in the future
-            sems = Semester.objects.order_by('-start')
-            return sems[0]
+        return semester_index().next_starting(datetime.date.today())
 
     @classmethod
     def first_relevant(cls):
@@ -786,7 +770,7 @@ class Semester(models.Model):
             sem = 7
         
         name = "%03d%1d" % ((year - 1900), sem)
-        return Semester.objects.get(name=name)
+        return semester_index().get(name)
 
     @classmethod
     def range(cls, start, end):
@@ -794,14 +778,9 @@ class Semester(models.Model):
         Produce a list of semesters from start to end. 
         Semester.range( '1134', '1147' ) == [ '1134', '1137', '1141', '1144', '1147' ]
 
-        Will run forever or fail if the end semester is not a valid semester. 
+        If the end semester is not a valid semester, continues to the last one we have.
         """
-        current_semester = Semester.objects.get(name=start)
-        while current_semester and current_semester.name != end:
-            yield str(current_semester.name)
-            current_semester = current_semester.offset(1) 
-        if current_semester:
-            yield str(current_semester.name)
+        return semester_index().name_range(start, end)
 
 class SemesterWeek(models.Model):
     """
@@ -820,6 +799,153 @@ class SemesterWeek(models.Model):
         unique_together = (('semester', 'week'))
 
 
+SEMESTER_INDEX_VERSION_KEY = 'semester_index_version'
+SEMESTER_INDEX_VERSION_TIMEOUT = 86400*7
+SEMESTER_INDEX_RECHECK = 5 # seconds between checks of the version key
+
+
+class SemesterIndex(object):
+    """
+    All of the semesters and their weeks, sorted so the common lookups (current semester, semester on a date,
+    offsets) are binary searches instead of queries. Treat as immutable: a change to any Semester or SemesterWeek
+    replaces the index (see semester_index). The Semester and SemesterWeek objects returned are fresh copies.
+    """
+    FIELDS = ['id', 'name', 'start', 'end']
+    WEEK_FIELDS = ['id', 'semester_id', 'week', 'monday']
+
+    def __init__(self, rows, week_rows, version=None, db='default'):
+        self.version = version
+        self.db = db
+        self.by_name = tuple(sorted(rows, key=lambda r: r[1]))
+        self.names = tuple(r[1] for r in self.by_name)
+        self.by_start = tuple(sorted(rows, key=lambda r: (r[2], r[1])))
+        self.starts = tuple(r[2] for r in self.by_start)
+        weeks = {}
+        for w in sorted(week_rows, key=lambda w: (w[1], w[2])):
+            weeks.setdefault(w[1], []).append(w)
+        self.week_rows = dict((sem_id, tuple(ws)) for sem_id, ws in weeks.items())
+
+    @classmethod
+    def load(cls, version=None):
+        semesters = Semester.objects.order_by()
+        rows = list(semesters.values_list(*cls.FIELDS))
+        week_rows = list(SemesterWeek.objects.order_by().values_list(*cls.WEEK_FIELDS))
+        return cls(rows, week_rows, version=version, db=semesters.db)
+
+    def _semester(self, row):
+        return Semester.from_db(self.db, self.FIELDS, row)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            raise Semester.DoesNotExist('Semester matching query does not exist.')
+        return self._semester(self.by_name[i])
+
+    def on_date(self, date):
+        """
+        The semester that started most recently on or before the date. IndexError if there isn't one.
+        """
+        i = bisect.bisect_right(self.starts, date) - 1
+        if i < 0:
+            raise IndexError('No semester starts before %s' % (date,))
+        return self._semester(self.by_start[i])
+
+    def next_starting(self, date):
+        """
+        The first semester starting after the date (or the last semester, if there's nothing later).
+        """
+        i = bisect.bisect_right(self.starts, date)
+        return self._semester(self.by_start[min(i, len(self.starts) - 1)])
+
+    def offset(self, name, n):
+        """
+        The semester n semesters after (or before, if negative) the named one, or None.
+        """
+        if n > 0:
+            i = bisect.bisect_right(self.names, name) + n - 1
+        else:
+            i = bisect.bisect_left(self.names, name) + n
+        if 0 <= i < len(self.names):
+            return self._semester(self.by_name[i])
+        return None
+
+    def name_range(self, start, end):
+        """
+        Names of the semesters from start to end inclusive (or to the last semester, if end isn't one).
+        """
+        self.get(start)
+        i = bisect.bisect_left(self.names, start)
+        j = bisect.bisect_left(self.names, end)
+        if j < len(self.names) and self.names[j] == end and j >= i:
+            return list(self.names[i:j+1])
+        return list(self.names[i:])
+
+    def between(self, start, end):
+        """
+        Semesters that start and end between the dates (inclusive), in order.
+        """
+        i = bisect.bisect_left(self.starts, start)
+        j = bisect.bisect_right(self.starts, end)
+        return [self._semester(r) for r in self.by_start[i:j] if r[3] <= end]
+
+    def weeks(self, semester_id):
+        """
+        The semester's SemesterWeeks, in order.
+        """
+        return [SemesterWeek.from_db(self.db, self.WEEK_FIELDS, w) for w in self.week_rows.get(semester_id, ())]
+
+
+_semester_index = None
+_semester_index_checked = 0.0
+
+
+def _semester_index_version():
+    version = cache.get(SEMESTER_INDEX_VERSION_KEY)
+    if version is None:
+        cache.add(SEMESTER_INDEX_VERSION_KEY, uuid.uuid4().hex, SEMESTER_INDEX_VERSION_TIMEOUT)
+        version = cache.get(SEMESTER_INDEX_VERSION_KEY)
+    return version
+
+
+def semester_index():
+    """
+    The process's SemesterIndex, loaded when first needed. Changes made in this process replace it immediately; the
+    shared version key (checked every SEMESTER_INDEX_RECHECK seconds) tells other processes to reload.
+    """
+    global _semester_index, _semester_index_checked
+    index = _semester_index
+    now = time.monotonic()
+    if index is not None and now - _semester_index_checked < SEMESTER_INDEX_RECHECK:
+        return index
+
+    version = _semester_index_version()
+    if index is None or version is None or index.version != version:
+        index = SemesterIndex.load(version)
+    _semester_index = index
+    _semester_index_checked = now
+    return index
+
+
+def invalidate_semester_index():
+    global _semester_index
+    _semester_index = None
+    cache.set(SEMESTER_INDEX_VERSION_KEY, uuid.uuid4().hex, SEMESTER_INDEX_VERSION_TIMEOUT)
+
+
+def _semester_changed(sender, **kwargs):
+    invalidate_semester_index()
+    # ... and again once committed, in case the index was reloaded (here or elsewhere) before the commit. (An index
+    # reloaded with a change that's then rolled back is kept until the next change.)
+    transaction.on_commit(invalidate_semester_index)
+
+for _model in [Semester, SemesterWeek]:
+    models.signals.post_save.connect(_semester_changed, sender=_model)
+    models.signals.post_delete.connect(_semester_changed, sender=_model)
+
+
 HOLIDAY_TYPE_CHOICES = (
         ('FULL', 'Classes cancelled, offices closed'),
         ('CLAS', 'Classes cancelled, offices open'),
@@ -974,6 +1100,11 @@ class CourseOffering(models.Model, ConditionalSaveMixin):
 
     # WQB requirement flags
     flags = BitField(flags=OFFERING_FLAG_KEYS, default=0)
+
+    # maintained by update_content_counts, so the course menu doesn't have to count them
+    activity_count = models.PositiveIntegerField(default=0, editable=False,
+        help_text='Number of activities visible to students')
+    page_count = models.PositiveIntegerField(default=0, editable=False, help_text='Number of pages')
     
     members = models.ManyToManyField(Person, related_name="member", through="Member")
     config = JSONField(null=False, blank=False, default=dict) # addition configuration stuff
@@ -1053,11 +1184,53 @@ class CourseOffering(models.Model, ConditionalSaveMixin):
         else:
             return "%s %s %s" % (self.subject, self.number, self.section)
     
+    COUNTER_FIELDS = ['activity_count', 'page_count']
+
     def save(self, *args, **kwargs):
         # make sure CourseOfferings always have .course filled.
         if not self.course_id:
             self.set_course(save=False)
+
+        menu_changed = False
+        if not self._state.adding and not kwargs.get('force_insert'):
+            menu_changed = self._menu_changed()
+            if kwargs.get('update_fields') is None:
+                # the counters are kept by update_content_counts: don't overwrite them with whatever we loaded
+                deferred = self.get_deferred_fields()
+                kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                           if not f.primary_key and f.name not in self.COUNTER_FIELDS
+                                           and f.attname not in deferred]
         super(CourseOffering, self).save(*args, **kwargs)
+        if menu_changed:
+            Member.clear_menu_cache(offering=self)
+
+    def _menu_changed(self):
+        """
+        Have any fields that affect Member.get_memberships changed?
+        """
+        dirty = self.get_dirty_fields(check_relationship=True)
+        if any(f in dirty for f in ['graded', 'component', 'semester']):
+            return True
+        return 'config' in dirty and dirty['config'].get('no_menu') != self.config.get('no_menu')
+
+    @classmethod
+    def update_content_counts(cls, offering_id):
+        """
+        Recount the offering's activity_count and page_count: call after any change to its activities or pages.
+        """
+        from grades.models import Activity
+        from pages.models import Page
+        counts = {
+            'activity_count': Activity.objects.filter(offering_id=offering_id, deleted=False).exclude(status='INVI').count(),
+            'page_count': Page.objects.filter(offering_id=offering_id).count(),
+        }
+        old = CourseOffering.objects.filter(id=offering_id).values(*cls.COUNTER_FIELDS).first()
+        if old is None or old == counts:
+            return
+        CourseOffering.objects.filter(id=offering_id).update(**counts)
+        if (old['activity_count'] or old['page_count']) != (counts['activity_count'] or counts['page_count']):
+            # students see the offering in their menu iff there's something in it
+            Member.clear_menu_cache(offering=offering_id)
     
     def get_absolute_url(self):
         return reverse('offering:course_info', kwargs={'course_slug': self.slug})
@@ -1325,27 +1498,61 @@ class Member(models.Model, ConditionalSaveMixin):
     def bu(self):
         return decimal.Decimal(str(self.raw_bu()))
 
+    MENU_CACHE_TIMEOUT = 3600*6
+
+    @staticmethod
+    def _menu_cache_key(userid, today=None):
+        # the menu depends on the date too: a new key each day
+        today = today or datetime.date.today()
+        return 'memberships-%s-%s' % (userid, today.isoformat())
+
+    @staticmethod
+    def clear_menu_cache(userids=(), offering=None):
+        """
+        Forget the cached get_memberships results for these userids, and/or for the members of this offering (or
+        offering.id).
+        """
+        userids = set(userids)
+        if offering is not None:
+            offering_id = getattr(offering, 'id', offering)
+            userids.update(Member.objects.filter(offering_id=offering_id).values_list('person__userid', flat=True))
+        userids.discard(None)
+        if userids:
+            keys = [Member._menu_cache_key(u) for u in userids]
+            cache.delete_many(keys)
+            # again when committed, in case another request cached the old memberships in the meantime
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
     @staticmethod
     def get_memberships(userid):
         """
         Get course memberships for this userid that we want to display on their menu. return list of Member objects and
         a boolean indicating whether or not there were temporal exclusions (so the "course history" link is relevant).
+
+        Cached until the user's memberships (or the offerings' menu-relevant fields) change.
         """
+        key = Member._menu_cache_key(userid)
+        res = cache.get(key)
+        if res is None:
+            res = Member._get_memberships(userid)
+            cache.set(key, res, Member.MENU_CACHE_TIMEOUT)
+        return res
+
+    @staticmethod
+    def _get_memberships(userid):
         today = datetime.date.today()
         past1 = today - datetime.timedelta(days=365) # 1 year ago
         past2 = today - datetime.timedelta(days=730) # 2 years ago
         memberships = Member.objects.exclude(role="DROP").exclude(offering__component="CAN") \
                 .filter(offering__graded=True, person__userid=userid) \
                 .order_by('-offering__semester', 'offering') \
-                .annotate(num_activities=Count('offering__activity')) \
-                .annotate(num_pages=Count('offering__page')) \
                 .select_related('offering','offering__semester')
         memberships = list(memberships) # get out of the database and do this locally
 
         # students don't see non-active courses or future courses
         memberships = [m for m in memberships if
                         m.role in ['TA', 'INST', 'APPR']
-                        or ((m.num_activities > 0 or m.num_pages > 0)
+                        or ((m.offering.activity_count > 0 or m.offering.page_count > 0)
                             and m.offering.semester.start <= today)]
 
         count1 = len(memberships)
@@ -1482,6 +1689,21 @@ class Member(models.Model, ConditionalSaveMixin):
         old_grades.update(official_grade=None)
 
 
+def _member_saved(sender, instance, raw=False, **kwargs):
+    """
+    A membership has changed: its person's menu may be different now.
+    """
+    if raw:
+        return
+    if Member.person.is_cached(instance):
+        userid = instance.person.userid
+    else:
+        userid = Person.objects.filter(id=instance.person_id).values_list('userid', flat=True).first()
+    Member.clear_menu_cache([userid])
+
+models.signals.post_save.connect(_member_saved, sender=Member)
+
+
 WEEKDAY_CHOICES = (
         (0, 'Monday'),
         (1, 'Tuesday'),
@@ -1596,64 +1818,122 @@ class Unit(models.Model):
         return self.slug in ['cmpt', 'ensc']
     
     @classmethod
-    #@cached(24*3600)
-    def __sub_unit_ids(cls, unitids):
-        """
-        Do the actual work for sub_unit_ids
-        """
-        children = unitids
-        decendants = set(children)
-        while True:
-            children = Unit.objects.filter(parent__in=children).values('id')
-            children = set(u['id'] for u in children)
-            if not children:
-                break
-            decendants |= children
-        return decendants
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # so we can tell if the hierarchy changed when it's saved
+        instance._loaded_parent_id = instance.__dict__.get('parent_id')
+        return instance
 
     @classmethod
     def sub_unit_ids(cls, units, by_id=False):
         """
         Get the Unit.id values for all descendants of the given list of unit.id values.
 
-        Cached so we can avoid the work when possible.
+        One query, against the UnitClosure table.
         """
-        # sort unit.id values for consistent cache keys
         if by_id:
-            unitids = sorted(list(set(units)))
+            unitids = set(units)
         else:
-            unitids = sorted(list(set(u.id for u in units)))
-        return Unit.__sub_unit_ids(unitids)
+            unitids = set(u.id for u in units)
+        return set(UnitClosure.objects.filter(ancestor_id__in=unitids).values_list('descendant_id', flat=True))
 
     @classmethod
     def sub_units(cls, units, by_id=False):
-        ids = cls.sub_unit_ids(units, by_id=by_id)
-        return Unit.objects.filter(id__in=ids)
-
-    def __super_units(self):
-        if not self.parent:
-            return []
+        if by_id:
+            unitids = set(units)
         else:
-            return [self.parent] + self.parent.super_units()
-            
+            unitids = set(u.id for u in units)
+        # a subquery, so using this in another filter is still one query
+        return Unit.objects.filter(id__in=UnitClosure.objects.filter(ancestor_id__in=unitids).values('descendant_id'))
+
     def super_units(self, include_self=False):
         """
         Units directly above this in the heirarchy
         """
-        key = 'superunits-' + self.slug
-        res = cache.get(key)
-        if res:
-            if include_self:
-                return res + [self]
-            else:
-                return res
+        res = list(Unit.objects.filter(descendant_links__descendant=self, descendant_links__depth__gt=0)
+                   .order_by('descendant_links__depth'))
+        if include_self:
+            return res + [self]
         else:
-            res = self.__super_units()
-            cache.set(key, res, 24*3600)
-            if include_self:
-                return res + [self]
-            else:
-                return res
+            return res
+
+
+class UnitClosure(models.Model):
+    """
+    Every (ancestor, descendant) pair in the Unit hierarchy, including each unit as its own ancestor at depth 0, so
+    "all units under X" and "all units above X" are single indexed lookups.
+
+    Rebuilt (in the same transaction) whenever a Unit is created or its parent changes. Changes that bypass
+    Unit.save (like QuerySet.update) need a UnitClosure.rebuild(): check_unit_closure will find them.
+    """
+    ancestor = models.ForeignKey(Unit, null=False, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Unit, null=False, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField(help_text='Steps from ancestor down to descendant')
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+        index_together = (('descendant', 'depth'),)
+
+    def __str__(self):
+        return '%s > %s (%i)' % (self.ancestor_id, self.descendant_id, self.depth)
+
+    @staticmethod
+    def closure_pairs(parents):
+        """
+        The (ancestor_id, descendant_id, depth) triples for the hierarchy described by parents, a dict of
+        unit.id -> unit.parent_id. Also returns the unit ids found to be in a parent cycle (whose chains are cut off
+        where they repeat).
+        """
+        pairs = set()
+        cycles = set()
+        for unit_id in parents:
+            seen = {unit_id}
+            pairs.add((unit_id, unit_id, 0))
+            ancestor_id = parents[unit_id]
+            depth = 1
+            while ancestor_id is not None:
+                if ancestor_id in seen:
+                    cycles.add(unit_id)
+                    break
+                seen.add(ancestor_id)
+                pairs.add((ancestor_id, unit_id, depth))
+                ancestor_id = parents.get(ancestor_id)
+                depth += 1
+        return pairs, cycles
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Replace the whole table with the pairs from the current Unit hierarchy.
+        """
+        with transaction.atomic():
+            # lock the units, so concurrent rebuilds see each other's changes
+            parents = dict(Unit.objects.select_for_update().order_by().values_list('id', 'parent_id'))
+            pairs, _ = cls.closure_pairs(parents)
+            cls.objects.all().delete()
+            cls.objects.bulk_create([cls(ancestor_id=a, descendant_id=d, depth=n) for a, d, n in pairs],
+                                    batch_size=1000)
+
+    @classmethod
+    def problems(cls):
+        """
+        Check the table against the Unit hierarchy: returns a list of descriptions of anything wrong.
+        """
+        parents = dict(Unit.objects.order_by().values_list('id', 'parent_id'))
+        expected, cycles = cls.closure_pairs(parents)
+        stored = set(cls.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        problems = ['unit %i is in a cycle of parents' % (u,) for u in sorted(cycles)]
+        problems.extend('missing %i > %i (depth %i)' % p for p in sorted(expected - stored))
+        problems.extend('unexpected %i > %i (depth %i)' % p for p in sorted(stored - expected))
+        return problems
+
+
+def _unit_saved(sender, instance, created=False, raw=False, **kwargs):
+    if created or raw or instance.parent_id != getattr(instance, '_loaded_parent_id', None):
+        UnitClosure.rebuild()
+    instance._loaded_parent_id = instance.parent_id
+
+models.signals.post_save.connect(_unit_saved, sender=Unit)
 
 
 class Role(models.Model):
@@ -1912,29 +2192,54 @@ class EnrolmentHistory(models.Model):
         assert self.date < other.date
         return self.enrl_vals == other.enrl_vals
 
+    DEDUPLICATE_DELETE_CHUNK = 1000
+
     @classmethod
-    def deduplicate(cls, start_date=None, end_date=None, dry_run=False):
+    def deduplicate(cls, start_date=None, end_date=None, dry_run=False, compact=False,
+                    chunk_size=DEDUPLICATE_DELETE_CHUNK):
         """
-        Remove any EnrolmentHistory objects that aren't adding any new information.
+        Remove any EnrolmentHistory objects that aren't adding any new information: each offering's rows are scanned
+        (in one ordered query) and every row is compared with the previous row kept for that offering, so all but the
+        first of each run of identical snapshots are deleted, in bulk statements of chunk_size rows.
+
+        Normally the first row in the date range is kept, as the state at the start of the range. With compact=True,
+        the offering's last snapshot before the range is the first row kept, so what's left in the range is only the
+        changes.
+
+        Returns a dict of rows scanned, rows removed, and elapsed seconds.
         """
-        all_ehs = EnrolmentHistory.objects.order_by('offering', 'date')
-        if start_date:
-            all_ehs = all_ehs.filter(date__gte=start_date)
+        start = time.monotonic()
+        all_ehs = EnrolmentHistory.objects.order_by('offering_id', 'date')
         if end_date:
             all_ehs = all_ehs.filter(date__lte=end_date)
+        if start_date and compact:
+            # the range, plus each offering's last row before it
+            last_before = EnrolmentHistory.objects.filter(offering_id=OuterRef('offering_id'), date__lt=start_date) \
+                .order_by('-date').values('date')[:1]
+            previous = EnrolmentHistory.objects.filter(date__lt=start_date, date=Subquery(last_before))
+            all_ehs = all_ehs.filter(Q(date__gte=start_date) | Q(id__in=previous.values('id')))
+        elif start_date:
+            all_ehs = all_ehs.filter(date__gte=start_date)
 
-        for off_id, ehs in itertools.groupby(all_ehs, key=lambda eh: eh.offering_id):
-            # iterate through EnrolmentHistory for this offering and purge any "same as yesterday" entries
-            with transaction.atomic():
-                current = next(ehs)
-                for eh in ehs:
-                    if current.is_dup(eh):
-                        if not dry_run:
-                            eh.delete()
-                        else:
-                            print('delete', eh)
-                    else:
-                        current = eh
+        scanned = 0
+        dup_ids = []
+        kept_offering = kept_vals = None # the previous row kept
+        for eh_id, offering_id, d, *vals in all_ehs.values_list('id', 'offering_id', 'date', 'enrl_cap', 'enrl_tot',
+                                                                'wait_tot').iterator():
+            scanned += 1
+            if offering_id == kept_offering and vals == kept_vals and not (start_date and d < start_date):
+                dup_ids.append(eh_id)
+                if dry_run:
+                    print('delete', offering_id, d, tuple(vals))
+            else:
+                kept_offering, kept_vals = offering_id, vals
+
+        if not dry_run:
+            for i in range(0, len(dup_ids), chunk_size):
+                # nothing cascades from or listens for these deletes, so Django deletes each chunk in one query
+                EnrolmentHistory.objects.filter(id__in=dup_ids[i:i+chunk_size]).delete()
+
+        return {'scanned': scanned, 'removed': len(dup_ids), 'seconds': round(time.monotonic() - start, 3)}
 
     def save_or_replace(self):
         """
@@ -1949,3 +2254,62 @@ class EnrolmentHistory(models.Model):
             other.enrl_tot = self.enrl_tot
             other.wait_tot = self.wait_tot
             other.save()
+
+
+class OfferingImport(models.Model):
+    """
+    One run of the offering import (coredata.tasks.import_offerings), so its progress can be followed.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    lanes = models.PositiveSmallIntegerField(default=0) # chains of groups imported in parallel
+    lanes_finished = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return 'offering import %s' % (self.created_at,)
+
+    def progress(self):
+        """
+        Count of the run's groups in each status.
+        """
+        counts = dict((s, 0) for s, _ in OfferingImportGroup.STATUS_CHOICES)
+        counts.update(self.offeringimportgroup_set.order_by().values_list('status').annotate(n=Count('id')))
+        return counts
+
+    def percent_done(self):
+        counts = self.progress()
+        total = sum(counts.values())
+        if not total:
+            return 100
+        return int(100 * (counts['DONE'] + counts['FAIL']) / total)
+
+
+class OfferingImportGroup(models.Model):
+    """
+    A group of offerings imported together, in one task, as part of an OfferingImport.
+    """
+    STATUS_CHOICES = [
+        ('WAIT', 'Waiting'),
+        ('RUN', 'Running'),
+        ('RETR', 'Failed: will retry'),
+        ('DONE', 'Done'),
+        ('FAIL', 'Failed'),
+    ]
+    run = models.ForeignKey(OfferingImport, null=False, on_delete=models.CASCADE)
+    unit = models.ForeignKey(Unit, null=True, on_delete=models.SET_NULL)
+    slugs = JSONField(null=False, blank=False, default=list) # offerings in the group
+    weight = models.PositiveIntegerField(default=0) # estimate of the work: see coredata.importer.offering_weight
+    status = models.CharField(max_length=4, choices=STATUS_CHOICES, default='WAIT')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    duration = models.DurationField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return '%s: %i offerings, %s' % (self.unit, len(self.slugs), self.status)
@@ -14,7 +14,7 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.utils.html import conditional_escape as escape
 
-from coredata.models import Semester, Unit
+from coredata.models import Semester, Unit, UnitClosure
 from coredata.queries import SIMSConn, SIMSProblem, userid_to_emplid, csrpt_update
 from dashboard.photos import do_photo_fetch
 from log.models import LogEntry
@@ -104,6 +104,17 @@ def deploy_checks(request=None):
     except django.db.utils.ProgrammingError:
         failed.append(('Main database connection', "database tables missing"))
 
+    # Unit hierarchy closure table matches the hierarchy
+    try:
+        problems = UnitClosure.problems()
+        if problems:
+            failed.append(('Unit hierarchy', '%i problems with UnitClosure: run "manage.py check_unit_closure --fix"'
+                           % (len(problems),)))
+        else:
+            passed.append(('Unit hierarchy', 'okay'))
+    except (django.db.utils.OperationalError, django.db.utils.ProgrammingError):
+        failed.append(('Unit hierarchy', "can't read UnitClosure table"))
+
     # non-BMP Unicode in database
     try:
         l = LogEntry.objects.create(userid='ggbaker', description='Test Unicode \U0001F600', related_object=Semester.objects.first())
@@ -631,6 +642,48 @@ def pip_info():
     result = '<pre>' + escape(output) + '</pre>'
     return [('PIP freeze', mark_safe(result))]
 
+def archive_cache_info():
+    from submission.archive_cache import archive_cache_stats, cached_archives
+    stats = archive_cache_stats()
+    requests = sum(stats.values())
+    archives = cached_archives()
+    used = sum(size for _, size, _ in archives)
+
+    info = []
+    info.append(('Cache directory', settings.ARCHIVE_CACHE_PATH))
+    info.append(('Served from cache', stats['hit']))
+    info.append(('Built by appending new files', stats['append']))
+    info.append(('Completely rebuilt', stats['rebuild']))
+    if requests:
+        info.append(('Hit rate', '%.1f%%' % (100.0 * stats['hit'] / requests)))
+    info.append(('Cached archives', len(archives)))
+    info.append(('Disk used', '%.1f of %.1f MB' % (used / 1024.0 / 1024.0,
+                                                   settings.ARCHIVE_CACHE_MAX_SIZE / 1024.0 / 1024.0)))
+    return info
+
+def sims_cache_info():
+    from coredata.queries import sims_result_cache, sims_query_stats
+    stats = sims_result_cache.totals()
+    hits = stats['local_hit'] + stats['hit'] + stats['negative_hit'] + stats['stale']
+    lookups = hits + stats['miss']
+    misses = stats['miss'] + stats['refresh']
+
+    info = []
+    info.append(('Hits in process memory', stats['local_hit']))
+    info.append(('Hits in shared cache', stats['hit']))
+    info.append(('Hits on cached empty results', stats['negative_hit']))
+    info.append(('Stale hits (refreshed in background)', stats['stale']))
+    info.append(('Misses', stats['miss']))
+    info.append(('Misses sharing another query\'s result', stats['shared']))
+    if lookups:
+        info.append(('Hit rate', '%.1f%%' % (100.0 * hits / lookups)))
+    if lookups - stats['local_hit']:
+        info.append(('Average shared cache lookup', '%.1f ms' % (stats['lookup_ms'] / (lookups - stats['local_hit']))))
+    if misses:
+        info.append(('Average SIMS query on miss', '%.1f ms' % (stats['sims_ms'] / misses)))
+    info.append(('SIMS queries (this process)', sims_query_stats['queries']))
+    return info
+
 def csrpt_info():
     try:
         return csrpt_update()
@@ -1,50 +1,222 @@
 from coredata.models import Person, Semester, SemesterWeek, CourseOffering
 from django.conf import settings
 from django.core.mail import mail_admins
+from django.core.signals import request_finished
 import django.db.transaction
 from django.core.cache import cache
 from django.utils.html import conditional_escape as e
 import re, hashlib, datetime, string, urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse, http.client, time, json
-import socket, decimal
+import socket, decimal, threading, collections, logging, pickle
 
+logger = logging.getLogger(__name__)
 
 multiple_breaks = re.compile(r'\n\n+')
 
 
+class SIMSProblem(Exception):
+    """
+    Class used to pass back problems with the SIMS connection.
+    """
+    pass
+
+
+_thread_conns = threading.local()
+_placeholder_re = re.compile(r'(%s|%%)')
+_sql_left_re = re.compile(r'\bLEFT\(([^,()]+),\s*(\d+)\)')
+sims_query_stats = collections.Counter() # running totals of SIMS queries: 'queries', 'seconds', 'connects', 'retries'
+_stats_lock = threading.Lock()
+
+
+def _count_query(**counts):
+    with _stats_lock:
+        sims_query_stats.update(counts)
+
+
+class ConnectionPool(object):
+    """
+    Idle connections to one SIMS backend, shared by the threads in the process.
+
+    Connections that have been idle for more than SIMS_HEALTH_CHECK_AGE seconds are checked with the backend's
+    health_query before they're handed out again. New connections are retried SIMS_CONNECT_RETRIES times, with
+    exponential backoff.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.idle = [] # (connection, time it was released)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if settings.DISABLE_REPORTING_DB and self.backend.uses_reporting_db:
+            raise SIMSProblem("Reporting database access has been disabled in this deployment.")
+
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, released = self.idle.pop()
+            if time.monotonic() - released < settings.SIMS_HEALTH_CHECK_AGE or self.healthy(conn):
+                return conn
+            self.discard(conn)
+
+        for attempt in range(settings.SIMS_CONNECT_RETRIES + 1):
+            try:
+                conn = self.backend.get_connection()
+                _count_query(connects=1)
+                return conn
+            except SIMSProblem:
+                if attempt == settings.SIMS_CONNECT_RETRIES:
+                    raise
+                logger.warning('Could not connect to SIMS (attempt %i): retrying', attempt + 1)
+                time.sleep(settings.SIMS_RETRY_DELAY * 2**attempt)
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < settings.SIMS_POOL_SIZE:
+                self.idle.append((conn, time.monotonic()))
+                return
+        self.discard(conn)
+
+    def healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.backend.health_query)
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 class DBConn(object):
     """
-    Singleton object representing DB connection. Implements a big enough subset of PEP 249 for me.
-    
-    singleton pattern implementation from: http://stackoverflow.com/questions/42558/python-and-the-singleton-pattern
-    
-    Absolutely NOT thread safe.
-    Implemented as a singleton to minimize number of times DB connection overhead occurs.
+    The calling thread's connection to a SIMS database, checked out of the backend's ConnectionPool. Implements a
+    big enough subset of PEP 249 for me.
+
+    There is one instance per backend per thread, so it's safe to use from threads (like a threaded Celery worker),
+    but not to interleave two queries in one thread. Queries are written with %s placeholders (and %% for a literal
+    %): the arguments are bound as query parameters, with lists/tuples/sets expanded for "IN" clauses. Queries that
+    fail because the connection has died are retried (once) on a new connection: they're all reads, so that's safe.
+
     Should only be created on-demand (in function) to minimize startup for other processes.
     """
-    _instance = None
-    def __new__(cls):
-        if not cls._instance:
-            cls._instance = super(DBConn, cls).__new__(cls)
-        return cls._instance
+    uses_reporting_db = True # honour settings.DISABLE_REPORTING_DB?
+    max_bound_list = 1000 # longer "IN" lists are escaped into the query, to stay under parameter limits
+    health_query = 'SELECT 1'
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __new__(cls, verbose=False):
+        inst = getattr(_thread_conns, cls.__name__, None)
+        if inst is None:
+            inst = super(DBConn, cls).__new__(cls)
+            inst.conn = inst.db = None
+            setattr(_thread_conns, cls.__name__, inst)
+        return inst
 
     def __init__(self, verbose=False):
-        self.conn, self.db = self.get_connection()
         self.verbose = verbose
+        if self.conn is None:
+            self.conn = self.pool().acquire()
+            self.db = self.conn.cursor()
+
+    @classmethod
+    def pool(cls):
+        with cls._pools_lock:
+            if cls not in cls._pools:
+                cls._pools[cls] = ConnectionPool(cls)
+            return cls._pools[cls]
+
+    def release(self):
+        """
+        Return this thread's connection to the pool (e.g. when a worker thread is finished with it).
+        """
+        if self.conn is not None:
+            self.pool().release(self.conn)
+            self.conn = self.db = None
 
     def get_connection(self):
         raise NotImplementedError
+
+    @classmethod
+    def connection_errors(cls):
+        """
+        Exception classes that mean the connection is unusable (and a query can be retried on a new one).
+        """
+        return ()
+
+    @classmethod
+    def database_errors(cls):
+        """
+        Exception classes that should be reported as a SIMSProblem by SIMS_problem_handler.
+        """
+        return ()
+
     def escape_arg(self, a):
         raise NotImplementedError
 
+    def bind_value(self, v):
+        "Transform an argument into a value the DB driver can bind."
+        return v
+
+    def bind(self, query, args):
+        """
+        Convert a query with %s placeholders into one with ? placeholders, and the list of values to bind to them.
+        """
+        args = iter(args)
+        sql = []
+        params = []
+        for part in _placeholder_re.split(query):
+            if part == '%s':
+                a = next(args)
+                if type(a) in (tuple, list, set) and len(a) > self.max_bound_list:
+                    sql.append(self.escape_arg(a))
+                elif type(a) in (tuple, list, set):
+                    a = list(a)
+                    sql.append('(' + ', '.join('?' * len(a)) + ')')
+                    params.extend(self.bind_value(v) for v in a)
+                else:
+                    sql.append('?')
+                    params.append(self.bind_value(a))
+            elif part == '%%':
+                sql.append('%')
+            else:
+                sql.append(part)
+        return self.translate(''.join(sql)), params
+
+    def translate(self, query):
+        "Adjust the SQL for this backend's dialect."
+        return query
+
     def execute(self, query, args):
-        "Execute a query, safely substituting arguments"
-        # should be ensuring real/active connection here?
-        clean_args = tuple((self.escape_arg(a) for a in args))
-        real_query = query % clean_args
+        "Execute a query, safely binding arguments"
+        real_query, params = self.bind(query, args)
         if self.verbose:
-            print(">>>", real_query)
+            print(">>>", real_query, params)
         self.query = real_query
-        return self.db.execute(real_query)
+
+        start = time.perf_counter()
+        try:
+            res = self.db.execute(real_query, params)
+        except self.connection_errors():
+            # connection has gone away: try once more with a fresh one
+            _count_query(retries=1)
+            self.pool().discard(self.conn)
+            self.conn = self.pool().acquire()
+            self.db = self.conn.cursor()
+            res = self.db.execute(real_query, params)
+
+        elapsed = time.perf_counter() - start
+        _count_query(queries=1, seconds=elapsed)
+        if elapsed > settings.SIMS_SLOW_QUERY:
+            logger.warning('Slow SIMS query (%.1f s): %s', elapsed, real_query)
+        else:
+            logger.debug('SIMS query (%.3f s): %s', elapsed, real_query)
+        return res
 
     def prep_value(self, v):
         "Transform a DB result value into the value we want."
@@ -69,18 +241,25 @@ class DBConn(object):
 
 
 class SIMSConnMSSQL(DBConn):
-    def get_connection(self):
-        if settings.DISABLE_REPORTING_DB:
-            raise SIMSProblem("Reporting database access has been disabled in this deployment.")
-
+    @classmethod
+    def get_connection(cls):
         import pyodbc
         try:
             dbconn = pyodbc.connect("DRIVER={FreeTDS};SERVER=%s;PORT=1433;DATABASE=%s;Trusted_Connection=Yes"
                                     % (settings.SIMS_DB_SERVER, settings.SIMS_DB_NAME))
         except (pyodbc.ProgrammingError, pyodbc.OperationalError):
             raise SIMSProblem("Unable to connect to reporting database.")
-        cursor = dbconn.cursor()
-        return dbconn, cursor
+        return dbconn
+
+    @classmethod
+    def connection_errors(cls):
+        import pyodbc
+        return (pyodbc.OperationalError,)
+
+    @classmethod
+    def database_errors(cls):
+        import pyodbc
+        return (pyodbc.ProgrammingError,)
 
     # adapted from _quote_simple_value from _mssql.pyx https://github.com/pymssql/pymssql/blob/master/src/pymssql/_mssql.pyx#L1930-L1933
     def escape_arg(self, value, charset='utf8'):
@@ -150,29 +329,31 @@ class SIMSConnMSSQL(DBConn):
 
 
 class SIMSConnDB2(DBConn):
-    """
-    Singleton object representing SIMS DB connection
-    """
-    DatabaseError = ReferenceError # placeholder until we have the DB2 module
-    DB2Error = ReferenceError
-
-    def get_connection(self):
-        if settings.DISABLE_REPORTING_DB:
-            raise SIMSProblem("Reporting database access has been disabled in this deployment.")
+    health_query = 'SELECT 1 FROM SYSIBM.SYSDUMMY1'
 
+    @classmethod
+    def get_connection(cls):
         try:
             import ibm_db_dbi
         except ImportError:
             raise SIMSProblem("could not import DB2 module")
-        SIMSConnDB2.DatabaseError = ibm_db_dbi.DatabaseError
-        SIMSConnDB2.DB2Error = ibm_db_dbi.Error
         try:
-            dbconn = ibm_db_dbi.connect(self.sims_db, self.sims_user, self.sims_passwd)
+            dbconn = ibm_db_dbi.connect(settings.SIMS_DB_NAME, settings.SIMS_USER, settings.SIMS_PASSWORD)
         except ibm_db_dbi.Error:
-            raise #SIMSProblem("Could not communicate with reporting database.")
+            raise SIMSProblem("Could not communicate with reporting database.")
         cursor = dbconn.cursor()
-        cursor.execute("SET SCHEMA "+self.schema)
-        return dbconn, cursor
+        cursor.execute("SET SCHEMA "+settings.SIMS_DB_SCHEMA)
+        return dbconn
+
+    @classmethod
+    def connection_errors(cls):
+        import ibm_db_dbi
+        return (ibm_db_dbi.OperationalError,)
+
+    @classmethod
+    def database_errors(cls):
+        import ibm_db_dbi
+        return (ibm_db_dbi.Error,)
 
     def escape_arg(self, a):
         """
@@ -207,35 +388,85 @@ class SIMSConnDB2(DBConn):
             return v
 
 
-class SIMSProblem(Exception):
+class SIMSConnSQLite(DBConn):
     """
-    Class used to pass back problems with the SIMS connection.
+    Local stand-in for the reporting database: an SQLite database (settings.SIMS_STANDIN_DB) with the SIMS tables
+    the importer uses, as created by coredata.sims_standin. Lets the importer be tested and benchmarked offline.
     """
-    pass
+    uses_reporting_db = False
 
+    @classmethod
+    def get_connection(cls):
+        import sqlite3
+        try:
+            dbconn = sqlite3.connect(settings.SIMS_STANDIN_DB, uri=True, check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        except sqlite3.Error:
+            raise SIMSProblem("Unable to open stand-in reporting database.")
+        # the SQL Server functions our queries use
+        dbconn.create_function('GETDATE', 0, lambda: datetime.datetime.now().isoformat(' '))
+        return dbconn
+
+    def translate(self, query):
+        # LEFT is a keyword in SQLite, so LEFT(...) can't be a function
+        return _sql_left_re.sub(r'SUBSTR(\1, 1, \2)', query)
+
+    @classmethod
+    def database_errors(cls):
+        import sqlite3
+        return (sqlite3.Error,)
 
-def SIMS_problem_handler_MSSQL(func):
-    """
-    Decorator to deal somewhat gracefully with any SIMS database problems.
-    Any decorated function may raise a SIMSProblem instance to indicate a
-    problem with the database connection.
+    def escape_arg(self, a):
+        if type(a) in (tuple, list, set):
+            return '(' + ', '.join((self.escape_arg(v) for v in a)) + ')'
+        if a is None:
+            return 'NULL'
+        if isinstance(a, (bool, int, float, decimal.Decimal)):
+            return str(int(a) if isinstance(a, bool) else a)
+        return "'" + str(a).replace("'", "''") + "'"
+
+    def bind_value(self, v):
+        if isinstance(v, decimal.Decimal):
+            return float(v)
+        return v
 
-    Should be applied to any functions that use a SIMSConn object.
+    def prep_value(self, v):
+        if isinstance(v, str):
+            return v.strip()
+        return v
+
+
+SIMS_BACKENDS = {
+    'mssql': SIMSConnMSSQL,
+    'db2': SIMSConnDB2,
+    'sqlite': SIMSConnSQLite,
+}
+
+
+def release_sims_connections(**kwargs):
+    """
+    Return all of the calling thread's SIMS connections to their pools: call when a task, request or thread is done
+    with them. (Also a request_finished receiver.)
     """
+    for conn in list(vars(_thread_conns).values()):
+        conn.release()
 
-    def wrapped(*args, **kwargs):
-        import pyodbc
-        # check for the types of errors we know might happen and return an error message in a SIMSProblem
-        try:
-            return func(*args, **kwargs)
-        except pyodbc.ProgrammingError as e:
-            raise SIMSProblem("reporting database error: " + str(e))
+request_finished.connect(release_sims_connections)
 
-    wrapped.__name__ = func.__name__
-    return wrapped
 
+class SIMSConn(object):
+    """
+    The calling thread's connection to the reporting database, with the backend selected by settings.SIMS_BACKEND.
+    """
+    def __new__(cls, verbose=False):
+        return SIMS_BACKENDS[settings.SIMS_BACKEND](verbose=verbose)
+
+    @staticmethod
+    def backend():
+        return SIMS_BACKENDS[settings.SIMS_BACKEND]
 
-def SIMS_problem_handler_DB2(func):
+
+def SIMS_problem_handler(func):
     """
     Decorator to deal somewhat gracefully with any SIMS database problems.
     Any decorated function may raise a SIMSProblem instance to indicate a
@@ -247,19 +478,17 @@ def SIMS_problem_handler_DB2(func):
         # check for the types of errors we know might happen and return an error message in a SIMSProblem
         try:
             return func(*args, **kwargs)
-        except SIMSConn.DatabaseError as e:
-            raise SIMSProblem("could not connect to reporting database")
-        except SIMSConn.DB2Error as e:
-            raise SIMSProblem("problem with connection to reporting database")
+        except SIMSProblem:
+            raise
+        except Exception as e:
+            if isinstance(e, SIMSConn.backend().database_errors()):
+                raise SIMSProblem("reporting database error: " + str(e))
+            raise
 
     wrapped.__name__ = func.__name__
     return wrapped
 
 
-SIMSConn = SIMSConnMSSQL
-SIMS_problem_handler = SIMS_problem_handler_MSSQL
-
-
 def _args_to_key(args, kwargs):
     "Hash arguments to get a cache key"
     h = hashlib.new('md5')
@@ -268,26 +497,204 @@ def _args_to_key(args, kwargs):
     return h.hexdigest()
 
 
+SIMS_CACHE_STATS = ['local_hit', 'hit', 'negative_hit', 'stale', 'miss', 'shared', 'refresh', 'lookup_ms', 'sims_ms']
+
+
+class _Flight(object):
+    "A SIMS call in progress, that other threads missing the same key can wait for."
+    def __init__(self):
+        self.done = threading.Event()
+        self.pickled = None # the result, pickled so each waiting thread gets its own copy
+        self.error = None
+
+
+class SIMSResultCache(object):
+    """
+    The cache behind cache_by_args: a small in-process LRU (of pickled results, so callers can't modify each other's)
+    in front of the Django cache (memcached).
+
+    Concurrent misses on a key share one SIMS call: threads in this process wait for the first, and other processes
+    wait (up to SIMS_CACHE_LOCK_WAIT seconds) on a lock key in memcached. Empty results are cached for only
+    SIMS_NEGATIVE_CACHE_SECONDS. Results are kept SIMS_CACHE_STALE_SECONDS past their expiry: a stale result is
+    returned immediately while a background thread fetches a fresh one.
+
+    Hit/miss/latency counts are kept per process and added to totals in the Django cache every few seconds.
+    """
+    def __init__(self):
+        self.local = collections.OrderedDict() # key -> (pickled value, local expiry time)
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = collections.Counter()
+        self.last_flush = time.monotonic()
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+            if time.monotonic() - self.last_flush < settings.SIMS_CACHE_STATS_FLUSH:
+                return
+            stats = self.stats
+            self.stats = collections.Counter()
+            self.last_flush = time.monotonic()
+        for stat, n in stats.items():
+            key = 'simscache-stat-' + stat
+            cache.add(key, 0, None)
+            try:
+                cache.incr(key, n)
+            except ValueError:
+                # expired between the add and incr
+                pass
+
+    def totals(self):
+        "Counts from all processes (as last flushed), plus this one's unflushed counts."
+        values = cache.get_many(['simscache-stat-' + s for s in SIMS_CACHE_STATS])
+        with self.lock:
+            return dict((s, values.get('simscache-stat-' + s, 0) + self.stats[s]) for s in SIMS_CACHE_STATS)
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+
+    def _local_get(self, key, now):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self.local[key]
+                return None
+            self.local.move_to_end(key)
+            return entry[0]
+
+    def _local_set(self, key, value, fresh_until, now):
+        expires = min(now + settings.SIMS_CACHE_LOCAL_SECONDS, fresh_until)
+        with self.lock:
+            self.local[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+            self.local.move_to_end(key)
+            while len(self.local) > settings.SIMS_CACHE_LOCAL_SIZE:
+                self.local.popitem(last=False)
+
+    def get(self, key, compute, seconds):
+        now = time.time()
+        pickled = self._local_get(key, now)
+        if pickled is not None:
+            self.count(local_hit=1)
+            return pickle.loads(pickled)
+
+        start = time.perf_counter()
+        entry = cache.get(key)
+        self.count(lookup_ms=int(1000 * (time.perf_counter() - start)))
+        if entry is not None:
+            value, fresh_until = entry
+            if fresh_until > now:
+                self._local_set(key, value, fresh_until, now)
+                self.count(**{'hit' if value else 'negative_hit': 1})
+            else:
+                self.count(stale=1)
+                self.revalidate(key, compute, seconds)
+            return value
+
+        self.count(miss=1)
+        return self.fill(key, compute, seconds)
+
+    def set(self, key, value, seconds):
+        now = time.time()
+        if not value:
+            seconds = min(seconds, settings.SIMS_NEGATIVE_CACHE_SECONDS)
+        fresh_until = now + seconds
+        cache.set(key, (value, fresh_until), seconds + settings.SIMS_CACHE_STALE_SECONDS)
+        self._local_set(key, value, fresh_until, now)
+
+    def fill(self, key, compute, seconds):
+        """
+        Compute the value for key and cache it, unless somebody else is already doing that: then wait for their result.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if not leader:
+            self.count(shared=1)
+            if flight.done.wait(settings.SIMS_CACHE_LOCK_WAIT):
+                if flight.error:
+                    raise flight.error
+                return pickle.loads(flight.pickled)
+            # taking too long: do it ourselves
+            return self._compute(key, compute, seconds)
+
+        try:
+            value = self._fill_once(key, compute, seconds)
+            flight.pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return value
+
+    def _fill_once(self, key, compute, seconds):
+        lock_key = key + '-lock'
+        if not cache.add(lock_key, 1, settings.SIMS_CACHE_LOCK_WAIT):
+            # another process is fetching it: give them a chance to finish
+            deadline = time.monotonic() + settings.SIMS_CACHE_LOCK_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None and entry[1] > time.time():
+                    self.count(shared=1)
+                    return entry[0]
+            return self._compute(key, compute, seconds)
+
+        try:
+            return self._compute(key, compute, seconds)
+        finally:
+            cache.delete(lock_key)
+
+    def _compute(self, key, compute, seconds):
+        start = time.perf_counter()
+        value = compute()
+        self.count(sims_ms=int(1000 * (time.perf_counter() - start)))
+        # got a result (with no exception thrown): cache it
+        self.set(key, value, seconds)
+        return value
+
+    def revalidate(self, key, compute, seconds):
+        """
+        Refresh a stale value in a background thread (unless that's already happening).
+        """
+        with self.lock:
+            if key in self.flights:
+                return
+        self.count(refresh=1)
+
+        def refresh():
+            try:
+                self.fill(key, compute, seconds)
+            except Exception:
+                logger.warning('Refreshing cached SIMS result failed', exc_info=True)
+            finally:
+                release_sims_connections()
+                django.db.connection.close()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+sims_result_cache = SIMSResultCache()
+
+
 def cache_by_args(func, seconds=38800): # 8 hours by default
     """
-    Decorator to cache query results from SIMS (if successful: no SIMSProblem).
+    Decorator to cache query results from SIMS (if successful: no SIMSProblem), in sims_result_cache.
     Requires arguments that can be converted to strings that uniquely identifies the results.
     Return results must be pickle-able so they can be cached.
     """
     def wrapped(*args, **kwargs):
-        key = "simscache-" + func.__name__ + "-" + _args_to_key(args, kwargs)
-        # first check cache
-        cacheres = cache.get(key)
-        if cacheres:
-            return cacheres
-        
-        # not in cache: calculate
-        res = func(*args, **kwargs)
+        key = "simscache2-" + func.__name__ + "-" + _args_to_key(args, kwargs)
+        return sims_result_cache.get(key, lambda: func(*args, **kwargs), seconds)
 
-        # got a result (with no exception thrown): cache it
-        cache.set(key, res, seconds)
-        return res
-    
     wrapped.__name__ = func.__name__
     return wrapped
 
@@ -420,6 +827,79 @@ def grad_student_info(emplid):
     return more_personal_info(emplid, needed=GRADFIELDS)
 
 
+SIMS_IN_CHUNK = 500 # emplids per "IN" list in the batched queries
+NAMES_QUERIES = 1 # SIMS queries done by get_names for one person...
+GRAD_INFO_QUERIES = 4 # ... and by grad_student_info
+
+
+def _emplid_chunks(emplids, chunk_size):
+    emplids = sorted(set(str(e) for e in emplids))
+    for start in range(0, len(emplids), chunk_size):
+        yield emplids[start:start+chunk_size]
+
+
+@SIMS_problem_handler
+def get_names_batch(emplids, chunk_size=SIMS_IN_CHUNK):
+    """
+    get_names for many people, with one query for each chunk_size of them.
+
+    Returns a dict of emplid -> (last_name, first_name, middle_name, pref_first_name, title) for the people found.
+    """
+    db = SIMSConn()
+    names = {}
+    for chunk in _emplid_chunks(emplids, chunk_size):
+        db.execute("SELECT EMPLID, NAME_TYPE, NAME_PREFIX, LAST_NAME, FIRST_NAME, MIDDLE_NAME FROM PS_NAMES WHERE "
+                   "EMPLID IN %s AND EFF_STATUS='A' AND NAME_TYPE IN ('PRI','PRF') "
+                   "ORDER BY EMPLID, EFFDT", (chunk,))
+        # same logic as get_names, applied to each person's rows in turn
+        for emplid, name_type, prefix, last, first, middle in db:
+            last_name, first_name, middle_name, pref_first_name, title = names.get(int(emplid), (None,)*5)
+            if name_type == 'PRI':
+                first_name = first
+            elif name_type == 'PRF':
+                pref_first_name = first
+            names[int(emplid)] = (last, first_name, middle, pref_first_name, prefix)
+
+    return names
+
+
+@SIMS_problem_handler
+def grad_student_info_batch(emplids, chunk_size=SIMS_IN_CHUNK):
+    """
+    grad_student_info for many people, with GRAD_INFO_QUERIES queries for each chunk_size of them.
+
+    Returns a dict of emplid -> data for every emplid given.
+    """
+    db = SIMSConn()
+    data = dict((int(e), {'gpa': 0.0, 'ccredits': 0}) for e in emplids)
+    for chunk in _emplid_chunks(emplids, chunk_size):
+        db.execute("SELECT CIT.EMPLID, C.DESCRSHORT FROM PS_CITIZENSHIP CIT, PS_COUNTRY_TBL C "
+                   "WHERE CIT.EMPLID IN %s AND CIT.COUNTRY=C.COUNTRY", (chunk,))
+        for emplid, country in db:
+            data[int(emplid)]['citizen'] = country
+
+        db.execute("SELECT V.EMPLID, T.DESCRSHORT FROM PS_VISA_PMT_DATA V, PS_VISA_PERMIT_TBL T "
+                   "WHERE V.EMPLID IN %s AND V.VISA_PERMIT_TYPE=T.VISA_PERMIT_TYPE AND V.COUNTRY=T.COUNTRY "
+                   "AND V.COUNTRY='CAN' AND V.VISA_WRKPMT_STATUS='A' AND T.EFF_STATUS='A' "
+                   "ORDER BY V.EMPLID, V.EFFDT ASC", (chunk,))
+        for emplid, desc in db:
+            data[int(emplid)]['visa'] = desc
+
+        db.execute("SELECT EMPLID, SEX FROM PS_PERSONAL_DATA WHERE EMPLID IN %s", (chunk,))
+        for emplid, sex in db:
+            if sex:
+                data[int(emplid)]['gender'] = sex
+
+        # ordered so each person's most recent semester is the last one seen
+        db.execute("SELECT EMPLID, CUM_GPA, TOT_CUMULATIVE FROM PS_STDNT_CAR_TERM WHERE EMPLID IN %s "
+                   "ORDER BY EMPLID, STRM ASC", (chunk,))
+        for emplid, gpa, cred in db:
+            data[int(emplid)]['gpa'] = gpa
+            data[int(emplid)]['ccredits'] = cred
+
+    return data
+
+
 PLAN_QUERY = string.Template("""
             SELECT PROG.EMPLID, PLANTBL.ACAD_PLAN, PLANTBL.DESCR, PLANTBL.TRNSCR_DESCR
             FROM PS_ACAD_PROG AS PROG
@@ -1532,6 +2012,10 @@ def emplid_to_userid(emplid):
 
     Admin contact for the API is George Lee in the Learning & Community Platforms Group
     """
+    if not SIMSConn.backend().uses_reporting_db:
+        # working offline against the stand-in reporting DB: the campus email address is the best we can do
+        return userid_from_sims(emplid)
+
     qs = urllib.parse.urlencode({'art': EMPLID_SECRET, 'sfuid': str(emplid)})
     url = USERID_BASE_URL + qs
     url_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
@@ -1592,8 +2076,8 @@ def import_person(p, commit=True, grad_data=False):
     """
     Import SIMS (+ userid) information about this Person. Return the Person or None if they can't be found.
     """
-    last_name, first_name, middle_name, pref_first_name, title = get_names(p.emplid)
-    if last_name is None:
+    names = get_names(p.emplid)
+    if names[0] is None:
         # no name = no such person
         return None
 
@@ -1601,11 +2085,23 @@ def import_person(p, commit=True, grad_data=False):
     #if userid and len(userid) > 8:
     #    raise ValueError('userid too long', "We have a userid >8 characters: %r" % (userid,))
 
-    p.last_name = last_name
-    p.first_name = first_name
-    p.middle_name = middle_name
-    p.pref_first_name = pref_first_name
-    p.title = title
+    set_person_data(p, names, userid, grad_student_info(p.emplid) if grad_data else None)
+
+    if commit:
+        p.save()
+        # this might now throw an IntegrityError if the new userid is re-used for another person,
+        # but that's *never* supposed to happen, just like changing a userid. See commented-out code
+        # from importer._person_save if it starts happening.
+
+    return p
+
+
+def set_person_data(p, names, userid, grad_data=None):
+    """
+    Update the Person with the results of get_names, emplid_to_userid, and (if given) grad_student_info, as
+    import_person does. Doesn't save.
+    """
+    p.last_name, p.first_name, p.middle_name, p.pref_first_name, p.title = names
     p.config['lastimport'] = int(time.time())
 
     # don't deactivate userids that have been deactivated by the University
@@ -1616,23 +2112,14 @@ def import_person(p, commit=True, grad_data=False):
             mail_admins('userid change', "Somebody's userid changed: %s became %s." % (p.userid, userid))
         p.userid = userid
 
-    if grad_data:
-        data = grad_student_info(p.emplid)
-        p.config.update(data)
+    if grad_data is not None:
+        p.config.update(grad_data)
 
         # if we tried to update but it's gone: don't keep old version
         for f in GRADFIELDS:
-            if f not in data and f in p.config:
+            if f not in grad_data and f in p.config:
                 del p.config[f]
 
-    if commit:
-        p.save()
-        # this might now throw an IntegrityError if the new userid is re-used for another person,
-        # but that's *never* supposed to happen, just like changing a userid. See commented-out code
-        # from importer._person_save if it starts happening.
-
-    return p
-
 
 
 
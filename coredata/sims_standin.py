@@ -0,0 +1,175 @@
+"""
+A local stand-in for the SIMS reporting database, for testing and benchmarking the importer offline.
+
+With settings.SIMS_BACKEND = 'sqlite', SIMSConn() connects to the SQLite database settings.SIMS_STANDIN_DB. This
+module creates the SIMS tables (or at least the columns of them that the importer uses) there, and fills them,
+either with given rows or with enrolment data made up to match the offerings in our database.
+
+The default stand-in is a shared in-memory database, which disappears when its last connection closes: create_tables
+keeps a connection open so it lives as long as the process.
+"""
+
+import datetime
+import itertools
+
+from coredata.models import CourseOffering, Member, Person
+from coredata.queries import SIMSConnSQLite
+
+TABLES = {
+    'PS_TERM_TBL': 'STRM TEXT, ACAD_CAREER TEXT, DESCR TEXT, TERM_BEGIN_DT DATE, TERM_END_DT DATE',
+    'PS_ACAD_ORG_TBL': 'ACAD_ORG TEXT, EFF_STATUS TEXT, DESCRFORMAL TEXT',
+    'PS_RQMNT_DESIG_TBL': 'RQMNT_DESIGNTN TEXT, EFFDT DATE, EFF_STATUS TEXT, DESCRSHORT TEXT',
+    'PS_CRSE_CATALOG': 'CRSE_ID TEXT, EFFDT DATE, EFF_STATUS TEXT, DESCR TEXT, SSR_COMPONENT TEXT, '
+                       'COURSE_TITLE_LONG TEXT, DESCRLONG TEXT, RQMNT_DESIGNTN TEXT, UNITS_MINIMUM REAL',
+    'PS_CLASS_TBL': 'SUBJECT TEXT, CATALOG_NBR TEXT, CLASS_SECTION TEXT, STRM TEXT, CRSE_ID TEXT, CLASS_NBR INTEGER, '
+                    'SSR_COMPONENT TEXT, DESCR TEXT, CAMPUS TEXT, ENRL_CAP INTEGER, ENRL_TOT INTEGER, '
+                    'WAIT_TOT INTEGER, CANCEL_DT DATE, ACAD_ORG TEXT, INSTRUCTION_MODE TEXT, ACAD_CAREER TEXT, '
+                    'CLASS_TYPE TEXT, CLASS_STAT TEXT',
+    'PS_CLASS_INSTR': 'CRSE_ID TEXT, CLASS_SECTION TEXT, STRM TEXT, EMPLID TEXT, INSTR_ROLE TEXT, '
+                      'SCHED_PRINT_INSTR TEXT',
+    'PS_CLASS_MTG_PAT': 'CRSE_ID TEXT, CLASS_SECTION TEXT, STRM TEXT, MEETING_TIME_START TIMESTAMP, '
+                        'MEETING_TIME_END TIMESTAMP, FACILITY_ID TEXT, MON TEXT, TUES TEXT, WED TEXT, THURS TEXT, '
+                        'FRI TEXT, SAT TEXT, SUN TEXT, START_DT TIMESTAMP, END_DT TIMESTAMP, STND_MTG_PAT TEXT',
+    'PS_SCTN_CMBND': 'STRM TEXT, CLASS_NBR INTEGER, SCTN_COMBINED_ID TEXT',
+    'PS_STDNT_ENRL': 'EMPLID TEXT, CLASS_NBR INTEGER, STRM TEXT, ACAD_CAREER TEXT, UNT_TAKEN REAL, '
+                     'CRSE_GRADE_OFF TEXT, STDNT_ENRL_STATUS TEXT, ENRL_STATUS_REASON TEXT, ENRL_DROP_DT DATE',
+    'PS_GRADE_ROSTER': 'EMPLID TEXT, CLASS_NBR INTEGER, STRM TEXT, ACAD_CAREER TEXT, CRSE_GRADE_INPUT TEXT',
+    'PS_NAMES': 'EMPLID TEXT, NAME_TYPE TEXT, NAME_PREFIX TEXT, LAST_NAME TEXT, FIRST_NAME TEXT, MIDDLE_NAME TEXT, '
+                'EFF_STATUS TEXT, EFFDT DATE',
+    'PS_PERSONAL_DATA': 'EMPLID TEXT, LAST_NAME TEXT, FIRST_NAME TEXT, MIDDLE_NAME TEXT, SEX TEXT',
+    'PS_EMAIL_ADDRESSES': 'EMPLID TEXT, E_ADDR_TYPE TEXT, EMAIL_ADDR TEXT, PREF_EMAIL_FLAG TEXT',
+    'PS_COUNTRY_TBL': 'COUNTRY TEXT, DESCRSHORT TEXT',
+    'PS_CITIZENSHIP': 'EMPLID TEXT, COUNTRY TEXT',
+    'PS_VISA_PERMIT_TBL': 'VISA_PERMIT_TYPE TEXT, COUNTRY TEXT, EFF_STATUS TEXT, DESCRSHORT TEXT',
+    'PS_VISA_PMT_DATA': 'EMPLID TEXT, VISA_PERMIT_TYPE TEXT, COUNTRY TEXT, VISA_WRKPMT_STATUS TEXT, EFFDT DATE',
+    'PS_STDNT_CAR_TERM': 'EMPLID TEXT, STRM TEXT, CUM_GPA REAL, TOT_CUMULATIVE REAL',
+}
+INDEXES = {
+    'PS_CLASS_TBL': ['STRM, CLASS_NBR', 'CRSE_ID'],
+    'PS_CLASS_INSTR': ['STRM, CRSE_ID, CLASS_SECTION'],
+    'PS_CLASS_MTG_PAT': ['STRM, CRSE_ID, CLASS_SECTION'],
+    'PS_STDNT_ENRL': ['STRM, CLASS_NBR', 'EMPLID'],
+    'PS_GRADE_ROSTER': ['STRM, CLASS_NBR'],
+    'PS_NAMES': ['EMPLID'],
+    'PS_PERSONAL_DATA': ['EMPLID'],
+}
+
+_keepalive = None
+
+
+def _connection():
+    global _keepalive
+    if _keepalive is None:
+        _keepalive = SIMSConnSQLite.get_connection()
+    return _keepalive
+
+
+def create_tables():
+    """
+    Create (or empty) the stand-in's tables.
+    """
+    conn = _connection()
+    with conn:
+        for table, columns in TABLES.items():
+            conn.execute('DROP TABLE IF EXISTS %s' % (table,))
+            conn.execute('CREATE TABLE %s (%s)' % (table, columns))
+            for i, cols in enumerate(INDEXES.get(table, [])):
+                conn.execute('CREATE INDEX %s_%i ON %s (%s)' % (table, i, table, cols))
+
+
+def close():
+    """
+    Forget the stand-in: for the default in-memory database, that destroys it.
+    """
+    global _keepalive
+    if _keepalive is not None:
+        _keepalive.close()
+        _keepalive = None
+
+
+def load(data):
+    """
+    Insert rows into the stand-in: data is a dict of table name -> list of dicts (of column -> value).
+    """
+    conn = _connection()
+    with conn:
+        for table, rows in data.items():
+            rows = list(rows)
+            if not rows:
+                continue
+            columns = sorted(rows[0].keys())
+            conn.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join('?' * len(columns))),
+                             [tuple(r[c] for c in columns) for r in rows])
+
+
+def person_rows(emplid, last_name, first_name, userid=None, effdt=datetime.date(2000, 1, 1)):
+    """
+    Rows describing one person, for load().
+    """
+    data = {
+        'PS_NAMES': [{'EMPLID': str(emplid), 'NAME_TYPE': 'PRI', 'NAME_PREFIX': None, 'LAST_NAME': last_name,
+                      'FIRST_NAME': first_name, 'MIDDLE_NAME': None, 'EFF_STATUS': 'A', 'EFFDT': effdt}],
+        'PS_PERSONAL_DATA': [{'EMPLID': str(emplid), 'LAST_NAME': last_name, 'FIRST_NAME': first_name,
+                              'MIDDLE_NAME': None, 'SEX': 'U'}],
+        'PS_EMAIL_ADDRESSES': [],
+    }
+    if userid:
+        data['PS_EMAIL_ADDRESSES'].append({'EMPLID': str(emplid), 'E_ADDR_TYPE': 'CAMP',
+                                           'EMAIL_ADDR': userid + '@sfu.ca', 'PREF_EMAIL_FLAG': 'Y'})
+    return data
+
+
+def _merge(data, more):
+    for table, rows in more.items():
+        data.setdefault(table, []).extend(rows)
+
+
+def offering_rows(strm, students_per_offering=None, first_emplid=390000000):
+    """
+    Rows describing the offerings we have in this semester as SIMS would: the classes, their instructors, and their
+    students (with their names). Uses the existing members, or students_per_offering made-up students if given.
+    """
+    data = dict((t, []) for t in TABLES)
+    offerings = CourseOffering.objects.filter(semester__name=strm).exclude(class_nbr=0).select_related('semester')
+    emplids = itertools.count(first_emplid)
+    people = {}
+    for o in offerings:
+        crse_id = '%06i' % (o.crse_id or 0,)
+        data['PS_CLASS_TBL'].append({
+            'SUBJECT': o.subject, 'CATALOG_NBR': ' ' + o.number, 'CLASS_SECTION': o.section, 'STRM': strm,
+            'CRSE_ID': crse_id, 'CLASS_NBR': o.class_nbr, 'SSR_COMPONENT': o.component, 'DESCR': o.title,
+            'CAMPUS': o.campus, 'ENRL_CAP': o.enrl_cap, 'ENRL_TOT': o.enrl_tot, 'WAIT_TOT': o.wait_tot,
+            'CANCEL_DT': None, 'ACAD_ORG': o.owner.acad_org, 'INSTRUCTION_MODE': o.instr_mode,
+            'ACAD_CAREER': 'UGRD', 'CLASS_TYPE': 'E', 'CLASS_STAT': 'A'})
+
+        members = Member.objects.filter(offering=o, role__in=['INST', 'STUD']).select_related('person')
+        for m in members:
+            if m.role == 'INST':
+                data['PS_CLASS_INSTR'].append({'CRSE_ID': crse_id, 'CLASS_SECTION': o.section, 'STRM': strm,
+                                               'EMPLID': str(m.person.emplid), 'INSTR_ROLE': 'PI',
+                                               'SCHED_PRINT_INSTR': 'Y'})
+                people[m.person.emplid] = m.person
+
+        if students_per_offering is None:
+            students = [m.person for m in members if m.role == 'STUD']
+        else:
+            students = [Person(emplid=next(emplids), last_name='Student', first_name='Test')
+                        for _ in range(students_per_offering)]
+        for p in students:
+            data['PS_STDNT_ENRL'].append({'EMPLID': str(p.emplid), 'CLASS_NBR': o.class_nbr, 'STRM': strm,
+                                          'ACAD_CAREER': 'UGRD', 'UNT_TAKEN': 3.0, 'CRSE_GRADE_OFF': None,
+                                          'STDNT_ENRL_STATUS': 'E', 'ENRL_STATUS_REASON': 'ENRL',
+                                          'ENRL_DROP_DT': None})
+            people[p.emplid] = p
+
+    for p in people.values():
+        _merge(data, person_rows(p.emplid, p.last_name, p.first_name, p.userid))
+    return data
+
+
+def populate(strm, students_per_offering=None):
+    """
+    Create the stand-in's tables, and fill them with offering_rows for the semester.
+    """
+    create_tables()
+    load(offering_rows(strm, students_per_offering=students_per_offering))
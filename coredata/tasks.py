@@ -2,7 +2,8 @@ import os
 from typing import Optional, Iterable, Type
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from haystack.exceptions import NotHandled
 from haystack.utils import loading
 from haystack.utils.app_loading import haystack_get_models, haystack_load_apps
@@ -12,7 +13,7 @@ from courselib.search import haystack_update_index, haystack_rebuild_index
 from courselib.svn import update_repository
 from django.core.management import call_command
 from courselib.celerytasks import task
-from coredata.models import Role, Unit, EnrolmentHistory
+from coredata.models import Role, Unit, EnrolmentHistory, OfferingImport, OfferingImportGroup
 import celery
 
 app = celery.Celery(broker=settings.CELERY_BROKER_URL, backend=settings.CELERY_RESULT_BACKEND)  # periodic tasks don't fire without app constructed
@@ -212,9 +213,8 @@ def import_task():
         daily_cleanup.si(),
         fix_unknown_emplids.si(),
         get_role_people.si(),
-        import_offerings.si(continue_import=True),
-        import_semester_info.si(),
-        import_active_grad_gpas.si(),
+        # the rest is started when the last of the offering groups is done
+        import_offerings.si(continue_import=True, then=[import_semester_info.si(), import_active_grad_gpas.si()]),
     ]
 
     celery.chain(*tasks).apply_async(serializer='pickle')
@@ -224,63 +224,116 @@ def import_task():
 def fix_unknown_emplids():
     logger.info('Fixing unknown emplids')
     importer.fix_emplid()
+    logger.info('People: ' + importer.person_import_summary())
 
 
 @task(queue='sims')
 def get_role_people():
     logger.info('Importing people with roles')
     importer.get_role_people()
+    logger.info('People: ' + importer.person_import_summary())
 
 @task(queue='sims')
-def import_offerings(continue_import=False):
+def import_offerings(continue_import=False, then=()):
+    """
+    Import the offerings, and start the tasks that import their members. The tasks in then (signatures) are run
+    after all of those.
+    """
     logger.info('Fetching offerings')
-    #tasks = get_import_offerings_tasks()
-    #logger.info('Starting offering subtasks')
-    #for t in tasks:
-    #    t.apply_async()
-
-    tasks = get_import_offerings_tasks()
-
+    then = [celery.signature(t) for t in then]
     if continue_import:
-        tasks = tasks | import_combined_sections.si()
-        tasks = tasks | import_joint.si()
-        tasks = tasks | haystack_update.si()
+        then = [import_combined_sections.si(), import_joint.si(), haystack_update.si()] + then
+    tasks = get_import_offerings_tasks(then)
 
     logger.info('Starting offering subtasks')
     tasks.apply_async()
 
 
-def get_import_offerings_tasks():
+def get_import_offerings_tasks(then=()):
     """
     Get all of the offerings to import, and build tasks (in groups) to do the work.
 
+    The groups are recorded in a new OfferingImport, and imported in settings.OFFERING_IMPORT_LANES parallel chains
+    of tasks, so a slow group holds up only its own lane. The last lane to finish starts finish_offering_import and
+    then the tasks in then. (Not a chord: the rpc result backend doesn't support them.)
+
     Doesn't actually call the jobs: just returns celery tasks to be called.
     """
     #offerings = importer.import_offerings(extra_where="CT.SUBJECT='CMPT' and CT.CATALOG_NBR IN (' 383', ' 470')")
     offerings = importer.import_offerings(cancel_missing=True)
-    offerings = list(offerings)
-    offerings.sort()
 
-    offering_groups = grouper(offerings, 10)
-    slug_groups = ([o.slug for o in offerings] for offerings in offering_groups)
+    run = OfferingImport.objects.create()
+    OfferingImportGroup.objects.bulk_create(
+        OfferingImportGroup(run=run, unit=unit, slugs=[o.slug for o in offs], weight=sum(map(importer.offering_weight, offs)))
+        for unit, offs in importer.partition_offerings(offerings))
+    lanes = importer.schedule_lanes(run.offeringimportgroup_set.all(), settings.OFFERING_IMPORT_LANES)
 
-    #tasks = [import_offering_group.si(slugs) for slugs in slug_groups]
-    #return tasks
+    then = list(then)
+    if not lanes:
+        return celery.chain(finish_offering_import.si(run.id), *then)
+    run.lanes = len(lanes)
+    run.save()
+    return celery.group([celery.chain(*[import_offering_group.si(g.id) for g in lane],
+                                      finish_offering_lane.si(run.id, then))
+                         for lane in lanes])
 
-    offering_import_chain = celery.chain(*[import_offering_group.si(slugs) for slugs in slug_groups])
-    return offering_import_chain
 
-from requests.exceptions import Timeout
-@task(bind=True, queue='sims', default_retry_delay=300)
-def import_offering_group(self, slugs):
-    offerings = CourseOffering.objects.filter(slug__in=slugs)
-    for o in offerings:
-        logger.debug('Importing %s' % (o.slug,))
-        try:
+@task(bind=True, queue='sims', max_retries=None)
+def import_offering_group(self, group_id):
+    """
+    Import the offerings in this OfferingImportGroup, recording how it went. Failures are retried (after
+    OFFERING_IMPORT_RETRY_DELAY seconds, in place in their lane) up to OFFERING_IMPORT_RETRIES times, and then left
+    for an admin: the rest of the import carries on either way.
+    """
+    group = OfferingImportGroup.objects.get(id=group_id)
+    group.status = 'RUN'
+    group.attempts += 1
+    group.started_at = datetime.datetime.now()
+    group.save()
+
+    start = time.monotonic()
+    try:
+        for o in CourseOffering.objects.filter(slug__in=group.slugs):
+            logger.debug('Importing %s' % (o.slug,))
             importer.import_offering_members(o)
-        except Timeout as exc:
-            # elasticsearch timeout: have celery pause while it collects it thoughts, and retry
-            raise self.retry(exc=exc)
+    except Exception as exc:
+        group.duration = datetime.timedelta(seconds=time.monotonic() - start)
+        group.error = '%s: %s' % (exc.__class__.__name__, exc)
+        if group.attempts <= settings.OFFERING_IMPORT_RETRIES:
+            group.status = 'RETR'
+            group.save()
+            raise self.retry(exc=exc, countdown=settings.OFFERING_IMPORT_RETRY_DELAY * group.attempts)
+        group.status = 'FAIL'
+        group.save()
+        logger.warning('Offering import group %i failed: %s' % (group.id, group.error))
+        return
+
+    group.duration = datetime.timedelta(seconds=time.monotonic() - start)
+    group.status = 'DONE'
+    group.error = None
+    group.save()
+
+
+@task(queue='sims')
+def finish_offering_lane(run_id, then=()):
+    """
+    Record that one of the import's lanes is done: the last one starts finish_offering_import and the tasks in then.
+    """
+    with transaction.atomic():
+        OfferingImport.objects.filter(id=run_id).update(lanes_finished=F('lanes_finished') + 1)
+        run = OfferingImport.objects.get(id=run_id)
+    if run.lanes_finished == run.lanes:
+        celery.chain(finish_offering_import.si(run_id), *[celery.signature(t) for t in then]).apply_async()
+
+
+@task(queue='sims')
+def finish_offering_import(run_id):
+    run = OfferingImport.objects.get(id=run_id)
+    run.finished_at = datetime.datetime.now()
+    run.save()
+    progress = run.progress()
+    logger.info('Offering import finished: %i groups imported, %i failed' % (progress['DONE'], progress['FAIL']))
+    logger.info('People: ' + importer.person_import_summary())
 
 
 @task(queue='sims')
@@ -313,9 +366,12 @@ def daily_cleanup():
     Member.clear_old_official_grades()
     # cleanup old similarity reports
     from submission.models.base import SimilarityResult
+    from submission.moss import prune_moss_report_cache
     SimilarityResult.cleanup_old()
+    prune_moss_report_cache()
     # deduplicate EnrolmentHistory
-    EnrolmentHistory.deduplicate(start_date=datetime.date.today() - datetime.timedelta(days=30))
+    stats = EnrolmentHistory.deduplicate(start_date=datetime.date.today() - datetime.timedelta(days=30))
+    logger.info('EnrolmentHistory deduplicated: %(scanned)i rows scanned, %(removed)i removed in %(seconds).1f s' % stats)
     # purge old EventLogs
     EventLogEntry.purge_old_logs()
     # clear orphaned tmp files
@@ -1,8 +1,8 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from haystack.query import SearchQuerySet
 
 from coredata.models import CourseOffering, Semester, Person, SemesterWeek, \
-                            Member, Role, Unit, EnrolmentHistory, ROLE_CHOICES
+                            Member, Role, Unit, EnrolmentHistory, OfferingImport, OfferingImportGroup, ROLE_CHOICES
 
 from django.urls import reverse
 
@@ -12,7 +12,7 @@ from courselib.testing import basic_page_tests, validate_content, Client, \
 
 from django.db import IntegrityError
 from datetime import date, datetime, timedelta
-import pytz, json
+import pytz, json, time
 
 
 def create_semesters():
@@ -321,6 +321,208 @@ class CoredataTest(TestCase):
         self.assertEqual(resp.status_code, 403)
 
 
+class SemesterIndexTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def test_lookups(self):
+        from coredata.models import semester_index
+        semesters = list(Semester.objects.order_by('name'))
+        on_date = dict((d, Semester.objects.filter(start__lte=d).order_by('-start')[0])
+                       for s in semesters for d in [s.start, s.end])
+        semester_index()
+        with self.assertNumQueries(0):
+            index = semester_index()
+            self.assertEqual(len(index), len(semesters))
+            for d, s in on_date.items():
+                self.assertEqual(Semester.get_semester(d), s)
+            for i, s in enumerate(semesters):
+                self.assertEqual(s.offset(1), semesters[i+1] if i+1 < len(semesters) else None)
+                self.assertEqual(s.offset(-2), semesters[i-2] if i >= 2 else None)
+                self.assertEqual(s.offset(0), s)
+                self.assertEqual(index.get(s.name), s)
+            self.assertEqual(index.get(semesters[0].name).start, semesters[0].start)
+            self.assertRaises(Semester.DoesNotExist, index.get, '0001')
+            self.assertRaises(IndexError, Semester.get_semester, date(1900, 1, 1))
+            self.assertEqual(Semester.range(semesters[2].name, semesters[4].name), [s.name for s in semesters[2:5]])
+            self.assertEqual(index.between(semesters[1].start, semesters[3].end), semesters[1:4])
+            self.assertEqual(index.next_starting(semesters[2].start), semesters[3])
+
+    def test_invalidation(self):
+        from unittest import mock
+        from coredata import models
+        # the test's changes are rolled back, and nothing replaces an index loaded with them: drop it afterwards
+        self.addCleanup(models.invalidate_semester_index)
+        s = Semester.current()
+        self.assertEqual(models.semester_index().weeks(s.id), list(SemesterWeek.objects.filter(semester=s)))
+
+        # changes in this process replace the index immediately
+        new = Semester(name='3997', start=date(2999, 9, 1), end=date(2999, 12, 1))
+        new.save()
+        self.assertEqual(Semester.current().offset(1000), None)
+        self.assertEqual(Semester.objects.order_by('-name')[1].offset(1), new)
+        wk = SemesterWeek(semester=new, week=1, monday=date(2999, 9, 2))
+        wk.save()
+        self.assertEqual(new.week_weekday(date(2999, 9, 11)), (2, 2))
+
+        # an index reloaded before the change is committed is replaced again on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            Semester(name='3994', start=date(2999, 5, 1), end=date(2999, 8, 1)).save()
+            index = models.semester_index()
+            self.assertEqual(index.get('3994').name, '3994')
+        self.assertIsNot(models.semester_index(), index)
+
+        # ... and the version key tells other processes to reload
+        index = models.semester_index()
+        Semester.objects.filter(id=new.id).update(start=date(2999, 9, 2)) # no signal
+        with mock.patch('coredata.models.SEMESTER_INDEX_RECHECK', 0):
+            self.assertIs(models.semester_index(), index)
+            from django.core.cache import cache
+            cache.delete(models.SEMESTER_INDEX_VERSION_KEY)
+            self.assertEqual(models.semester_index().get('3997').start, date(2999, 9, 2))
+
+    def test_hot_callers(self):
+        from django.test import RequestFactory
+        from courselib.auth import is_course_staff_by_slug
+        from coredata.models import semester_index
+        instr = Member.objects.filter(offering__slug=TEST_COURSE_SLUG, role='INST').select_related('person').first()
+        request = RequestFactory().get('/')
+        request.user = type('User', (), {'username': instr.person.userid})()
+        semester_index()
+        with self.assertNumQueries(1):
+            # just the membership query
+            self.assertTrue(is_course_staff_by_slug(request, TEST_COURSE_SLUG))
+
+        dates = [date(2000, 1, 1) + timedelta(days=d) for d in range(9000, 10000, 7)]
+        with self.assertNumQueries(0):
+            semesters = [Semester.get_semester(d) for d in dates]
+        self.assertEqual(semesters[-1], Semester.objects.filter(start__lte=dates[-1]).order_by('-start')[0])
+
+
+class UnitClosureTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def test_lookups(self):
+        from coredata.models import UnitClosure
+        units = list(Unit.objects.all())
+        self.assertEqual(UnitClosure.problems(), [])
+        for u in units:
+            ancestors = []
+            p = u.parent
+            while p:
+                ancestors.append(p)
+                p = p.parent
+            self.assertEqual(u.super_units(), ancestors)
+            self.assertEqual(u.super_units(include_self=True), ancestors + [u])
+            self.assertEqual(Unit.sub_unit_ids([u]), set(v.id for v in units if u == v or u in v.super_units()))
+
+        univ = Unit.objects.get(label='UNIV')
+        with self.assertNumQueries(1):
+            self.assertEqual(Unit.sub_unit_ids([univ]), set(u.id for u in units))
+        with self.assertNumQueries(1):
+            # "all roles under these units" is one query
+            n = Role.objects.filter(unit__in=Unit.sub_units([univ.id], by_id=True)).count()
+        self.assertEqual(n, Role.objects.count())
+
+    def test_maintenance(self):
+        from django.core.management import call_command, CommandError
+        from io import StringIO
+        from coredata.models import UnitClosure
+        cmpt = Unit.objects.get(label='CMPT')
+        new = Unit(label='NEWU', name='New Unit', parent=cmpt)
+        new.save()
+        self.assertEqual(new.super_units(), [cmpt] + cmpt.super_units())
+
+        # reparenting rebuilds
+        univ = Unit.objects.get(label='UNIV')
+        new = Unit.objects.get(id=new.id)
+        new.parent = univ
+        new.save()
+        self.assertEqual(new.super_units(), [univ])
+        self.assertNotIn(new.id, Unit.sub_unit_ids([cmpt]))
+        self.assertEqual(UnitClosure.problems(), [])
+
+        # ... but QuerySet.update doesn't, and the checker notices
+        Unit.objects.filter(id=new.id).update(parent=cmpt)
+        problems = UnitClosure.problems()
+        self.assertIn('missing %i > %i (depth 1)' % (cmpt.id, new.id), problems)
+        self.assertIn('unexpected %i > %i (depth 1)' % (univ.id, new.id), problems)
+        self.assertRaises(CommandError, call_command, 'check_unit_closure', stdout=StringIO())
+        call_command('check_unit_closure', fix=True, stdout=StringIO())
+        self.assertEqual(UnitClosure.problems(), [])
+        self.assertIn(new.id, Unit.sub_unit_ids([cmpt]))
+
+        pairs, cycles = UnitClosure.closure_pairs({1: 2, 2: 1, 3: None})
+        self.assertEqual(cycles, {1, 2})
+        self.assertIn((2, 1, 1), pairs)
+
+
+class MembershipMenuTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_content_counts(self):
+        from grades.models import Activity
+        from pages.models import Page
+        o = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        self.assertEqual((o.activity_count, o.page_count), (5, 0))
+
+        p = Page(offering=o, label='Index')
+        p.save()
+        a = Activity.objects.filter(offering=o, deleted=False).exclude(status='INVI').first()
+        a.status = 'INVI'
+        a.save()
+        o2 = CourseOffering.objects.get(id=o.id)
+        self.assertEqual((o2.activity_count, o2.page_count), (4, 1))
+
+        # saving a stale instance doesn't put the old counts back
+        o.title = 'Changed Title'
+        o.save()
+        o.refresh_from_db()
+        self.assertEqual((o.title, o.activity_count, o.page_count), ('Changed Title', 4, 1))
+
+        Activity.objects.filter(offering=o, deleted=False).exclude(status='INVI').first().safely_delete()
+        p.delete()
+        o.refresh_from_db()
+        self.assertEqual((o.activity_count, o.page_count), (3, 0))
+
+    def test_menu_cache(self):
+        from pages.models import Page
+        o = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        m = Member.objects.filter(offering=o, role='STUD').select_related('person').first()
+        userid = m.person.userid
+        self.assertEqual(Member.get_memberships(userid)[0], []) # fixture semester is long past
+
+        # changing the offering's semester invalidates its members' menus
+        current = Semester.current()
+        o.semester = current
+        o.save()
+        with self.assertNumQueries(1):
+            memberships, _ = Member.get_memberships(userid)
+        self.assertEqual([mm.id for mm in memberships], [m.id])
+        with self.assertNumQueries(0):
+            Member.get_memberships(userid)
+
+        # ... as do Member changes
+        m.role = 'DROP'
+        m.save()
+        self.assertEqual(Member.get_memberships(userid)[0], [])
+        m.role = 'STUD'
+        m.save()
+
+        # an offering with nothing in it isn't in students' menus, until it has content
+        other = CourseOffering.objects.get(slug='2023fa-cmpt-125-d1')
+        other.semester = current
+        other.save()
+        m2 = Member(person=m.person, offering=other, role='STUD', added_reason='UNK', career='UGRD')
+        m2.save()
+        self.assertEqual([mm.id for mm in Member.get_memberships(userid)[0]], [m.id])
+        Page(offering=other, label='Index').save()
+        self.assertEqual(set(mm.id for mm in Member.get_memberships(userid)[0]), {m.id, m2.id})
+
+
 class SlowCoredataTest(TestCase):
     fixtures = ['basedata', 'coredata']
     
@@ -411,6 +613,473 @@ class EnrolmentHistoryTest(TestCase):
         self.assertEqual(eh2[1].date, date(2017, 1, 5))
         self.assertEqual(eh2[1].enrl_vals, (20, 30, 7))
 
+    def test_dedupe_stats(self):
+        with self.assertNumQueries(2):
+            # one scan, and one DELETE per chunk
+            stats = EnrolmentHistory.deduplicate(chunk_size=1000)
+        self.assertEqual((stats['scanned'], stats['removed']), (11, 6))
+        self.assertEqual(EnrolmentHistory.objects.count(), 5)
+        self.assertEqual(EnrolmentHistory.deduplicate()['removed'], 0)
+
+    def test_dedupe_range(self):
+        stats = EnrolmentHistory.deduplicate(start_date=date(2017, 1, 2), end_date=date(2017, 1, 5), dry_run=True)
+        self.assertEqual((stats['scanned'], stats['removed']), (7, 3))
+        self.assertEqual(EnrolmentHistory.objects.count(), 11)
+
+        with self.assertNumQueries(3):
+            stats = EnrolmentHistory.deduplicate(start_date=date(2017, 1, 2), end_date=date(2017, 1, 5), chunk_size=2)
+        self.assertEqual(stats['removed'], 3)
+        # the first row in the range is kept...
+        self.assertTrue(EnrolmentHistory.objects.filter(offering=self.o2, date=date(2017, 1, 2)).exists())
+
+        # ... unless compacting
+        stats = EnrolmentHistory.deduplicate(start_date=date(2017, 1, 2), compact=True)
+        self.assertEqual((stats['scanned'], stats['removed']), (8, 3))
+        self.assertEqual([eh.date for eh in EnrolmentHistory.objects.filter(offering=self.o1).order_by('date')],
+                         [date(2017, 1, 1), date(2017, 1, 3), date(2017, 1, 7)])
+        self.assertEqual([eh.date for eh in EnrolmentHistory.objects.filter(offering=self.o2).order_by('date')],
+                         [date(2017, 1, 1), date(2017, 1, 5)])
+
+    def test_dedupe_compact_runs(self):
+        # an offering with the usual daily snapshots: long runs of the same numbers
+        o3 = CourseOffering.objects.all()[2]
+        o3.enrl_cap, o3.enrl_tot, o3.wait_tot = 30, 20, 0
+        for day in range(10, 15):
+            EnrolmentHistory.from_offering(o3, date=date(2017, 1, day))
+        o3.enrl_tot = 25
+        for day in range(15, 19):
+            EnrolmentHistory.from_offering(o3, date=date(2017, 1, day))
+
+        stats = EnrolmentHistory.deduplicate(start_date=date(2017, 1, 12), compact=True)
+        self.assertEqual(stats['removed'], 6)
+        # each row in the range is compared with the last one kept, so only the changes remain
+        self.assertEqual([eh.date for eh in EnrolmentHistory.objects.filter(offering=o3).order_by('date')],
+                         [date(2017, 1, 10), date(2017, 1, 11), date(2017, 1, 15)])
+
+        # and the same for the whole history
+        stats = EnrolmentHistory.deduplicate(compact=True)
+        self.assertEqual([eh.date for eh in EnrolmentHistory.objects.filter(offering=o3).order_by('date')],
+                         [date(2017, 1, 10), date(2017, 1, 15)])
+
+
+class StudentImportTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def test_import_all_students(self):
+        from unittest import mock
+        from coredata import importer
+        from grades.models import NumericActivity, ActivityStats, grade_version
+        o = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        o.set_labtut(False)
+        o.save()
+        Member.objects.filter(offering=o, role='STUD').update(added_reason='AUTO')
+        students = list(Member.objects.filter(offering=o, role='STUD').select_related('person').order_by('id'))
+        stay, changed, dropped = students[2:], students[0], students[1]
+        newp = Person.objects.exclude(id__in=Member.objects.filter(offering=o).values('person_id')).exclude(emplid__in=importer.IGNORE_EMPLIDS).first()
+
+        enrolments = [(o.class_nbr, str(m.person.emplid), m.career, 3.0, None, None) for m in stay]
+        enrolments.append((o.class_nbr, str(changed.person.emplid), 'UGRD', 4.0, None, None))
+        enrolments.append((o.class_nbr, str(newp.emplid), 'GRAD', 3.0, None, None))
+        enrolments.append((o.class_nbr, '399999999', 'UGRD', 3.0, None, None))
+        labtut = {(o.class_nbr, newp.emplid): 'D101'}
+        drop_dates = {(o.class_nbr, dropped.person.emplid): date(2023, 9, 20)}
+
+        def sims(strm, class_nbrs):
+            self.assertEqual(strm, o.semester.name)
+            if o.class_nbr in class_nbrs:
+                return enrolments, labtut, drop_dates
+            return [], {}, {}
+
+        def get_people(emplids):
+            return dict((p.emplid, p) for p in Person.objects.filter(emplid__in=emplids))
+
+        with mock.patch('coredata.importer._semester_students_from_sims', sims), \
+                mock.patch('coredata.importer.get_people', get_people):
+            # dry run: diff but no changes
+            diff = importer.import_all_students(o.semester.name, dry_run=True, chunk_size=2)
+            self.assertEqual(sorted(e for _, e in diff.added), sorted([newp.emplid, 399999999]))
+            self.assertEqual(diff.new_people, {399999999})
+            self.assertEqual(dict((m.id, f) for m, f in diff.changed),
+                             {changed.id: ['credits', 'career'], dropped.id: ['role', 'config']})
+            self.assertEqual(diff.labtut_offerings, {o})
+            self.assertIn('add %i to %s' % (newp.emplid, o.slug), diff.summary())
+            self.assertFalse(Member.objects.filter(offering=o, person=newp).exists())
+            self.assertEqual(Member.objects.get(id=dropped.id).role, 'STUD')
+
+            activity = NumericActivity.objects.filter(offering=o).first()
+            ActivityStats.for_activity(activity)
+            version = grade_version(o.id)
+            importer.import_all_students(o.semester.name, chunk_size=1000)
+
+        # what the Member signals would have done
+        self.assertFalse(ActivityStats.objects.filter(activity=activity).exists())
+        self.assertNotEqual(grade_version(o.id), version)
+
+        m = Member.objects.get(offering=o, person=newp)
+        self.assertEqual((m.role, m.career, m.labtut_section, m.added_reason), ('STUD', 'GRAD', 'D101', 'AUTO'))
+        m = Member.objects.get(id=dropped.id)
+        self.assertEqual((m.role, m.config['drop_date']), ('DROP', '2023-09-20'))
+        m = Member.objects.get(id=changed.id)
+        self.assertEqual((m.role, m.credits, m.career), ('STUD', 4, 'UGRD'))
+        self.assertEqual(Member.objects.filter(offering=o, role='STUD').count(), len(students))
+        self.assertTrue(CourseOffering.objects.get(id=o.id).labtut())
+
+    def test_get_people(self):
+        from unittest import mock
+        from coredata import importer
+        old = Person.objects.exclude(userid__isnull=True).order_by('id')[:3]
+        stale, fresh, missing = old
+        stale.config['lastimport'] = 0
+        stale.save()
+        fresh.config['lastimport'] = int(time.time())
+        fresh.save()
+        missing.config['lastimport'] = 0
+        missing.save()
+        new_emplids = list(range(399999000, 399999020))
+
+        names = dict((e, ('Last%i' % (e,), 'First', None, 'Pref', None)) for e in new_emplids)
+        names[stale.emplid] = ('Newname', 'First', 'M', None, 'Dr')
+        names_batch = mock.Mock(return_value=names)
+        grad_batch = mock.Mock(side_effect=lambda emplids: dict((e, {'gpa': 3.5, 'ccredits': 12}) for e in emplids))
+        userids = lambda emplid: 'u%i' % (emplid % 1000000,) if emplid in new_emplids else None
+
+        importer.imported_people = {}
+        importer.person_import_stats.clear()
+        with mock.patch('coredata.importer.get_names_batch', names_batch), \
+                mock.patch('coredata.importer.grad_student_info_batch', grad_batch), \
+                mock.patch('coredata.importer.emplid_to_userid', userids), \
+                mock.patch('coredata.importer.random.random', return_value=0.5), \
+                mock.patch('coredata.importer.SIMS_IN_CHUNK', 8), \
+                self.assertNumQueries(4):
+            people = importer.get_people([str(e) for e in new_emplids] + [stale.emplid, fresh.emplid,
+                                         missing.emplid, 399999999], grad_data=True)
+
+        # one SIMS lookup for the people that needed it, not one each
+        names_batch.assert_called_once()
+        self.assertEqual(set(names_batch.call_args[0][0]), set(new_emplids) | {stale.emplid, missing.emplid, 399999999})
+        self.assertEqual(set(people), set(new_emplids) | {stale.emplid, fresh.emplid, missing.emplid})
+
+        p = Person.objects.get(emplid=new_emplids[3])
+        self.assertEqual((p.last_name, p.pref_first_name, p.userid, p.config['gpa']),
+                         ('Last%i' % (new_emplids[3],), 'Pref', 'u999003', 3.5))
+        self.assertEqual(people[p.emplid].id, p.id)
+        p = Person.objects.get(id=stale.id)
+        self.assertEqual((p.last_name, p.title, p.userid), ('Newname', 'Dr', stale.userid))
+        self.assertEqual(Person.objects.get(id=missing.id).last_name, missing.last_name)
+        self.assertFalse(Person.objects.filter(emplid=399999999).exists())
+
+        # 23 people to look up and 21 found, in chunks of 8
+        self.assertEqual(importer.person_import_stats['imported'], 21)
+        self.assertEqual(importer.person_import_stats['sims_queries'], 3 * 1 + 3 * 4)
+        self.assertEqual(importer.person_import_stats['sims_queries_saved'], (23 * 1 + 21 * 4) - (3 * 1 + 3 * 4))
+
+        # now cached: no more work
+        with self.assertNumQueries(0):
+            self.assertEqual(importer.get_person(stale.emplid).last_name, 'Newname')
+        importer.imported_people = {}
+
+
+@override_settings(SIMS_BACKEND='sqlite', SIMS_STANDIN_DB='file:coursys_test_sims?mode=memory&cache=shared')
+class SIMSConnTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def setUp(self):
+        from coredata import sims_standin
+        sims_standin.create_tables()
+
+    def tearDown(self):
+        from coredata import sims_standin
+        from coredata.queries import SIMSConn
+        SIMSConn().release()
+        sims_standin.close()
+
+    def test_bind(self):
+        from coredata.queries import SIMSConn
+        db = SIMSConn()
+        sql, params = db.bind("SELECT X FROM T WHERE A IN %s AND B LIKE %s AND C='100%%'", ([1, 2, 3], 'a%'))
+        self.assertEqual(sql, "SELECT X FROM T WHERE A IN (?, ?, ?) AND B LIKE ? AND C='100%'")
+        self.assertEqual(params, [1, 2, 3, 'a%'])
+
+        # long lists are escaped instead of bound
+        sql, params = db.bind("SELECT X FROM T WHERE A IN %s AND B=%s", (list(range(db.max_bound_list + 1)), "it's"))
+        self.assertTrue(sql.startswith("SELECT X FROM T WHERE A IN (0, 1, 2, "))
+        self.assertEqual(params, ["it's"])
+
+        # values that would need escaping come through untouched
+        db.execute("SELECT %s, %s", ("Robert'); DROP TABLE PS_NAMES;--", 3))
+        self.assertEqual(db.rows(), [("Robert'); DROP TABLE PS_NAMES;--", 3)])
+
+    def test_threads(self):
+        import threading
+        from coredata.queries import SIMSConn, sims_query_stats
+        db = SIMSConn()
+        self.assertIs(SIMSConn(), db)
+
+        conns = []
+        def worker():
+            other = SIMSConn()
+            other.execute("SELECT COUNT(*) FROM PS_NAMES", ())
+            conns.append((other, other.conn, other.rows()))
+            other.release()
+
+        before = sims_query_stats['queries']
+        for _ in range(2):
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+        (db1, conn1, rows1), (db2, conn2, rows2) = conns
+        self.assertEqual(rows1, [(0,)])
+        self.assertIsNot(db1, db)
+        self.assertIsNot(db1, db2)
+        self.assertIs(conn1, conn2) # the second thread got the first's connection from the pool
+        self.assertEqual(sims_query_stats['queries'] - before, 2)
+
+    def test_release(self):
+        import threading
+        from unittest import mock
+        from django.core.signals import request_finished
+        from coredata.queries import SIMSConn, release_sims_connections
+        db = SIMSConn()
+        conn = db.conn
+        release_sims_connections()
+        self.assertIsNone(db.conn)
+        self.assertIn(conn, [c for c, _ in db.pool().idle])
+
+        # ... at the end of a request, so the next one gets the same connection back
+        db = SIMSConn()
+        self.assertIs(db.conn, conn)
+        request_finished.send(sender=self.__class__)
+        self.assertIsNone(db.conn)
+
+        # ... and by the stale-while-revalidate threads
+        from coredata.queries import sims_result_cache
+        done = threading.Event()
+        def compute():
+            SIMSConn().execute("SELECT 1", ())
+            return 1
+        def release():
+            release_sims_connections()
+            done.set()
+        with mock.patch('coredata.queries.release_sims_connections', side_effect=release):
+            sims_result_cache.revalidate('simscache-test-release', compute, 60)
+            self.assertTrue(done.wait(5))
+
+    def test_import_from_standin(self):
+        from coredata import importer, sims_standin
+        o = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        strm = o.semester.name
+        sims_standin.load(sims_standin.offering_rows(strm))
+        sims_standin.load(sims_standin.person_rows(300000999, 'Newstudent', 'Nell', 'nnew'))
+        sims_standin.load({'PS_STDNT_ENRL': [{'EMPLID': '300000999', 'CLASS_NBR': o.class_nbr, 'STRM': strm,
+                                              'ACAD_CAREER': 'UGRD', 'UNT_TAKEN': 3.0, 'CRSE_GRADE_OFF': None,
+                                              'STDNT_ENRL_STATUS': 'E', 'ENRL_STATUS_REASON': 'ENRL',
+                                              'ENRL_DROP_DT': None}]})
+        students = set(Member.objects.filter(offering=o, role='STUD').values_list('person__emplid', flat=True))
+        instructors = set(Member.objects.filter(offering=o, role='INST').values_list('person__emplid', flat=True))
+
+        importer.imported_people = {}
+        importer.import_all_instructors(strm)
+        importer.import_all_students(strm)
+        importer.imported_people = {}
+
+        self.assertEqual(set(Member.objects.filter(offering=o, role='STUD').values_list('person__emplid', flat=True)),
+                         students | {300000999})
+        self.assertEqual(set(Member.objects.filter(offering=o, role='INST').values_list('person__emplid', flat=True)),
+                         instructors)
+        p = Person.objects.get(emplid=300000999)
+        self.assertEqual((p.last_name, p.first_name, p.userid), ('Newstudent', 'Nell', 'nnew'))
+
+
+@override_settings(SIMS_CACHE_STATS_FLUSH=0)
+class SIMSCacheTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_cache_tiers(self):
+        from django.core.cache import cache
+        from coredata.queries import SIMSResultCache
+        from coredata import panel
+        c = SIMSResultCache()
+        calls = []
+        def compute():
+            calls.append(1)
+            return {'answer': 42}
+
+        v = c.get('simscache-test', compute, 100)
+        self.assertEqual(v, {'answer': 42})
+        v['answer'] = 0 # doesn't affect the cached copy
+        self.assertEqual(c.get('simscache-test', compute, 100), {'answer': 42})
+        c.clear_local()
+        self.assertEqual(c.get('simscache-test', compute, 100), {'answer': 42})
+        self.assertEqual(len(calls), 1)
+        stats = c.totals()
+        self.assertEqual((stats['miss'], stats['local_hit'], stats['hit']), (1, 1, 1))
+
+        # empty results are cached, briefly
+        with override_settings(SIMS_NEGATIVE_CACHE_SECONDS=5):
+            self.assertIsNone(c.get('simscache-empty', lambda: None, 100))
+        self.assertIsNone(c.get('simscache-empty', lambda: 1/0, 100))
+        self.assertLessEqual(cache.get('simscache-empty')[1], time.time() + 5)
+
+        from unittest import mock
+        with mock.patch('coredata.queries.sims_result_cache', c):
+            info = dict(panel.sims_cache_info())
+        self.assertEqual(info['Misses'], 2)
+        self.assertEqual(info['Hit rate'], '60.0%')
+
+    def test_single_flight(self):
+        import threading
+        from coredata.queries import SIMSResultCache
+        c = SIMSResultCache()
+        calls = []
+        release = threading.Event()
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return ['result']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(c.get('simscache-flight', compute, 100)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [['result']] * 5)
+        self.assertEqual(len(set(id(r) for r in results)), 5) # each thread gets its own copy
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(c.totals()['shared'], 4)
+
+    def test_stale_while_revalidate(self):
+        from django.core.cache import cache
+        from coredata.queries import SIMSResultCache
+        c = SIMSResultCache()
+        cache.set('simscache-stale', ('old', time.time() - 1), 100)
+        self.assertEqual(c.get('simscache-stale', lambda: 'new', 100), 'old')
+        for _ in range(50):
+            if cache.get('simscache-stale')[0] == 'new':
+                break
+            time.sleep(0.05)
+        self.assertEqual(c.get('simscache-stale', lambda: 'newer', 100), 'new')
+        self.assertEqual(c.totals()['refresh'], 1)
+
+
+@override_settings(OFFERING_IMPORT_GROUP_SIZE=3, OFFERING_IMPORT_GROUP_WEIGHT=500)
+class OfferingImportTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def test_partition(self):
+        from coredata.importer import partition_offerings, schedule_lanes, offering_weight
+        offerings = list(CourseOffering.objects.select_related('owner'))
+        offerings[0].enrl_tot = 1000 # too big for any group: alone in one
+        groups = partition_offerings(offerings)
+        self.assertEqual(sorted(o.slug for _, offs in groups for o in offs), sorted(o.slug for o in offerings))
+        for unit, offs in groups:
+            self.assertTrue(all(o.owner == unit for o in offs))
+            self.assertLessEqual(len(offs), 3)
+            self.assertTrue(len(offs) == 1 or sum(map(offering_weight, offs)) <= 500)
+        self.assertIn((offerings[0].owner, [offerings[0]]), groups)
+
+        groups = [OfferingImportGroup(weight=w) for w in [10, 50, 20, 40, 30]]
+        lanes = schedule_lanes(groups, 2)
+        self.assertEqual([[g.weight for g in lane] for lane in lanes], [[50, 20, 10], [40, 30]])
+        self.assertEqual(len(schedule_lanes(groups[:1], 4)), 1)
+
+    def test_group_task(self):
+        from django.conf import settings
+        if not settings.USE_CELERY:
+            return
+        from unittest import mock
+        from coredata.tasks import import_offering_group, finish_offering_import
+        o = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        run = OfferingImport.objects.create()
+        good = OfferingImportGroup.objects.create(run=run, unit=o.owner, slugs=[o.slug], weight=10)
+        bad = OfferingImportGroup.objects.create(run=run, unit=o.owner, slugs=[o.slug], weight=10)
+        self.assertEqual(run.percent_done(), 0)
+
+        imported = []
+        with mock.patch('coredata.importer.import_offering_members', imported.append):
+            import_offering_group(good.id)
+        self.assertEqual(imported, [o])
+        good.refresh_from_db()
+        self.assertEqual((good.status, good.attempts), ('DONE', 1))
+        self.assertIsNotNone(good.duration)
+
+        # a failing group is retried, and then given up on without failing the rest of the import
+        with mock.patch('coredata.importer.import_offering_members', side_effect=ValueError('broken')), \
+                override_settings(OFFERING_IMPORT_RETRIES=1):
+            with self.assertRaises(ValueError):
+                import_offering_group(bad.id)
+            bad.refresh_from_db()
+            self.assertEqual((bad.status, bad.attempts), ('RETR', 1))
+            import_offering_group(bad.id)
+        bad.refresh_from_db()
+        self.assertEqual((bad.status, bad.attempts, bad.error), ('FAIL', 2, 'ValueError: broken'))
+
+        finish_offering_import(run.id)
+        run.refresh_from_db()
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual(run.percent_done(), 100)
+        self.assertEqual((run.progress()['DONE'], run.progress()['FAIL']), (1, 1))
+
+    def test_import_canvas(self):
+        from django.conf import settings
+        if not settings.USE_CELERY:
+            return
+        import celery
+        from unittest import mock
+        from coredata.tasks import app, get_import_offerings_tasks, finish_offering_lane, haystack_update
+        offerings = list(CourseOffering.objects.select_related('owner'))
+        with mock.patch('coredata.importer.import_offerings', return_value=offerings), \
+                override_settings(OFFERING_IMPORT_LANES=2):
+            tasks = get_import_offerings_tasks([haystack_update.si()])
+        run = OfferingImport.objects.order_by('-id').first()
+        self.assertEqual(run.lanes, 2)
+
+        # no chords anywhere, since the configured result backend may not support them ...
+        def signatures(sig):
+            yield sig
+            for t in getattr(sig, 'tasks', ()):
+                yield from signatures(t)
+        self.assertFalse(any(isinstance(sig, celery.chord) for sig in signatures(tasks)))
+        # ... and it can be started with that backend (without listening for results or sending anything)
+        with mock.patch.object(app.backend.result_consumer, 'consume_from'), \
+                mock.patch('celery.app.task.Task.apply_async') as apply:
+            tasks.apply_async()
+        self.assertEqual(apply.call_count, 2) # the first task in each lane
+
+        # the last lane to finish starts the rest of the import
+        then = [haystack_update.si()]
+        with mock.patch('celery.canvas._chain.apply_async') as start:
+            finish_offering_lane(run.id, then)
+            start.assert_not_called()
+            finish_offering_lane(run.id, then)
+            start.assert_called_once()
+
+    def test_progress_page(self):
+        o = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        run = OfferingImport.objects.create()
+        OfferingImportGroup.objects.create(run=run, unit=o.owner, slugs=[o.slug], weight=10, status='DONE',
+                                           attempts=1, duration=timedelta(seconds=3))
+        OfferingImportGroup.objects.create(run=run, unit=o.owner, slugs=[o.slug], weight=10, status='FAIL',
+                                           attempts=3, error='ValueError: broken')
+        OfferingImportGroup.objects.create(run=run, unit=o.owner, slugs=[o.slug], weight=10)
+        self.assertEqual(run.percent_done(), 66)
+
+        r = Role.objects.filter(role='SYSA')[0]
+        r.person.config['privacy_signed'] = True
+        r.person.config['privacy_da_signed'] = True
+        r.person.save()
+        client = Client()
+        client.login_user(r.person.userid)
+        response = basic_page_tests(self, client, reverse('sysadmin:offering_imports'))
+        self.assertContains(response, 'ValueError: broken')
+        self.assertContains(response, '66% of groups complete')
+        basic_page_tests(self, client, reverse('sysadmin:offering_imports', kwargs={'run_id': run.id}))
+
 
 class SearchTest(TestCase):
     fixtures = ['basedata', 'coredata']
@@ -57,6 +57,8 @@ sysadmin_patterns = [ # prefix /sysadmin/
     url(r'^semesters/$', coredata_views.semester_list, name='semester_list'),
     url(r'^semesters/new$', coredata_views.edit_semester, name='edit_semester'),
     url(r'^semesters/edit/(?P<semester_name>\d{4})$', coredata_views.edit_semester, name='edit_semester'),
+    url(r'^imports/$', coredata_views.offering_imports, name='offering_imports'),
+    url(r'^imports/(?P<run_id>\d+)$', coredata_views.offering_imports, name='offering_imports'),
     url(r'^users/' + USERID_OR_EMPLID + '/$', coredata_views.user_summary, name='user_summary'),
     url(r'^users/' + USERID_OR_EMPLID + '/config/$', coredata_views.user_config, name='user_config'),
     url(r'^offerings/' + COURSE_SLUG + '/$', coredata_views.offering_summary, name='offering_summary'),
@@ -10,7 +10,7 @@ from courselib.auth import requires_global_role, requires_role, requires_course_
         has_formgroup, has_global_role
 from courselib.search import get_query, find_userid_or_emplid
 from coredata.models import Person, Semester, CourseOffering, Course, Member, Role, Unit, SemesterWeek, Holiday, \
-    AnyPerson, FuturePerson, RoleAccount, CombinedOffering, UNIT_ROLES, ROLES, ROLE_DESCR, INSTR_ROLES, DISC_ROLES
+    AnyPerson, FuturePerson, RoleAccount, CombinedOffering, OfferingImport, UNIT_ROLES, ROLES, ROLE_DESCR, INSTR_ROLES, DISC_ROLES
 from coredata import panel
 from advisornotes.models import NonStudent
 from onlineforms.models import FormGroup, FormGroupMember
@@ -262,6 +262,17 @@ def semester_list(request):
     semesters = Semester.objects.all()
     return render(request, 'coredata/semester_list.html', {'semesters': semesters})
 
+@requires_global_role("SYSA")
+def offering_imports(request, run_id=None):
+    if run_id:
+        run = get_object_or_404(OfferingImport, id=run_id)
+    else:
+        run = OfferingImport.objects.first()
+    runs = OfferingImport.objects.all()[:20]
+    groups = run.offeringimportgroup_set.select_related('unit') if run else []
+    context = {'run': run, 'runs': runs, 'groups': groups}
+    return render(request, 'coredata/offering_imports.html', context)
+
 @requires_global_role("SYSA")
 def edit_semester(request, semester_name=None):
     if semester_name:
@@ -432,6 +443,12 @@ def admin_panel(request):
         elif request.GET['content'] == 'pip':
             data = panel.pip_info()
             return render(request, 'coredata/admin_panel_tab.html', {'pip': data})
+        elif request.GET['content'] == 'archive_cache':
+            data = panel.archive_cache_info()
+            return render(request, 'coredata/admin_panel_tab.html', {'archive_cache': data})
+        elif request.GET['content'] == 'sims_cache':
+            data = panel.sims_cache_info()
+            return render(request, 'coredata/admin_panel_tab.html', {'sims_cache': data})
         elif request.GET['content'] == 'csrpt':
             data = panel.csrpt_info()
             return render(request, 'coredata/admin_panel_tab.html', {'csrpt': data})
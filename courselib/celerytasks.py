@@ -3,6 +3,7 @@ import datetime
 
 from django.conf import settings
 from celery import shared_task
+from celery.exceptions import Ignore, Retry
 
 from django.core.mail import mail_admins
 from functools import wraps
@@ -24,6 +25,10 @@ def task(*d_args, **d_kwargs):
             start = datetime.datetime.now()
             try:
                 res = f(*f_args, **f_kwargs)
+            except (Retry, Ignore) as e:
+                # task.retry() and task.replace(): not failures
+                log_data['exception'] = e.__class__.__name__
+                raise
             except Exception as e:
                 # email admins and re-raise
                 exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -35,6 +40,10 @@ def task(*d_args, **d_kwargs):
                 log_data['exception_message'] = str(e)
                 raise
             finally:
+                # the worker thread keeps going: give back any SIMS connection the task used
+                from coredata.queries import release_sims_connections
+                release_sims_connections()
+
                 # log the task
                 end = datetime.datetime.now()
                 task = f'{f.__module__}.{f.__name__}'
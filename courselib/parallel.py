@@ -0,0 +1,26 @@
+"""
+Run CPU-bound work (parsing, hashing) on many inputs in worker processes.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+PARALLEL_THRESHOLD = 20 # don't bother with worker processes for fewer items than this
+
+
+def process_map(func, items, processes=None, threshold=PARALLEL_THRESHOLD):
+    """
+    Like list(map(func, items)), but in a pool of worker processes if there are enough items to make it worthwhile.
+
+    func must be a module-level function and items picklable. Runs serially if processes is 1, or in a daemonic
+    process (like a Celery worker) since those can't start children.
+    """
+    items = list(items)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1 or len(items) < threshold or multiprocessing.current_process().daemon:
+        return [func(i) for i in items]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(func, items, chunksize=max(1, len(items) // (processes * 4))))
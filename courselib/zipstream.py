@@ -0,0 +1,154 @@
+"""
+Build a ZIP archive as it is sent to the browser, instead of in a temporary file first.
+
+ZipStream quacks enough like zipfile.ZipFile (write, writestr, close) that the submission components' add_to_zip
+methods can add themselves to it. Entries are only recorded when they are added: the archive is produced as the
+iterator from ZipStream.stream() is consumed (typically by a StreamingHttpResponse), so memory use is bounded by
+ZIP_STREAM_CHUNK and no temporary disk space is used, regardless of the size of the archive.
+"""
+
+from collections import deque
+import datetime
+import os
+import zipfile
+
+from django.http import StreamingHttpResponse
+
+ZIP_STREAM_CHUNK = 64*1024
+
+# formats that are already compressed: deflating them again costs CPU time and saves nothing
+STORED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jar', '.war',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.mp4', '.m4a', '.mov', '.avi', '.mkv', '.webm',
+}
+
+
+def compress_type_for(arcname):
+    """
+    The compression method for this file in the archive: stored if it's already compressed, else deflated.
+    """
+    _, ext = os.path.splitext(arcname)
+    if ext.lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    else:
+        return zipfile.ZIP_DEFLATED
+
+
+class _ZipBuffer(object):
+    """
+    Unseekable file-like object that collects what the ZipFile writes until it's drained into the response.
+
+    Because it can't seek, ZipFile writes sizes and CRCs in data descriptors after each entry (and switches to zip64
+    records as needed) rather than going back to fill them in.
+    """
+    def __init__(self):
+        self.data = []
+
+    def write(self, b):
+        self.data.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.data)
+        self.data = []
+        return data
+
+
+class ZipStream(object):
+    """
+    A ZIP archive whose entries are written as the archive is streamed.
+    """
+    def __init__(self):
+        self.entries = deque()
+
+    def write(self, filename, arcname=None, compress_type=None):
+        """
+        Add the file from disk. Like ZipFile.write, fails with OSError now if the file doesn't exist.
+        """
+        if arcname is None:
+            arcname = filename
+        os.stat(filename)
+        self.entries.append(('file', arcname, filename, compress_type))
+
+    def writestr(self, arcname, data, compress_type=None):
+        """
+        Add a file with this (str or bytes) content.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.entries.append(('data', arcname, data, compress_type))
+
+    def write_iter(self, arcname, chunks, compress_type=None):
+        """
+        Add a file whose contents are produced (as str or bytes) by this iterable while the archive is streamed.
+        """
+        self.entries.append(('iter', arcname, chunks, compress_type))
+
+    def write_later(self, func):
+        """
+        Call func(zipstream) when the archive gets to this point, so the entries it adds (and any database queries
+        needed to find them) don't delay the start of the response.
+        """
+        self.entries.append(('call', None, func, None))
+
+    def close(self):
+        pass
+
+    def stream(self):
+        """
+        Generate the bytes of the archive.
+        """
+        buf = _ZipBuffer()
+        z = zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        while self.entries:
+            kind, arcname, content, compress_type = self.entries.popleft()
+            if kind == 'call':
+                # entries added by func go here, not at the end
+                entries, self.entries = self.entries, deque()
+                content(self)
+                self.entries.extend(entries)
+                continue
+
+            if compress_type is None:
+                compress_type = compress_type_for(arcname)
+
+            if kind == 'file':
+                zinfo = zipfile.ZipInfo.from_file(content, arcname, strict_timestamps=False)
+                zinfo.compress_type = compress_type
+                with open(content, 'rb') as src, z.open(zinfo, 'w') as dest:
+                    while True:
+                        data = src.read(ZIP_STREAM_CHUNK)
+                        if not data:
+                            break
+                        dest.write(data)
+                        yield buf.drain()
+            else:
+                zinfo = zipfile.ZipInfo(arcname, date_time=datetime.datetime.now().timetuple()[:6])
+                zinfo.compress_type = compress_type
+                zinfo.external_attr = 0o600 << 16
+                chunks = [content] if kind == 'data' else content
+                # we don't know how big an iterable will be, so leave room for zip64 sizes
+                with z.open(zinfo, 'w', force_zip64=(kind == 'iter')) as dest:
+                    for data in chunks:
+                        if isinstance(data, str):
+                            data = data.encode('utf-8')
+                        dest.write(data)
+                        yield buf.drain()
+
+            yield buf.drain()
+
+        z.close()
+        yield buf.drain()
+
+    def response(self, filename):
+        """
+        A StreamingHttpResponse that sends the archive as filename.
+        """
+        response = StreamingHttpResponse((data for data in self.stream() if data), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (filename,)
+        return response
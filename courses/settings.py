@@ -1,6 +1,6 @@
 from django.conf import global_settings # Django defaults so we can modify them
 from django.urls import reverse_lazy
-import socket, sys, os
+import socket, sys, os, tempfile
 hostname = socket.gethostname()
 assert sys.version_info >= (3, 7)  # some logic assumes the insertion-ordered dicts from Python 3.7+
 
@@ -351,6 +351,9 @@ if USE_CELERY:
     }
 
 MAX_SUBMISSION_SIZE = 30000 # kB
+# local disk space for reusing activity submission ZIP files (a size of 0 disables the cache)
+ARCHIVE_CACHE_PATH = getattr(localsettings, 'ARCHIVE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'coursys_archive_cache'))
+ARCHIVE_CACHE_MAX_SIZE = getattr(localsettings, 'ARCHIVE_CACHE_MAX_SIZE', 10*1024*1024*1024) # bytes
 CAS_SERVER_URL = "https://cas.sfu.ca/cas/"
 CAS_VERSION = '3'
 CAS_LOGIN_MSG = None
@@ -366,9 +369,32 @@ SIMS_DB_NAME = getattr(localsettings, 'SIMS_DB_NAME', 'CSRPT')
 SIMS_USER = getattr(secrets, 'SIMS_USER', 'ggbaker')  # TODO: remove after DB2 transition
 SIMS_PASSWORD = getattr(secrets, 'SIMS_PASSWORD', '')  # TODO: remove after DB2 transition
 SIMS_DB_SCHEMA = "dbcsown"  # TODO: remove after DB2 transition
+# reporting database backend: 'mssql', 'db2', or 'sqlite' for the local stand-in (see coredata.sims_standin)
+SIMS_BACKEND = getattr(localsettings, 'SIMS_BACKEND', 'mssql')
+SIMS_STANDIN_DB = getattr(localsettings, 'SIMS_STANDIN_DB', 'file:coursys_sims_standin?mode=memory&cache=shared')
+SIMS_POOL_SIZE = getattr(localsettings, 'SIMS_POOL_SIZE', 4) # idle connections kept, per process
+SIMS_HEALTH_CHECK_AGE = getattr(localsettings, 'SIMS_HEALTH_CHECK_AGE', 300) # seconds idle before a connection is checked
+SIMS_CONNECT_RETRIES = getattr(localsettings, 'SIMS_CONNECT_RETRIES', 2)
+SIMS_RETRY_DELAY = getattr(localsettings, 'SIMS_RETRY_DELAY', 2) # seconds, doubling for each retry
+SIMS_SLOW_QUERY = getattr(localsettings, 'SIMS_SLOW_QUERY', 10) # seconds: log queries slower than this
+# caching of SIMS query results: see coredata.queries.SIMSResultCache
+SIMS_CACHE_LOCAL_SIZE = getattr(localsettings, 'SIMS_CACHE_LOCAL_SIZE', 1000) # results kept in each process
+SIMS_CACHE_LOCAL_SECONDS = getattr(localsettings, 'SIMS_CACHE_LOCAL_SECONDS', 60)
+SIMS_NEGATIVE_CACHE_SECONDS = getattr(localsettings, 'SIMS_NEGATIVE_CACHE_SECONDS', 600) # for empty results
+SIMS_CACHE_STALE_SECONDS = getattr(localsettings, 'SIMS_CACHE_STALE_SECONDS', 3600) # served while refreshing after expiry
+SIMS_CACHE_LOCK_WAIT = getattr(localsettings, 'SIMS_CACHE_LOCK_WAIT', 30) # seconds to wait for another caller's query
+SIMS_CACHE_STATS_FLUSH = getattr(localsettings, 'SIMS_CACHE_STATS_FLUSH', 10) # seconds between updates of the totals
+# the offering import: see coredata.tasks.get_import_offerings_tasks
+OFFERING_IMPORT_LANES = getattr(localsettings, 'OFFERING_IMPORT_LANES', 4) # groups imported in parallel
+OFFERING_IMPORT_GROUP_SIZE = getattr(localsettings, 'OFFERING_IMPORT_GROUP_SIZE', 10) # offerings per group...
+OFFERING_IMPORT_GROUP_WEIGHT = getattr(localsettings, 'OFFERING_IMPORT_GROUP_WEIGHT', 1000) # ... and roughly students per group
+OFFERING_IMPORT_RETRIES = getattr(localsettings, 'OFFERING_IMPORT_RETRIES', 2)
+OFFERING_IMPORT_RETRY_DELAY = getattr(localsettings, 'OFFERING_IMPORT_RETRY_DELAY', 300) # seconds, times the attempt number
 
 EMPLID_API_SECRET = getattr(secrets, 'EMPLID_API_SECRET', '')
 MOSS_DISTRIBUTION_PATH = getattr(localsettings, 'MOSS_DISTRIBUTION_PATH', None)
+# parsed MOSS reports, so re-running the same report doesn't mean parsing its HTML again
+MOSS_REPORT_CACHE_PATH = getattr(localsettings, 'MOSS_REPORT_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'coursys_moss_cache'))
 SERVER_MESSAGE_INDEX = getattr(localsettings, 'SERVER_MESSAGE_INDEX', '')
 SERVER_MESSAGE = getattr(localsettings, 'SERVER_MESSAGE', '')
 
@@ -3,7 +3,7 @@ from coredata.models import Person, CourseOffering, Member
 from django.utils.safestring import mark_safe
 from pytz import timezone
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.urls import reverse
 from autoslug.settings import slugify
 from courselib.json_fields import JSONField, config_property
@@ -28,6 +28,9 @@ def new_feed_token():
     return "%032x" % (n)
 
 
+NEWSITEM_BATCH_SIZE = 500 # news items inserted and emailed at once by NewsItem.bulk_create_and_email
+
+
 class NewsItem(models.Model):
     """
     Class representing a news item for a particular user.
@@ -59,12 +62,37 @@ class NewsItem(models.Model):
 
         # see if this user wants news by email
         ucs = UserConfig.objects.filter(user=self.user, key="newsitems")
-        if ucs and 'email' in ucs[0].value and not ucs[0].value['email']:
-            # user has requested no email
-            pass
-        else:
+        if NewsItem._wants_email(ucs[0] if ucs else None):
             self.email_user()
 
+    @staticmethod
+    def _wants_email(userconfig):
+        """
+        Does the user with this "newsitems" UserConfig (or None) want news items by email?
+        """
+        return not (userconfig and 'email' in userconfig.value and not userconfig.value['email'])
+
+    @classmethod
+    def bulk_create_and_email(cls, items, progress=None):
+        """
+        Save many NewsItems and send the emails for them, as NewsItem.save would but in batches of
+        NEWSITEM_BATCH_SIZE: one bulk insert and one batch of emails (over a single mail connection) per batch, with
+        the users' email preferences fetched in a single query.
+
+        progress(done, total) is called after each batch, if given.
+        """
+        configs = dict((uc.user_id, uc) for uc
+                       in UserConfig.objects.filter(user__in=set(n.user_id for n in items), key="newsitems"))
+        connection = get_connection()
+        total = len(items)
+        for start in range(0, total, NEWSITEM_BATCH_SIZE):
+            batch = items[start:start+NEWSITEM_BATCH_SIZE]
+            NewsItem.objects.bulk_create(batch)
+            messages = [n.email_message() for n in batch if NewsItem._wants_email(configs.get(n.user_id))]
+            connection.send_messages([m for m in messages if m])
+            if progress:
+                progress(start + len(batch), total)
+
     def email_from(self):
         """
         Determine who the email should appear to come from: perfer to use course contact email if exists.
@@ -94,8 +122,16 @@ class NewsItem(models.Model):
         """
         Email this news item to the user.
         """
+        msg = self.email_message()
+        if msg:
+            msg.send()
+
+    def email_message(self):
+        """
+        The email for this news item, or None if the user has no email address.
+        """
         if not self.user.email():
-            return
+            return None
 
         headers = {
                 'Precedence': 'bulk',
@@ -134,7 +170,7 @@ class NewsItem(models.Model):
         
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to_email], headers=headers)
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
+        return msg
         
     def content_xhtml(self):
         """
@@ -177,15 +213,17 @@ class NewsItem(models.Model):
         newsitem_kwargs.
         """
         # randomize order in the hopes of throwing off any spam filters
-        members = Member.objects.exclude(role="DROP").exclude(role="APPR").filter(**member_kwargs)
+        members = Member.objects.exclude(role="DROP").exclude(role="APPR").filter(**member_kwargs).select_related("person")
         members = list(members)
         random.shuffle(members)
 
         markup = newsitem_kwargs.pop('markup', 'textile')
+        items = []
         for m in members:
             n = NewsItem(user=m.person, **newsitem_kwargs)
             n.markup = markup
-            n.save()
+            items.append(n)
+        NewsItem.bulk_create_and_email(items)
 
 
 class UserConfig(models.Model):
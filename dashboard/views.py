@@ -75,9 +75,8 @@ def index_full(request):
     userid = request.user.username
     memberships = Member.objects.exclude(role="DROP").exclude(offering__component="CAN") \
             .filter(offering__graded=True, person__userid=userid).order_by('offering__semester', 'offering') \
-            .annotate(num_activities=Count('offering__activity')) \
+            .filter(Q(role__in=['TA', 'INST', 'APPR']) | Q(offering__activity_count__gt=0)) \
             .select_related('offering','offering__semester')
-    memberships = [m for m in memberships if m.role in ['TA', 'INST', 'APPR'] or m.num_activities>0]
 
     context = {'memberships': memberships}
     return render(request, "dashboard/index_full.html", context)
@@ -86,6 +86,5 @@ def import_grad_group(emplids):
     """
     Import grad Person information for this collection of emplids.
     """
-    from coredata.importer import get_person_grad
-    for emplid in emplids:
-        get_person_grad(emplid)
+    from coredata.importer import get_people
+    get_people(emplids, grad_data=True)
@@ -3,7 +3,7 @@ from courselib.auth import ForbiddenResponse, NotFoundResponse
 from django.shortcuts import render
 from grad.models import Promise, OtherFunding, GradStatus, Scholarship, \
         GradProgramHistory, FinancialComment, STATUS_ACTIVE
-from coredata.models import Semester
+from coredata.models import Semester, semester_index
 from ta.models import TAContract, TACourse, STATUSES_NOT_TAING
 from tacontracts.models import TAContract as NewTAContract
 from ra.models import RAAppointment, RARequest
@@ -64,7 +64,7 @@ def financials(request, grad_slug, style='complete'):
     latest_semester = max(all_semesters)
 
     semesters = []
-    semesters_qs = Semester.objects.filter(start__gte=earliest_semester.start, end__lte=latest_semester.end).order_by('-start')
+    semesters_qs = reversed(semester_index().between(earliest_semester.start, latest_semester.end))
     current_acad_year = None
 
     # build data structure with funding for each semester
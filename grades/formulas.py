@@ -10,10 +10,14 @@
 #   act_dict = activities_dictionary(activities)        
 # then pass it into the evaluator along with a Member object for the student:
 #   result = eval_parse(parsed_expr, act_dict, member, visible)
+# or, to calculate for many students at once, compile the tree once and evaluate it over a preloaded grade matrix:
+#   formula = CompiledFormula(parsed_expr, activity, act_dict, visible)
+#   matrix = load_grade_matrix(formula.activities.values(), members)
+#   results = {m.id: formula(matrix.get(m.id, {})) for m in members}
 
 from pyparsing import ParseException
 import itertools
-from grades.models import NumericActivity
+from grades.models import NumericActivity, NumericGrade
 
 class EvalException(Exception):
     pass
@@ -280,6 +284,154 @@ def eval_parse(tree, activity, act_dict, member, visible):
         raise EvalException("Unknown element in parse tree: %s" % (tree,))
     
 
+def load_grade_matrix(activities, members=None):
+    """
+    Load the numeric grades for these activities in one query, as a dictionary of member.id -> {activity.id: value}.
+
+    "No grade" values are left out of the matrix: like missing grades, they are treated as 0.0 when evaluating.
+    """
+    grades = NumericGrade.objects.filter(activity__in=list(activities)).exclude(flag='NOGR')
+    if members is not None:
+        grades = grades.filter(member__in=list(members))
+
+    matrix = {}
+    for member_id, activity_id, value in grades.values_list('member_id', 'activity_id', 'value'):
+        matrix.setdefault(member_id, {})[activity_id] = float(value)
+    return matrix
+
+
+class CompiledFormula(object):
+    """
+    A formula parse tree compiled into nested closures, so it can be evaluated for many members without walking the
+    tree (or querying for grades) each time.
+
+    Evaluate by calling with a member's row from load_grade_matrix: the semantics are exactly those of eval_parse.
+
+    Throws KeyError for unknown column (when compiling, not evaluating).
+    """
+    def __init__(self, tree, activity, act_dict, visible):
+        self.activity = activity
+        self.act_dict = act_dict
+        self.visible = visible
+        self.calculating_leak = activity.calculation_leak()
+        self.activities = {} # activity.id -> activity for every activity whose grades are needed
+        self.evaluate = self._compile(tree)
+
+    def __call__(self, row):
+        return self.evaluate(row)
+
+    def _grade_getter(self, act):
+        """
+        Compiled equivalent of visible_grade for this activity.
+        """
+        if not self.calculating_leak and self.visible and act.status != 'RLS':
+            return lambda row: 0.0
+        self.activities[act.id] = act
+        act_id = act.id
+        return lambda row: row.get(act_id, 0.0)
+
+    def _compile(self, tree):
+        t = tree[0]
+        if t == 'sign' and tree[2] == '+':
+            return self._compile(tree[3])
+        elif t == 'sign' and tree[2] == '-':
+            f = self._compile(tree[3])
+            return lambda row: -f(row)
+        elif t == 'col':
+            act = self.act_dict[tree[2]]
+            part = tree[3]
+            if part == "val":
+                return self._grade_getter(act)
+            elif part == "max":
+                max_grade = float(act.max_grade)
+                return lambda row: max_grade
+            elif part == "per":
+                percent = float(act.percent) if act.percent else 0.0
+                return lambda row: percent
+            elif part == "fin":
+                max_grade = float(act.max_grade)
+                if not act.percent or not max_grade:
+                    return lambda row: 0.0
+                scale = float(act.percent)
+                grade = self._grade_getter(act)
+                return lambda row: grade(row)/max_grade * scale
+
+        elif t == 'num':
+            value = tree[2]
+            return lambda row: value
+        elif t == 'expr':
+            first = self._compile(tree[2])
+            ops = []
+            for operator, operand in zip(tree[3::2], tree[4::2]):
+                if operator not in ["+", "-", "*", "/"]:
+                    raise EvalException("Unknown operator in parse tree: %s"%(operator,))
+                ops.append((operator, self._compile(operand)))
+
+            def evaluate_expr(row):
+                val = first(row)
+                for operator, operand in ops:
+                    o = operand(row)
+                    if operator == "+":
+                        val += o
+                    elif operator == "-":
+                        val -= o
+                    elif operator == "*":
+                        val *= o
+                    elif o == 0:
+                        val = 0.0
+                    else:
+                        val /= o
+                return val
+            return evaluate_expr
+
+        elif t == 'func':
+            func = tree[2]
+            args = [self._compile(a) for a in tree[3:]]
+            if func == 'SUM':
+                return lambda row: sum(a(row) for a in args)
+            elif func == 'MAX':
+                return lambda row: max(a(row) for a in args)
+            elif func == 'MIN':
+                return lambda row: min(a(row) for a in args)
+            elif func == 'COUNT':
+                return lambda row: sum(1 for a in args if a(row) > 0.0)
+            elif func == 'AVG':
+                if not args:
+                    return lambda row: 0
+                return lambda row: sum(a(row) for a in args) / len(args)
+            elif func == 'BEST':
+                best_n, marks = args[0], args[1:]
+                def evaluate_best(row):
+                    # round first argument to an int: it's the number of best items to pick
+                    n = int(round(best_n(row)) + 0.1)
+                    if n < 1:
+                        raise EvalException('Bad number of "best" selected, %i.'%(n,))
+                    if n > len(marks):
+                        raise EvalException("Not enough arguments to choose %i best."%(n,))
+                    values = sorted(m(row) for m in marks)
+                    return sum(values[-n:])
+                return evaluate_best
+            else:
+                raise EvalException("Unknown function in parse tree: %s"%(func,))
+
+        elif t == 'flag':
+            flag = tree[2]
+            if flag == 'activitytotal':
+                # total [activity.final] for all activities
+                fix_used_acts(tree, self.activity.offering, self.activity)
+                parts = []
+                for label in tree[1]:
+                    act = self.act_dict[label]
+                    max_grade = float(act.max_grade)
+                    if max_grade:
+                        parts.append((self._grade_getter(act), max_grade, float(act.percent)))
+                return lambda row: sum(grade(row)/max_grade * percent for grade, max_grade, percent in parts)
+            else:
+                raise EvalException("Unknown flag in parse tree: %s" % (flag,))
+        else:
+            raise EvalException("Unknown element in parse tree: %s" % (tree,))
+
+
 def create_display(tree, act_dict):
     if isinstance(tree, str):
         return str(tree)
@@ -0,0 +1,237 @@
+"""
+A compact, cached copy of every grade in an offering, for the views that display or export the whole gradebook.
+
+The matrix is built with one query per grade type and cached under the offering's grade_version, which is bumped
+whenever a grade, activity or member in the offering is saved, so it never needs explicit invalidation.
+"""
+
+from array import array
+import decimal
+import pickle
+import zlib
+
+from django.core.cache import cache
+
+from coredata.models import Person, Member
+from grades.models import NumericGrade, LetterGrade, FLAG_CHOICES, FLAGS, LETTER_GRADE_CHOICES, grade_version, \
+    all_activities_filter
+
+GRADEBOOK_CACHE_TIMEOUT = 86400
+GRADEBOOK_EXPORT_CHUNK = 500 # students whose grades are fetched at once by gradebook_rows
+
+# small integer codes for flags and letters. Code 0 means "no grade record".
+_FLAG_CODES = [None] + [f for f, _ in FLAG_CHOICES]
+_FLAG_CODE = dict((f, i) for i, f in enumerate(_FLAG_CODES))
+_LETTER_CODES = [None] + [l for l, _ in LETTER_GRADE_CHOICES]
+_LETTER_CODE = dict((l, i) for i, l in enumerate(_LETTER_CODES))
+
+
+class GradebookCell(object):
+    """
+    One grade from the matrix: quacks enough like a NumericGrade/LetterGrade for the select_grade template tag.
+    """
+    def __init__(self, numeric, value, letter_grade, flag, comment):
+        self.numeric = numeric
+        self.value = value
+        self.letter_grade = letter_grade
+        self.flag = flag
+        self.comment = comment
+
+    @property
+    def grade(self):
+        return self.value if self.numeric else self.letter_grade
+
+    def get_flag_display(self):
+        return FLAGS[self.flag]
+
+    def display_staff_short(self):
+        if self.numeric:
+            if self.flag == 'NOGR':
+                return ''
+            else:
+                return "%.1f" % (self.value)
+        else:
+            if self.flag == 'NOGR':
+                return '\u2014'
+            else:
+                return "%s" % (self.letter_grade)
+
+    def export_value(self):
+        """
+        The grade as it appears in the CSV export.
+        """
+        if self.flag == 'NOGR':
+            return ''
+        elif self.numeric:
+            return self.value
+        else:
+            return self.letter_grade
+
+
+class GradebookMatrix(object):
+    """
+    Every grade in an offering, as member_ids x activity_ids arrays (row-major by member).
+
+    Numeric values are stored as integer hundredths (matching NumericGrade.value's two decimal places); flags and
+    letters as one-byte codes. Comments are rare, so they are kept in a dict keyed by cell index.
+    """
+    def __init__(self, member_ids, activity_ids):
+        self.member_ids = array('l', member_ids)
+        self.activity_ids = array('l', activity_ids)
+        self._member_index = dict((m, i) for i, m in enumerate(self.member_ids))
+        self._activity_index = dict((a, j) for j, a in enumerate(self.activity_ids))
+        cells = len(self.member_ids) * len(self.activity_ids)
+        self.values = array('i', bytes(array('i').itemsize * cells))
+        self.flags = bytearray(cells)
+        self.letters = bytearray(cells)
+        self.comments = {}
+
+    def _cell(self, member_id, activity_id):
+        return self._member_index[member_id] * len(self.activity_ids) + self._activity_index[activity_id]
+
+    @classmethod
+    def build(cls, offering, member_ids=None):
+        """
+        Build the matrix from the database: for only the given members, if member_ids is given.
+        """
+        numeric = NumericGrade.objects.filter(activity__offering=offering)
+        letter = LetterGrade.objects.filter(activity__offering=offering)
+        if member_ids is not None:
+            numeric = numeric.filter(member_id__in=member_ids)
+            letter = letter.filter(member_id__in=member_ids)
+        numeric = list(numeric.values_list('member_id', 'activity_id', 'value', 'flag', 'comment'))
+        letter = list(letter.values_list('member_id', 'activity_id', 'letter_grade', 'flag', 'comment'))
+
+        member_ids = sorted(set(g[0] for g in numeric) | set(g[0] for g in letter))
+        activity_ids = sorted(set(g[1] for g in numeric) | set(g[1] for g in letter))
+        matrix = cls(member_ids, activity_ids)
+        for member_id, activity_id, value, flag, comment in numeric:
+            i = matrix._cell(member_id, activity_id)
+            matrix.values[i] = int(value * 100)
+            matrix.flags[i] = _FLAG_CODE[flag]
+            if comment:
+                matrix.comments[i] = comment
+        for member_id, activity_id, letter_grade, flag, comment in letter:
+            i = matrix._cell(member_id, activity_id)
+            matrix.letters[i] = _LETTER_CODE[letter_grade]
+            matrix.flags[i] = _FLAG_CODE[flag]
+            if comment:
+                matrix.comments[i] = comment
+        return matrix
+
+    @staticmethod
+    def _cache_key(offering):
+        return 'gradebook-%i-%s' % (offering.id, grade_version(offering.id))
+
+    @classmethod
+    def cached(cls, offering):
+        """
+        The matrix for this offering if it's in the cache, else None.
+        """
+        data = cache.get(cls._cache_key(offering))
+        if data is not None:
+            return cls.loads(data)
+        return None
+
+    @classmethod
+    def for_offering(cls, offering):
+        """
+        The matrix for this offering, from the cache if it's there.
+        """
+        # the key from before the build: if a grade changes while we build, this matrix is already out of date
+        key = cls._cache_key(offering)
+        data = cache.get(key)
+        if data is not None:
+            return cls.loads(data)
+
+        matrix = cls.build(offering)
+        cache.set(key, matrix.dumps(), GRADEBOOK_CACHE_TIMEOUT)
+        return matrix
+
+    def dumps(self):
+        # compressed: most cells in a large offering are similar, and memcached limits values to 1MB
+        return zlib.compress(pickle.dumps(
+            (self.member_ids, self.activity_ids, self.values, self.flags, self.letters, self.comments),
+            pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def loads(cls, data):
+        member_ids, activity_ids, values, flags, letters, comments = pickle.loads(zlib.decompress(data))
+        matrix = cls(member_ids, activity_ids)
+        matrix.values, matrix.flags, matrix.letters, matrix.comments = values, flags, letters, comments
+        return matrix
+
+    def get(self, member_id, activity_id):
+        """
+        The GradebookCell for this member and activity, or None if there is no grade record.
+        """
+        try:
+            i = self._cell(member_id, activity_id)
+        except KeyError:
+            return None
+        flag = self.flags[i]
+        if flag == 0:
+            return None
+        letter = self.letters[i]
+        if letter:
+            return GradebookCell(False, None, _LETTER_CODES[letter], _FLAG_CODES[flag], self.comments.get(i))
+        else:
+            value = decimal.Decimal(self.values[i]).scaleb(-2)
+            return GradebookCell(True, value, None, _FLAG_CODES[flag], self.comments.get(i))
+
+    def grades_by_slug(self, activities, members):
+        """
+        The {activity.slug: {userid: grade}} structure the all_grades template expects.
+        """
+        grades = {}
+        for a in activities:
+            grades[a.slug] = {}
+            for m in members:
+                g = self.get(m.id, a.id)
+                if g is not None:
+                    grades[a.slug][m.person.userid] = g
+        return grades
+
+
+def gradebook_rows(offering):
+    """
+    Generate the rows of the all-grades export: a header row, then one row per student.
+
+    Students are read with a server-side cursor and their grades fetched GRADEBOOK_EXPORT_CHUNK students at a time
+    (unless the whole matrix is already cached), so memory use doesn't grow with the size of the offering.
+    """
+    activities = all_activities_filter(offering=offering)
+    labtut = offering.labtut
+    matrix = GradebookMatrix.cached(offering)
+
+    row = ['Last name', 'First name', Person.userid_header(), Person.emplid_header()]
+    if labtut:
+        row.append('Lab/Tutorial')
+    for a in activities:
+        row.append(a.short_name)
+    yield row
+
+    students = Member.objects.filter(offering=offering, role="STUD").select_related('person')
+    chunk = []
+    for s in students.iterator(chunk_size=GRADEBOOK_EXPORT_CHUNK):
+        chunk.append(s)
+        if len(chunk) == GRADEBOOK_EXPORT_CHUNK:
+            yield from _gradebook_chunk_rows(offering, matrix, activities, labtut, chunk)
+            chunk = []
+    yield from _gradebook_chunk_rows(offering, matrix, activities, labtut, chunk)
+
+
+def _gradebook_chunk_rows(offering, matrix, activities, labtut, students):
+    if not students:
+        return
+    if matrix is None:
+        matrix = GradebookMatrix.build(offering, member_ids=[s.id for s in students])
+
+    for s in students:
+        row = [s.person.last_name, s.person.first_name, s.person.userid, s.person.emplid]
+        if labtut:
+            row.append(s.labtut_section or '')
+        for a in activities:
+            gr = matrix.get(s.id, a.id)
+            row.append(gr.export_value() if gr else '')
+        yield row
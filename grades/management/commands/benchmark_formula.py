@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from coredata.models import Member
+from grades.formulas import parse, activities_dictionary, eval_parse, CompiledFormula, load_grade_matrix
+from grades.models import NumericActivity, CalNumericActivity
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-member formula evaluator with the compiled, matrix-based one for a calculated activity. ' \
+           'Nothing is saved.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_slug', type=str, help='slug of the course offering')
+        parser.add_argument('activity_slug', type=str, help='slug of the calculated numeric activity')
+
+    def _time(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            res = func()
+            elapsed = time.time() - start
+        return res, elapsed, len(queries)
+
+    def handle(self, *args, **options):
+        try:
+            activity = CalNumericActivity.objects.get(offering__slug=options['course_slug'],
+                                                      slug=options['activity_slug'], deleted=False)
+        except CalNumericActivity.DoesNotExist:
+            raise CommandError('No such calculated numeric activity.')
+
+        course = activity.offering
+        act_dict = activities_dictionary(NumericActivity.objects.filter(offering=course, deleted=False))
+        students = list(Member.objects.filter(offering=course, role='STUD'))
+        visible = activity.status == 'RLS'
+
+        def tree_walk():
+            tree = parse(activity.formula, course, activity)
+            return {s.id: eval_parse(tree, activity, act_dict, s, visible) for s in students}
+
+        def compiled():
+            tree = parse(activity.formula, course, activity)
+            formula = CompiledFormula(tree, activity, act_dict, visible)
+            matrix = load_grade_matrix(formula.activities.values())
+            return {s.id: formula(matrix.get(s.id, {})) for s in students}
+
+        old_res, old_time, old_queries = self._time(tree_walk)
+        new_res, new_time, new_queries = self._time(compiled)
+
+        mismatches = [mid for mid in old_res if abs(old_res[mid] - new_res[mid]) > 1e-9]
+        self.stdout.write('%i students, formula %r' % (len(students), activity.formula))
+        self.stdout.write('  eval_parse:      %8.3f s, %6i queries' % (old_time, old_queries))
+        self.stdout.write('  CompiledFormula: %8.3f s, %6i queries' % (new_time, new_queries))
+        if mismatches:
+            raise CommandError('Results differ for %i students.' % (len(mismatches),))
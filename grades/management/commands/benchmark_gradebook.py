@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from coredata.devtest_data_generator import create_benchmark_offering
+from coredata.models import Member
+from grades.gradebook import GradebookMatrix
+from grades.models import all_activities_filter
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Build a large fake offering and compare loading all of its grades from the ORM with the cached ' \
+           'GradebookMatrix. Everything is created in a transaction that is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=2000, dest='students')
+        parser.add_argument('--activities', type=int, default=60, dest='activities')
+
+    def _time(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            res = func()
+            elapsed = time.time() - start
+        return res, elapsed, len(queries)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                offering = create_benchmark_offering(students=options['students'],
+                                                     numeric_activities=options['activities'], calculated_activities=0)
+                self._benchmark(offering)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def _benchmark(self, offering):
+        activities = all_activities_filter(offering=offering)
+        students = list(Member.objects.filter(offering=offering, role='STUD').select_related('person'))
+
+        def orm():
+            # the way the all-grades views used to collect the grades
+            grades = {}
+            for a in activities:
+                grades[a.slug] = {}
+                gs = a.numericgrade_set.all().select_related('member', 'member__person')
+                for g in gs:
+                    grades[a.slug][g.member.person.userid] = g
+            return grades
+
+        def matrix():
+            return GradebookMatrix.for_offering(offering).grades_by_slug(activities, students)
+
+        _, orm_time, orm_queries = self._time(orm)
+        _, build_time, build_queries = self._time(matrix) # cache miss: builds
+        _, cached_time, cached_queries = self._time(matrix)
+        size = len(GradebookMatrix.build(offering).dumps())
+
+        self.stdout.write('%i students x %i activities' % (len(students), len(activities)))
+        self.stdout.write('  ORM:             %8.3f s, %6i queries' % (orm_time, orm_queries))
+        self.stdout.write('  matrix (build):  %8.3f s, %6i queries' % (build_time, build_queries))
+        self.stdout.write('  matrix (cached): %8.3f s, %6i queries' % (cached_time, cached_queries))
+        self.stdout.write('  cached size:     %8i bytes' % (size,))
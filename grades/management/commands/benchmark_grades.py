@@ -0,0 +1,151 @@
+import json
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from coredata.devtest_data_generator import create_benchmark_offering
+from coredata.models import Member
+from grades import views as grades_views
+from grades.models import ActivityStats, all_activities_filter, NumericActivity, CalNumericActivity, \
+    CalLetterActivity, bump_grade_version
+from grades.utils import calculate_numeric_grade, calculate_letter_grade, generate_numeric_activity_stat
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Create a large fake offering (in a transaction that is rolled back) and time the hot paths of the ' \
+           'grades code on it. Writes a JSON report of wall time, query count and peak memory for each.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=1000, dest='students')
+        parser.add_argument('--numeric', type=int, default=20, dest='numeric',
+                            help='number of numeric activities')
+        parser.add_argument('--calculated', type=int, default=3, dest='calculated',
+                            help='number of calculated numeric activities')
+        parser.add_argument('--seed', type=int, default=0, dest='seed')
+        parser.add_argument('--output', type=str, dest='output', help='file for the JSON report (default stdout)')
+
+    def _measure(self, name, func):
+        """
+        Run func, recording its wall time, number of queries and peak memory allocated.
+        """
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result = {'name': name, 'seconds': round(elapsed, 4), 'queries': len(queries), 'peak_memory_bytes': peak}
+        self.stderr.write('%-40s %9.3f s %7i queries %12i bytes' % (name, elapsed, len(queries), peak))
+        return result
+
+    def _view(self, view, url_name, offering, instructor):
+        def request():
+            req = self.factory.get(reverse(url_name, kwargs={'course_slug': offering.slug}))
+            req.user = User.objects.get_or_create(username=instructor.person.userid)[0]
+            resp = view(req, course_slug=offering.slug)
+            assert resp.status_code == 200, resp.status_code
+            # streaming responses do their work as they're consumed
+            for _ in (resp.streaming_content if resp.streaming else [resp.content]):
+                pass
+        return request
+
+    def _api(self, view_class, serializer_class, offering, member):
+        def request():
+            view = view_class()
+            view.offering = offering
+            view.member = member
+            serializer_class(view.get_queryset(), many=True, context={'view': view}).data
+        return request
+
+    def _benchmark(self, offering):
+        instructor = Member.objects.select_related('person').get(offering=offering, role='INST')
+        student = Member.objects.filter(offering=offering, role='STUD').first()
+        calculated = list(CalNumericActivity.objects.filter(offering=offering).order_by('position'))
+        letter = CalLetterActivity.objects.get(offering=offering)
+        numeric = NumericActivity.objects.filter(offering=offering).exclude(id__in=[c.id for c in calculated]).first()
+
+        def calculate_all():
+            for a in calculated:
+                calculate_numeric_grade(offering, a)
+
+        def stats_cold():
+            ActivityStats.objects.filter(activity__offering=offering).delete()
+            generate_numeric_activity_stat(numeric, 'INST')
+
+        def csv_cold():
+            bump_grade_version(offering.id)
+            self._view(grades_views.all_grades_csv, 'offering:all_grades_csv', offering, instructor)()
+
+        results = [
+            self._measure('calculate_numeric_grade', calculate_all),
+            self._measure('calculate_letter_grade', lambda: calculate_letter_grade(offering, letter)),
+            self._measure('generate_numeric_activity_stat (cold)', stats_cold),
+            self._measure('generate_numeric_activity_stat (warm)',
+                          lambda: generate_numeric_activity_stat(numeric, 'INST')),
+            self._measure('all_grades_csv', csv_cold),
+            self._measure('export_all',
+                          self._view(grades_views.export_all, 'offering:export_all', offering, instructor)),
+        ]
+
+        try:
+            from grades.api_views import OfferingActivities, OfferingStats, OfferingStudents
+            from grades.serializers import ActivitySerializer, StatsSerializer, StudentSerializer
+        except ImportError:
+            # djangorestframework isn't currently in requirements.txt
+            self.stderr.write('rest_framework not installed: skipping API views')
+            return results
+
+        results.extend([
+            self._measure('api OfferingActivities',
+                          self._api(OfferingActivities, ActivitySerializer, offering, instructor)),
+            self._measure('api OfferingStats (instructor)',
+                          self._api(OfferingStats, StatsSerializer, offering, instructor)),
+            self._measure('api OfferingStats (student)', self._api(OfferingStats, StatsSerializer, offering, student)),
+            self._measure('api OfferingStudents', self._api(OfferingStudents, StudentSerializer, offering, instructor)),
+        ])
+        return results
+
+    def handle(self, *args, **options):
+        self.factory = RequestFactory()
+        report = {
+            'database': connection.vendor,
+            'students': options['students'],
+            'numeric_activities': options['numeric'],
+            'calculated_activities': options['calculated'],
+            'seed': options['seed'],
+        }
+
+        try:
+            with transaction.atomic():
+                start = time.perf_counter()
+                offering = create_benchmark_offering(students=options['students'],
+                                                     numeric_activities=options['numeric'],
+                                                     calculated_activities=options['calculated'],
+                                                     seed=options['seed'])
+                report['setup_seconds'] = round(time.perf_counter() - start, 4)
+                report['activities'] = len(all_activities_filter(offering))
+                report['results'] = self._benchmark(offering)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        data = json.dumps(report, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+        else:
+            self.stdout.write(data)
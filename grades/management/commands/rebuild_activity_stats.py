@@ -0,0 +1,57 @@
+import decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from grades.models import Activity, NumericActivity, LetterActivity, ActivityStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored activity grade statistics, or check them against the grades with --verify.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offering', type=str, dest='offering', help='slug of the course offering to limit to')
+        parser.add_argument('--verify', action='store_true', dest='verify',
+                            help='check the stored stats without changing them')
+
+    def _activities(self, offering_slug):
+        activities = Activity.objects.filter(deleted=False).select_related('offering')
+        if offering_slug:
+            activities = activities.filter(offering__slug=offering_slug)
+        for a in activities:
+            # get the NumericActivity/LetterActivity subclass instance
+            try:
+                yield a.numericactivity
+            except NumericActivity.DoesNotExist:
+                try:
+                    yield a.letteractivity
+                except LetterActivity.DoesNotExist:
+                    pass
+
+    def handle(self, *args, **options):
+        verify = options['verify']
+        bad = 0
+        count = 0
+        for activity in self._activities(options['offering']):
+            count += 1
+            built = ActivityStats.build(activity)
+            if verify:
+                try:
+                    stored = ActivityStats.objects.get(activity_id=activity.id)
+                except ActivityStats.DoesNotExist:
+                    continue
+                if (stored.count, decimal.Decimal(stored.total), decimal.Decimal(stored.sum_squares), stored.config) \
+                        != (built.count, built.total, built.sum_squares, built.config):
+                    bad += 1
+                    self.stdout.write('Stats for %s (id %i) out of date.' % (activity, activity.id))
+            else:
+                with transaction.atomic():
+                    ActivityStats.objects.filter(activity_id=activity.id).delete()
+                    built.save()
+
+        if verify:
+            self.stdout.write('%i activities checked.' % (count,))
+            if bad:
+                raise CommandError('%i activities have incorrect stats.' % (bad,))
+        else:
+            self.stdout.write('Stats rebuilt for %i activities.' % (count,))
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:30
+
+import courselib.json_fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grades', '0005_on_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=4, default=0, max_digits=24)),
+                ('sum_squares', models.DecimalField(decimal_places=4, default=0, max_digits=24)),
+                ('config', courselib.json_fields.JSONField(default=dict)),
+                ('activity', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, related_name='grade_stats', to='grades.activity')),
+            ],
+        ),
+    ]
@@ -1,16 +1,17 @@
-from django.db import models
+from django.db import models, IntegrityError
 from autoslug import AutoSlugField
 from coredata.models import Member, CourseOffering, Person
 from dashboard.models import NewsItem
 from django.db import transaction
 from django.db.models import Count
+from django.core.cache import cache
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from datetime import datetime, timedelta, date
 from courselib.json_fields import JSONField
 from courselib.json_fields import getter_setter
 from courselib.slugs import make_slug
-import decimal, json
+import decimal, json, math, uuid
 
 COMMENT_LENGTH = 5000
 
@@ -135,16 +136,31 @@ class Activity(models.Model):
         
         super(Activity, self).save(*args, **kwargs)
 
+        if not old or (old.status, old.deleted, old.offering_id) != (self.status, self.deleted, self.offering_id):
+            # the number of visible activities may have changed
+            CourseOffering.update_content_counts(self.offering_id)
+            if old and old.offering_id != self.offering_id:
+                CourseOffering.update_content_counts(old.offering_id)
+
+        # formulas and activities used by calculations may have changed
+        from grades.utils import invalidate_dependency_graph
+        invalidate_dependency_graph(self.offering_id)
+        # max_grade may have changed, which moves grades between histogram buckets
+        ActivityStats.invalidate(activity_ids=[self.id])
+
         if newsitem and old and self.status == 'RLS' and old != None and old.status != 'RLS':
             from grades.tasks import send_grade_released_news, create_grade_released_history
 
+            # identifies this release, so the tasks can be safely retried
+            released_at = datetime.now().isoformat()
+
             # newly-released grades: record that grade was released
             assert entered_by
             entered_by = get_entry_person(entered_by)
-            create_grade_released_history(self.id, entered_by.id)
+            create_grade_released_history(self.id, entered_by.id, released_at)
 
             # newly-released grades: create news items
-            send_grade_released_news(self.id)
+            send_grade_released_news(self.id, released_at)
 
         if old and old.group and not self.group:
             # activity changed group -> individual. Clean out any group memberships
@@ -565,7 +581,12 @@ class NumericGrade(models.Model):
             # make sure "no grade" values have a zero: just in case the value is used in some other calc
             self.value = 0
 
-        super(NumericGrade, self).save()
+        with transaction.atomic():
+            # lock the row so a concurrent save can't apply its stats change against the same old value
+            old = NumericGrade.objects.select_for_update().filter(id=self.id).values_list('value', 'flag').first() \
+                if self.id else None
+            super(NumericGrade, self).save()
+            ActivityStats.grades_changed(self.activity, [(self.member, old, (self.value, self.flag))])
 
         entered_by = get_entry_person(entered_by)
         if bool(mark) and not mark.id:
@@ -575,6 +596,11 @@ class NumericGrade(models.Model):
             gh = GradeHistory(activity=self.activity, member=self.member, entered_by=entered_by, activity_status=self.activity.status,
                               numeric_grade=self.value, grade_flag=self.flag, comment=self.comment, mark=mark, group=group)
             gh.save()
+            # a grade was entered by someone (not a calculation): update any calculated grades that depend on it,
+            # once it's committed so the calculation sees it
+            from grades.tasks import recalculate_dependents
+            activity_id, member_id = self.activity_id, self.member_id
+            transaction.on_commit(lambda: recalculate_dependents(activity_id, member_id))
         else:
             assert (self.flag == 'CALC') or (is_temporary and self.flag=='NOGR')
 
@@ -651,13 +677,23 @@ class LetterGrade(models.Model):
 
         newsitem controls the posting of a NewsItem for the student.
         """
-        super(LetterGrade, self).save()
+        with transaction.atomic():
+            # lock the row so a concurrent save can't apply its stats change against the same old value
+            old = LetterGrade.objects.select_for_update().filter(id=self.id).values_list('letter_grade', 'flag') \
+                .first() if self.id else None
+            super(LetterGrade, self).save()
+            ActivityStats.grades_changed(self.activity, [(self.member, old, (self.letter_grade, self.flag))])
 
         entered_by = get_entry_person(entered_by)
         if entered_by:
             gh = GradeHistory(activity=self.activity, member=self.member, entered_by=entered_by, activity_status=self.activity.status,
                               letter_grade=self.letter_grade, grade_flag=self.flag, comment=self.comment, mark=None, group=group)
             gh.save()
+            # a grade was entered by someone (not a calculation): update any calculated grades that depend on it,
+            # once it's committed so the calculation sees it
+            from grades.tasks import recalculate_dependents
+            activity_id, member_id = self.activity_id, self.member_id
+            transaction.on_commit(lambda: recalculate_dependents(activity_id, member_id))
         else:
             assert self.flag == 'CALC'
 
@@ -833,3 +869,360 @@ class GradeHistory(models.Model):
         return self.letter_grade or self.numeric_grade 
 
 
+
+HISTOGRAM_BUCKETS = 12 # <0%, ten 10% ranges, >100%: as in grades.utils.generate_grade_range_stat
+
+def grade_histogram_bucket(value, max_grade):
+    """
+    Index of the histogram bucket this grade belongs in: 0 for <0%, 1-10 for the 10% ranges, 11 for >100%.
+    """
+    EPS = 1e-6
+    if max_grade == 0:
+        g = 100
+    else:
+        g = float(value)/float(max_grade)*100
+    if g < 0:
+        return 0
+    elif g > 100:
+        return HISTOGRAM_BUCKETS - 1
+    bucket = int(g//10 + EPS)
+    if bucket == 10:
+        # move 100% down into x-100 bucket
+        bucket -= 1
+    return bucket + 1
+
+
+class ActivityStats(models.Model):
+    """
+    Summary of the students' grades (other than "no grade") in an activity, maintained incrementally as grades are
+    saved, so the summary stats don't have to be recomputed from every grade on each request.
+
+    Rows are deleted whenever they might be out of date in a way that can't be updated incrementally (activity saved,
+    student's role changed) and rebuilt when next needed by ActivityStats.for_activity.
+    """
+    activity = models.OneToOneField(Activity, null=False, on_delete=models.PROTECT, related_name='grade_stats')
+    count = models.PositiveIntegerField(null=False, default=0)
+    total = models.DecimalField(max_digits=24, decimal_places=4, null=False, default=0)
+    sum_squares = models.DecimalField(max_digits=24, decimal_places=4, null=False, default=0)
+    config = JSONField(null=False, blank=False, default=dict) # addition configuration stuff:
+    # .config['values']: dict of grade value (as a string) or letter grade -> number of students with that grade
+    # .config['histogram']: for numeric activities, number of students in each grade_histogram_bucket
+
+    def __str__(self):
+        return "stats for %s" % (self.activity,)
+
+    @staticmethod
+    def _grade_class(activity):
+        if isinstance(activity, NumericActivity):
+            return NumericGrade, 'value'
+        elif isinstance(activity, LetterActivity):
+            return LetterGrade, 'letter_grade'
+        else:
+            raise TypeError('NumericActivity or LetterActivity required')
+
+    def _apply(self, activity, value, flag, k):
+        """
+        Add (k=1) or remove (k=-1) a grade from the summary.
+        """
+        if value is None or flag == 'NOGR':
+            return
+        values = self.config.setdefault('values', {})
+        if isinstance(activity, NumericActivity):
+            value = decimal.Decimal(value).quantize(decimal.Decimal('0.01'))
+            self.count += k
+            self.total += k*value
+            self.sum_squares += k*value*value
+            histogram = self.config.setdefault('histogram', [0]*HISTOGRAM_BUCKETS)
+            histogram[grade_histogram_bucket(value, activity.max_grade)] += k
+            key = str(value)
+        else:
+            self.count += k
+            key = value
+
+        values[key] = values.get(key, 0) + k
+        if values[key] == 0:
+            del values[key]
+
+    @classmethod
+    def build(cls, activity):
+        """
+        Build the summary for this activity from scratch (but don't save it).
+        """
+        GradeClass, value_field = cls._grade_class(activity)
+        stats = cls(activity=activity)
+        grades = GradeClass.objects.filter(activity=activity, member__role='STUD').exclude(flag='NOGR')
+        for value, flag in grades.values_list(value_field, 'flag'):
+            stats._apply(activity, value, flag, 1)
+        return stats
+
+    @classmethod
+    def for_activity(cls, activity):
+        """
+        Get the summary for this activity, building it if necessary.
+        """
+        try:
+            return cls.objects.get(activity_id=activity.id)
+        except cls.DoesNotExist:
+            pass
+
+        stats = cls.build(activity)
+        try:
+            with transaction.atomic():
+                stats.save()
+        except IntegrityError:
+            # someone else built it at the same time
+            return cls.objects.get(activity_id=activity.id)
+        return stats
+
+    @classmethod
+    def grades_changed(cls, activity, changes):
+        """
+        Update the summary (if there is one stored) for changed grades.
+
+        changes is a list of (member, old, new) where old and new are (value, flag) pairs or None.
+        """
+        changes = [(old, new) for member, old, new in changes if member.role == 'STUD' and old != new]
+        if not changes:
+            return
+        with transaction.atomic(savepoint=False):
+            try:
+                stats = cls.objects.select_for_update().get(activity_id=activity.id)
+            except cls.DoesNotExist:
+                # nothing stored: it will be built when it's needed
+                return
+            for old, new in changes:
+                if old:
+                    stats._apply(activity, old[0], old[1], -1)
+                if new:
+                    stats._apply(activity, new[0], new[1], 1)
+            stats.save()
+
+    @classmethod
+    def invalidate(cls, activity_ids=None, offering_id=None):
+        if activity_ids is not None:
+            cls.objects.filter(activity_id__in=activity_ids).delete()
+        if offering_id is not None:
+            cls.objects.filter(activity__offering_id=offering_id).delete()
+
+    def values_sorted(self):
+        """
+        List of (value, count) pairs in increasing order (decimal values, or letters in sorted_letters order).
+        """
+        values = self.config.get('values', {})
+        if 'histogram' in self.config:
+            return sorted((decimal.Decimal(v), c) for v, c in values.items())
+        else:
+            return sorted(values.items(), key=lambda vc: LETTER_POSITION[vc[0]])
+
+    def nth_value(self, n, values_sorted=None):
+        """
+        The n-th smallest grade (0-indexed), as if the grades were all in a sorted list.
+        """
+        if values_sorted is None:
+            values_sorted = self.values_sorted()
+        for v, c in values_sorted:
+            if n < c:
+                return v
+            n -= c
+        raise IndexError('only %i grades' % (self.count,))
+
+    def median(self):
+        """
+        The median numeric grade (averaging the middle two if there's an even number).
+        """
+        values_sorted = self.values_sorted()
+        lower = self.nth_value((self.count - 1) // 2, values_sorted)
+        upper = self.nth_value(self.count // 2, values_sorted)
+        if self.count % 2 == 0:
+            return (lower + upper) / 2
+        else:
+            return lower
+
+    def average(self):
+        return float(self.total) / self.count
+
+    def stddev(self):
+        """
+        Population standard deviation of the grades.
+        """
+        mean = self.total / self.count
+        return math.sqrt(max(0.0, float(self.sum_squares / self.count - mean*mean)))
+
+    def histogram(self):
+        return self.config.get('histogram', [0]*HISTOGRAM_BUCKETS)
+
+
+def _member_role_changed(sender, instance, **kwargs):
+    """
+    A change to a student's role changes which grades are included in ActivityStats: throw away the offering's stats.
+    """
+    if instance.pk and 'role' in instance.get_dirty_fields(check_relationship=False):
+        ActivityStats.invalidate(offering_id=instance.offering_id)
+
+models.signals.pre_save.connect(_member_role_changed, sender=Member)
+
+
+GRADE_VERSION_TIMEOUT = 86400*7
+
+def _grade_version_key(offering_id):
+    return 'grade_version-%i' % (offering_id,)
+
+def grade_version(offering_id):
+    """
+    Token that changes whenever any grade, activity or membership in the offering changes: use as part of a cache
+    key for anything built from the offering's grades.
+    """
+    key = _grade_version_key(offering_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, GRADE_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def bump_grade_version(offering_id):
+    """
+    Invalidate everything cached under the offering's grade_version.
+    """
+    key = _grade_version_key(offering_id)
+    cache.set(key, uuid.uuid4().hex, GRADE_VERSION_TIMEOUT)
+    # again when committed: anything built from the pre-commit data in the meantime has the version set above
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, GRADE_VERSION_TIMEOUT))
+
+def _grade_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        # loading fixtures
+        return
+    if isinstance(instance, (NumericGrade, LetterGrade)):
+        bump_grade_version(instance.activity.offering_id)
+    elif isinstance(instance, (Activity, Member)):
+        bump_grade_version(instance.offering_id)
+
+for _model in [NumericGrade, LetterGrade, Member, Activity, NumericActivity, LetterActivity, CalNumericActivity,
+               CalLetterActivity]:
+    models.signals.post_save.connect(_grade_saved, sender=_model)
+    models.signals.post_delete.connect(_grade_saved, sender=_model)
+
+
+class GradeChangeSummary(object):
+    """
+    Summary of the changes made by bulk_save_grades.
+    """
+    def __init__(self):
+        self.unchanged = 0
+        self.updated = 0
+        self.created = 0
+        self.ignored = 0 # existing manually-entered grades left alone because of keep_manual
+        self.grades = {} # member.id -> the (possibly unsaved, if ignored/unchanged) grade object
+        self.changed = [] # grade objects that were created or updated
+
+    def __repr__(self):
+        return "GradeChangeSummary(unchanged=%i, updated=%i, created=%i, ignored=%i)" \
+               % (self.unchanged, self.updated, self.created, self.ignored)
+
+
+BULK_GRADE_BATCH_SIZE = 500
+
+def bulk_save_grades(activity, values, entered_by, flag='GRAD', comment=None, keep_manual=False, newsitem=True,
+                     recalculate=True):
+    """
+    Save many grades for one activity at once: the bulk equivalent of NumericGrade.save/LetterGrade.save.
+
+    values is a dict of Member -> new value (a decimal value for a NumericActivity, a letter for a LetterActivity).
+
+    entered_by is as for NumericGrade.save: None ONLY if this is the result of a calculation (and flag=='CALC').
+
+    keep_manual leaves existing grades alone unless their flag is 'CALC' (i.e. the calculation doesn't overwrite
+    grades that were set by hand). Those are counted as .ignored in the result.
+
+    Grades and their GradeHistory are written with a constant number of queries, in one transaction. Returns a
+    GradeChangeSummary.
+    """
+    if isinstance(activity, NumericActivity):
+        GradeClass, value_field, history_field = NumericGrade, 'value', 'numeric_grade'
+    elif isinstance(activity, LetterActivity):
+        GradeClass, value_field, history_field = LetterGrade, 'letter_grade', 'letter_grade'
+    else:
+        raise TypeError('NumericActivity or LetterActivity required')
+
+    entered_by = get_entry_person(entered_by)
+    if not entered_by:
+        assert flag == 'CALC'
+
+    summary = GradeChangeSummary()
+    with transaction.atomic():
+        existing = GradeClass.objects.select_for_update().filter(activity=activity)
+        if len(values) == 1:
+            existing = existing.filter(member__in=list(values.keys()))
+        existing = dict((g.member_id, g) for g in existing)
+
+        to_create = []
+        to_update = []
+        stats_changes = []
+        for member, value in values.items():
+            if GradeClass is NumericGrade and flag == 'NOGR':
+                # make sure "no grade" values have a zero, as in NumericGrade.save
+                value = 0
+
+            grade = existing.get(member.id)
+            if grade is None:
+                grade = GradeClass(activity=activity, member=member, flag=flag, comment=comment)
+                setattr(grade, value_field, value)
+                to_create.append(grade)
+                stats_changes.append((member, None, (value, flag)))
+                summary.created += 1
+            elif keep_manual and grade.flag != 'CALC':
+                summary.ignored += 1
+            elif getattr(grade, value_field) == value and grade.flag == flag \
+                    and (comment is None or grade.comment == comment):
+                summary.unchanged += 1
+            else:
+                stats_changes.append((member, (getattr(grade, value_field), grade.flag), (value, flag)))
+                setattr(grade, value_field, value)
+                grade.flag = flag
+                if comment is not None:
+                    grade.comment = comment
+                to_update.append(grade)
+                summary.updated += 1
+
+            grade.member = member
+            grade.activity = activity
+            summary.grades[member.id] = grade
+
+        GradeClass.objects.bulk_create(to_create, batch_size=BULK_GRADE_BATCH_SIZE)
+        update_fields = [value_field, 'flag'] + (['comment'] if comment is not None else [])
+        GradeClass.objects.bulk_update(to_update, update_fields, batch_size=BULK_GRADE_BATCH_SIZE)
+        summary.changed = to_create + to_update
+        ActivityStats.grades_changed(activity, stats_changes)
+        if summary.changed:
+            # bulk writes don't send post_save
+            bump_grade_version(activity.offering_id)
+
+        if entered_by:
+            history = []
+            for g in summary.changed:
+                gh = GradeHistory(activity=activity, member=g.member, entered_by=entered_by,
+                                  activity_status=activity.status, grade_flag=g.flag, comment=g.comment, mark=None,
+                                  group=None)
+                setattr(gh, history_field, getattr(g, value_field))
+                history.append(gh)
+            GradeHistory.objects.bulk_create(history, batch_size=BULK_GRADE_BATCH_SIZE)
+
+    if activity.status == "RLS" and newsitem and flag not in ["NOGR", "CALC"]:
+        # new grades assigned: generate news items only if the result is released
+        url = activity.get_absolute_url()
+        items = [NewsItem(user=g.member.person, author=None, course=activity.offering,
+                          source_app="grades", title="%s grade available" % (activity.name),
+                          content='A new grade for %s in %s is available.'
+                            % (activity.name, activity.offering.name()),
+                          url=url)
+                 for g in summary.changed]
+        NewsItem.bulk_create_and_email(items)
+
+    if entered_by and recalculate and summary.changed:
+        # grades were entered by someone (not a calculation): update any calculated grades that depend on them,
+        # once they're committed so the calculation sees them
+        from grades.tasks import recalculate_dependents
+        member_id = summary.changed[0].member_id if len(summary.changed) == 1 else None
+        transaction.on_commit(lambda: recalculate_dependents(activity.id, member_id))
+
+    return summary
@@ -1,52 +1,145 @@
 from courselib.celerytasks import task
 from django.conf import settings
+from django.core.cache import cache
 from dashboard.models import NewsItem
+from coredata.models import Member
 from grades.models import Activity, NumericGrade, LetterGrade, GradeHistory
+import datetime
 import itertools
+import logging
+import random
 
+logger = logging.getLogger(__name__)
 
-def _send_grade_released_news(activity_id):
-    activity = Activity.objects.get(id=activity_id)
-    NewsItem.for_members(member_kwargs={'offering': activity.offering},
-                newsitem_kwargs={
-                    'author': None, 'course': activity.offering, 'source_app': 'grades',
-                    'title': "%s grade released" % (activity.name),
-                    'content': 'Grades have been released for %s in %s.'
-                      % (activity.name, activity.offering.name()),
-                    'url': activity.get_absolute_url(),
-                    'markup': 'textile',
-                })
+
+GRADE_RELEASE_CHUNK = 500 # grades handled at once when recording a release
+RELEASE_PROGRESS_TIMEOUT = 3600
+
+
+def _release_progress_key(activity_id):
+    return 'grade_release_progress-%i' % (activity_id,)
+
+def grade_release_progress(activity_id):
+    """
+    Progress of the work done when this activity's grades were released: a dict of 'history' and 'news', each
+    (done, total) or missing if that part hasn't started.
+    """
+    return cache.get(_release_progress_key(activity_id)) or {}
+
+def _set_release_progress(activity_id, part, done, total):
+    progress = grade_release_progress(activity_id)
+    progress[part] = (done, total)
+    cache.set(_release_progress_key(activity_id), progress, RELEASE_PROGRESS_TIMEOUT)
+    logger.info('grade release for activity %i: %s %i/%i', activity_id, part, done, total)
+
+def _parse_released_at(released_at):
+    # passed through Celery as a string
+    if released_at is None:
+        return datetime.datetime.now()
+    return datetime.datetime.fromisoformat(released_at)
+
+
+def _send_grade_released_news(activity_id, released_at=None):
+    """
+    Create the "grade released" news item (and email) for each member of the offering.
+
+    Members who already got a news item for this release (released_at) are skipped, so a retried task doesn't
+    notify anyone twice.
+    """
+    released_at = _parse_released_at(released_at)
+    activity = Activity.objects.select_related('offering').get(id=activity_id)
+    url = activity.get_absolute_url()
+    title = "%s grade released" % (activity.name)
+
+    already = NewsItem.objects.filter(course=activity.offering, source_app='grades', title=title, url=url,
+                                      published__gte=released_at).values_list('user_id', flat=True)
+    # randomize order in the hopes of throwing off any spam filters
+    members = list(Member.objects.exclude(role="DROP").exclude(role="APPR").filter(offering=activity.offering)
+                   .exclude(person_id__in=already).select_related('person'))
+    random.shuffle(members)
+
+    items = []
+    for m in members:
+        n = NewsItem(user=m.person, author=None, course=activity.offering, source_app='grades', title=title,
+                     content='Grades have been released for %s in %s.' % (activity.name, activity.offering.name()),
+                     url=url)
+        n.markup = 'textile'
+        items.append(n)
+
+    _set_release_progress(activity_id, 'news', 0, len(items))
+    NewsItem.bulk_create_and_email(items,
+            progress=lambda done, total: _set_release_progress(activity_id, 'news', done, total))
 
 @task(max_retries=2, queue='fast')
-def send_grade_released_news_task(activity_id):
-    _send_grade_released_news(activity_id)
+def send_grade_released_news_task(activity_id, released_at=None):
+    _send_grade_released_news(activity_id, released_at)
 
 
-def _create_grade_released_history(activity_id, entered_by_id):
-    num_grades = NumericGrade.objects.filter(id=activity_id)
-    let_grades = LetterGrade.objects.filter(id=activity_id)
+def _create_grade_released_history(activity_id, entered_by_id, released_at=None):
+    """
+    Record a GradeHistory status change for each grade in the activity when it's released.
+
+    Grades that already have a record for this release (released_at) are skipped, so a retried task doesn't
+    duplicate them.
+    """
+    released_at = _parse_released_at(released_at)
     activity = Activity.objects.get(id=activity_id)
-    for g in itertools.chain(num_grades, let_grades):
-        gh = GradeHistory(activity=activity, member=g.member, entered_by_id=entered_by_id, activity_status=activity.status,
-                          grade_flag=g.flag, comment=g.comment, mark=None, group=None, status_change=True)
-        if hasattr(g, 'value'):
-            # NumericGrade
-            gh.numeric_grade = g.value
-        else:
-            # LetterGrade
-            gh.letter_grade = g.letter_grade
-        
-        gh.save()
+    already = set(GradeHistory.objects.filter(activity_id=activity_id, status_change=True, timestamp__gte=released_at)
+                  .values_list('member_id', flat=True))
+    num_grades = NumericGrade.objects.filter(activity_id=activity_id).exclude(member_id__in=already)
+    let_grades = LetterGrade.objects.filter(activity_id=activity_id).exclude(member_id__in=already)
+    total = num_grades.count() + let_grades.count()
+    grades = itertools.chain(num_grades.iterator(chunk_size=GRADE_RELEASE_CHUNK),
+                             let_grades.iterator(chunk_size=GRADE_RELEASE_CHUNK))
+
+    done = 0
+    _set_release_progress(activity_id, 'history', done, total)
+    while True:
+        chunk = list(itertools.islice(grades, GRADE_RELEASE_CHUNK))
+        if not chunk:
+            break
+        history = []
+        for g in chunk:
+            gh = GradeHistory(activity=activity, member_id=g.member_id, entered_by_id=entered_by_id,
+                              activity_status=activity.status, grade_flag=g.flag, comment=g.comment, mark=None,
+                              group=None, status_change=True)
+            if hasattr(g, 'value'):
+                # NumericGrade
+                gh.numeric_grade = g.value
+            else:
+                # LetterGrade
+                gh.letter_grade = g.letter_grade
+            history.append(gh)
+
+        GradeHistory.objects.bulk_create(history)
+        done += len(history)
+        _set_release_progress(activity_id, 'history', done, total)
+
+@task(queue='fast')
+def create_grade_released_history_task(activity_id, entered_by_id, released_at=None):
+    _create_grade_released_history(activity_id, entered_by_id, released_at)
+
+
+def _recalculate_dependents(activity_id, member_id):
+    from grades.utils import recalculate_dependents
+    activity = Activity.objects.select_related('offering').get(id=activity_id)
+    if member_id is None:
+        member = None
+    else:
+        member = Member.objects.select_related('person').get(id=member_id)
+    recalculate_dependents(activity, member)
 
 @task(queue='fast')
-def create_grade_released_history_task(activity_id, entered_by_id):
-    _create_grade_released_history(activity_id, entered_by_id)
+def recalculate_dependents_task(activity_id, member_id):
+    _recalculate_dependents(activity_id, member_id)
 
 
 # let these work with or without Celery
 if settings.USE_CELERY:
     send_grade_released_news = send_grade_released_news_task.delay
     create_grade_released_history = create_grade_released_history_task.delay
+    recalculate_dependents = recalculate_dependents_task.delay
 else:
     send_grade_released_news = _send_grade_released_news
     create_grade_released_history = _create_grade_released_history
+    recalculate_dependents = _recalculate_dependents
@@ -1,15 +1,21 @@
 # coding=utf-8
 
-from grades.formulas import parse, cols_used, eval_parse, EvalException, ParseException
+from grades.formulas import parse, cols_used, eval_parse, EvalException, ParseException, CompiledFormula, \
+    load_grade_matrix
 from grades.models import Activity, NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity, \
     NumericGrade, LetterGrade, GradeHistory, all_activities_filter, ACTIVITY_STATUS, sorted_letters, \
-    median_letters
-from grades.utils import activities_dictionary, generate_grade_range_stat
+    median_letters, bulk_save_grades, ActivityStats, grade_version, \
+    bump_grade_version
+from grades.gradebook import GradebookMatrix, gradebook_rows
+from grades.utils import activities_dictionary, generate_grade_range_stat, dependent_activities, \
+    generate_numeric_activity_stat, generate_letter_activity_stat, letter_for_grade, letter_grades_for, \
+    generate_lettergrades, calculate_letter_grade, preview_letter_grades
 from coredata.models import Person, Member, CourseOffering, Unit
-from dashboard.models import UserConfig
+from dashboard.models import UserConfig, NewsItem
 from submission.models import StudentSubmission
 from coredata.tests import create_offering
-import pickle, datetime, decimal, json
+import pickle, datetime, decimal, json, csv, io, zipfile
+from unittest.mock import patch
 
 from django.conf import settings
 from courselib.testing import *
@@ -149,6 +155,66 @@ class GradesTest(TestCase):
         res = eval_parse(tree, ca, act_dict, m, True)
         self.assertAlmostEqual(res, 7.229166666)
 
+    def test_compiled_formulas(self):
+        """
+        Test that compiled formulas over the grade matrix agree with eval_parse.
+        """
+        s, c = create_offering()
+        p = Person.objects.get(userid="0aaa0")
+        m = Member(person=p, offering=c, role="STUD", credits=3, added_reason="UNK")
+        m.save()
+
+        a = NumericActivity(name="Paragraph", short_name="¶", status="RLS", offering=c, position=3, max_grade=40, percent=5)
+        a.save()
+        g = NumericGrade(activity=a, member=m, value="4.5", flag="CALC")
+        g.save(entered_by='ggbaker')
+        a1 = NumericActivity(name="Assignment #1", short_name="A1", status="RLS", offering=c, position=1, max_grade=15, percent=10)
+        a1.save()
+        g = NumericGrade(activity=a1, member=m, value=10, flag="GRAD")
+        g.save(entered_by='ggbaker')
+        a2 = NumericActivity(name="Assignment #2", short_name="A2", status="URLS", offering=c, position=2, max_grade=40, percent=20)
+        a2.save(entered_by='ggbaker')
+        g = NumericGrade(activity=a2, member=m, value=30, flag="GRAD")
+        g.save(entered_by='ggbaker')
+        ca = CalNumericActivity(name="Final Grade", short_name="FG", status="RLS", offering=c, position=4, max_grade=1)
+        ca.save()
+
+        activities = NumericActivity.objects.filter(offering=c)
+        act_dict = activities_dictionary(activities)
+        extra_formulas = [("[A1.max] + [A2.percent]", 35), ("[A1.final]", 6.6666666667),
+                          ("COUNT([A1], [A2], 0)", 2), ("[[activitytotal]]", 22.229166666)]
+
+        with self.assertNumQueries(1):
+            matrix = load_grade_matrix(activities, [m])
+        for expr, correct in test_formulas + extra_formulas:
+            tree = parse(expr, c, ca)
+            formula = CompiledFormula(tree, ca, act_dict, False)
+            res = formula(matrix[m.id])
+            self.assertAlmostEqual(correct, res, msg="Incorrect result for %s"%(expr,))
+            self.assertAlmostEqual(eval_parse(tree, ca, act_dict, m, False), res)
+
+        # unreleased activities are zero when the calculated activity is visible...
+        tree = parse("[A2] + [A1]", c, ca)
+        self.assertAlmostEqual(CompiledFormula(tree, ca, act_dict, True)(matrix[m.id]), 10.0)
+        # ... and aren't fetched at all
+        self.assertEqual(set(CompiledFormula(tree, ca, act_dict, True).activities), {a1.id})
+        ca.set_calculation_leak(True)
+        self.assertAlmostEqual(CompiledFormula(tree, ca, act_dict, True)(matrix[m.id]), 40.0)
+        ca.set_calculation_leak(False)
+
+        # "no grade" and missing grades are zeros
+        g.flag = "NOGR"
+        g.save(entered_by='ggbaker')
+        matrix = load_grade_matrix(activities)
+        self.assertAlmostEqual(CompiledFormula(tree, ca, act_dict, False)(matrix[m.id]), 10.0)
+        self.assertAlmostEqual(CompiledFormula(tree, ca, act_dict, False)({}), 0.0)
+
+        # bad formulas
+        tree = parse("1 + BEST(3, [A1], [A2])", c, ca)
+        self.assertRaises(EvalException, CompiledFormula(tree, ca, act_dict, True), matrix[m.id])
+        tree = parse("[Foo] /2", c, ca)
+        self.assertRaises(KeyError, CompiledFormula, tree, ca, act_dict, True)
+
     def test_activities(self):
         """
         Test activity classes: subclasses, selection, sorting.
@@ -412,6 +478,403 @@ class GradesTest(TestCase):
         cs = a.get_cutoffs()
         self.assertAlmostEqual(float(cs[1]), 90.333333333333)
 
+    def test_letter_grade_engine(self):
+        """
+        Test the batch letter grade calculation and cutoff previews.
+        """
+        s, c = create_offering()
+        members = []
+        for i in range(6):
+            m = Member(person=Person.objects.get(userid="0aaa%i" % (i,)), offering=c, role="STUD", credits=3,
+                       added_reason="UNK")
+            m.save()
+            members.append(m)
+        na = NumericActivity(name="Total", short_name="Tot", status="URLS", offering=c, position=1, max_grade=100)
+        na.save()
+        exam = NumericActivity(name="Final", short_name="Fin", status="URLS", offering=c, position=2, max_grade=50)
+        exam.save()
+        la = CalLetterActivity(offering=c, name="Letter", short_name="L", status="URLS", numeric_activity=na,
+                               exam_activity=exam, position=3)
+        la.save()
+
+        # boundaries: exactly on a cutoff gets that letter
+        ascending = list(reversed(la.get_cutoffs()))
+        self.assertEqual([letter_for_grade(decimal.Decimal(g), ascending) for g in [100, 95, 94.99, 50, 49.99, -5]],
+                         ['A+', 'A+', 'A', 'D', 'F', 'F'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_save_grades(na, {members[0]: 96, members[1]: 80, members[2]: 72, members[3]: 40, members[4]: 88},
+                             entered_by='ggbaker')
+            bulk_save_grades(exam, {members[0]: 40, members[1]: 30, members[2]: 20, members[3]: 10},
+                             entered_by='ggbaker')
+            bulk_save_grades(exam, {members[4]: 0}, entered_by='ggbaker', flag='EXCU')
+
+        with self.assertNumQueries(3):
+            results = letter_grades_for(la, members)
+        self.assertEqual([results[m] for m in members], ['A+', 'B+', 'B-', 'F', 'DE', 'N'])
+        for m in members:
+            self.assertEqual(generate_lettergrades(m, la), results[m])
+
+        # a manual grade is left alone by the calculation, and counted as-is by the preview
+        g = LetterGrade.objects.get(activity=la, member=members[3])
+        g.letter_grade = 'D'
+        g.flag = 'GRAD'
+        g.save(entered_by='ggbaker')
+        self.assertEqual(calculate_letter_grade(c, la), 1)
+        self.assertEqual(LetterGrade.objects.get(activity=la, member=members[1]).letter_grade, 'B+')
+
+        cutoffs = [decimal.Decimal(g) for g in [95, 90, 85, 81, 75, 70, 65, 60, 55, 50]]
+        before = list(LetterGrade.objects.filter(activity=la).order_by('id').values_list('letter_grade', flat=True))
+        histogram = preview_letter_grades(la, cutoffs)
+        self.assertEqual(dict((l, n) for l, n in histogram.items() if n),
+                         {'A+': 1, 'B': 1, 'B-': 1, 'D': 1, 'DE': 1, 'N': 1})
+        after = list(LetterGrade.objects.filter(activity=la).order_by('id').values_list('letter_grade', flat=True))
+        self.assertEqual(before, after)
+
+        # ... and through the view
+        Member(person=Person.objects.get(userid="ggbaker"), offering=c, role="INST", added_reason="UNK").save()
+        client = Client()
+        client.login_user('ggbaker')
+        url = reverse('offering:preview_cutoffs', kwargs={'course_slug': c.slug, 'activity_slug': la.slug})
+        params = dict(zip(['ap', 'a', 'am', 'bp', 'b', 'bm', 'cp', 'c', 'cm', 'd'], cutoffs))
+        resp = client.get(url, params)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(dict(json.loads(resp.content.decode('utf-8'))['histogram']), histogram)
+        params['a'] = 99
+        resp = client.get(url, params)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_dependent_recalculation(self):
+        """
+        Test the activity dependency graph, and recalculation of dependent grades when a grade is entered.
+        """
+        s, c = create_offering()
+        p1 = Person.objects.get(userid="0aaa0")
+        m1 = Member(person=p1, offering=c, role="STUD", credits=3, added_reason="UNK")
+        m1.save()
+        p2 = Person.objects.get(userid="0aaa1")
+        m2 = Member(person=p2, offering=c, role="STUD", credits=3, added_reason="UNK")
+        m2.save()
+
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10, percent=50)
+        a1.save()
+        a2 = NumericActivity(name="Assignment 2", short_name="A2", status="RLS", offering=c, position=2, max_grade=10, percent=50)
+        a2.save()
+        total = CalNumericActivity(name="Total", short_name="Tot", status="RLS", offering=c, position=3, max_grade=20, formula="[A1]+[A2]")
+        total.save()
+        final = CalNumericActivity(name="Final Percent", short_name="Perc", status="RLS", offering=c, position=4, max_grade=100, formula="[Total]/[Total.max]*100")
+        final.save()
+        letter = CalLetterActivity(name="Letter", short_name="Let", status="RLS", offering=c, position=5, numeric_activity=final, exam_activity=None)
+        letter.save()
+
+        self.assertEqual(dependent_activities(c, a1.id), [total.id, final.id, letter.id])
+        self.assertEqual(dependent_activities(c, final.id), [letter.id])
+        self.assertEqual(dependent_activities(c, letter.id), [])
+
+        # entering grades recalculates the chain (once committed), but only for that student
+        with self.captureOnCommitCallbacks(execute=True):
+            NumericGrade(activity=a1, member=m1, value=9, flag="GRAD").save(entered_by='ggbaker')
+            NumericGrade(activity=a2, member=m1, value=10, flag="GRAD").save(entered_by='ggbaker')
+            self.assertFalse(NumericGrade.objects.filter(activity=total, member=m1).exists())
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m1).value, decimal.Decimal('19'))
+        self.assertEqual(NumericGrade.objects.get(activity=final, member=m1).value, decimal.Decimal('95'))
+        self.assertEqual(LetterGrade.objects.get(activity=letter, member=m1).letter_grade, 'A+')
+        self.assertFalse(NumericGrade.objects.filter(activity=total, member=m2).exists())
+
+        # manually-set calculated grades are left alone
+        g = NumericGrade.objects.get(activity=final, member=m1)
+        g.value = 40
+        g.flag = 'GRAD'
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+            NumericGrade(activity=a1, member=m1, value=5, flag="GRAD", id=NumericGrade.objects.get(activity=a1, member=m1).id).save(entered_by='ggbaker')
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m1).value, decimal.Decimal('15'))
+        self.assertEqual(NumericGrade.objects.get(activity=final, member=m1).value, decimal.Decimal('40'))
+        self.assertEqual(LetterGrade.objects.get(activity=letter, member=m1).letter_grade, 'F')
+
+        # changing a formula invalidates the cached graph
+        final.formula = "[A2]*10"
+        final.save()
+        self.assertEqual(dependent_activities(c, a1.id), [total.id])
+        self.assertEqual(dependent_activities(c, a2.id), [total.id, final.id, letter.id])
+
+    def test_bulk_save_grades(self):
+        """
+        Test the bulk grade-writing path.
+        """
+        s, c = create_offering()
+        members = []
+        for userid in ['0aaa0', '0aaa1', '0aaa2']:
+            m = Member(person=Person.objects.get(userid=userid), offering=c, role="STUD", credits=3, added_reason="UNK")
+            m.save()
+            members.append(m)
+        m0, m1, m2 = members
+        a = NumericActivity(name="Assignment 1", short_name="A1", status="URLS", offering=c, position=1, max_grade=10)
+        a.save()
+        NumericGrade(activity=a, member=m0, value=5, flag="GRAD").save(entered_by='ggbaker')
+        NumericGrade(activity=a, member=m1, value=6, flag="CALC").save(entered_by=None)
+        history_before = GradeHistory.objects.filter(activity=a).count()
+
+        # calculation-style save: manual grades are left alone
+        with self.assertNumQueries(6): # savepoint, select, insert, update, stats select, release
+            changes = bulk_save_grades(a, {m0: 7, m1: 7, m2: 7}, entered_by=None, flag='CALC', keep_manual=True)
+        self.assertEqual((changes.unchanged, changes.updated, changes.created, changes.ignored), (0, 1, 1, 1))
+        self.assertEqual(NumericGrade.objects.get(activity=a, member=m0).value, 5)
+        self.assertEqual(NumericGrade.objects.get(activity=a, member=m1).value, 7)
+        self.assertEqual(NumericGrade.objects.get(activity=a, member=m2).value, 7)
+        self.assertEqual(GradeHistory.objects.filter(activity=a).count(), history_before)
+
+        # entered grades overwrite, and get history
+        changes = bulk_save_grades(a, {m0: 8, m1: 7, m2: decimal.Decimal('7.00')}, entered_by='ggbaker', flag='CALC')
+        self.assertEqual((changes.unchanged, changes.updated, changes.created, changes.ignored), (2, 1, 0, 0))
+        changes = bulk_save_grades(a, {m1: 9, m2: 9}, entered_by='ggbaker', flag='GRAD')
+        self.assertEqual((changes.unchanged, changes.updated, changes.created, changes.ignored), (0, 2, 0, 0))
+        self.assertEqual(GradeHistory.objects.filter(activity=a).count(), history_before + 3)
+        gh = GradeHistory.objects.filter(activity=a, member=m2).order_by('-id')[0]
+        self.assertEqual((gh.numeric_grade, gh.grade_flag, gh.entered_by.userid), (9, 'GRAD', 'ggbaker'))
+
+        la = LetterActivity(name="Project", short_name="Proj", status="URLS", offering=c, position=2)
+        la.save()
+        changes = bulk_save_grades(la, {m0: 'A', m1: 'B'}, entered_by='ggbaker')
+        self.assertEqual(changes.created, 2)
+        self.assertEqual(LetterGrade.objects.get(activity=la, member=m1).letter_grade, 'B')
+        self.assertEqual(GradeHistory.objects.filter(activity=la).count(), 2)
+
+        # released: news items created together, and dependents recalculated once committed
+        a.status = 'RLS'
+        a.save(newsitem=False)
+        total = CalNumericActivity(name="Total", short_name="Tot", status="URLS", offering=c, position=3,
+                                   max_grade=10, formula="[A1]")
+        total.save()
+        news_before = NewsItem.objects.filter(course=c).count()
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_save_grades(a, {m0: 10, m1: 10}, entered_by='ggbaker')
+            self.assertFalse(NumericGrade.objects.filter(activity=total).exists())
+        self.assertEqual(NewsItem.objects.filter(course=c).count(), news_before + 2)
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m0).value, 10)
+
+    def test_activity_stats(self):
+        """
+        Test the incrementally-maintained activity stats against the stats computed from scratch.
+        """
+        s, c = create_offering()
+        members = []
+        for i in range(6):
+            m = Member(person=Person.objects.get(userid="0aaa%i" % (i,)), offering=c, role="STUD", credits=3,
+                       added_reason="UNK")
+            m.save()
+            members.append(m)
+        a = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10)
+        a.save()
+        la = LetterActivity(name="Project", short_name="Proj", status="RLS", offering=c, position=2)
+        la.save()
+
+        def check():
+            stored = ActivityStats.objects.get(activity=a)
+            built = ActivityStats.build(a)
+            self.assertEqual((stored.count, stored.total, stored.sum_squares, stored.config),
+                             (built.count, built.total, built.sum_squares, built.config))
+
+        # nothing stored until it's asked for
+        NumericGrade(activity=a, member=members[0], value=5, flag="GRAD").save(entered_by='ggbaker')
+        self.assertFalse(ActivityStats.objects.filter(activity=a).exists())
+        stats, _ = generate_numeric_activity_stat(a, 'INST')
+        self.assertEqual((stats.count, stats.average, stats.median), (1, '5.00', '5.00'))
+
+        # ... then maintained as grades change
+        for m, v in zip(members, [5, 10, 7.5, 0, 12, 3]):
+            g = NumericGrade.objects.filter(activity=a, member=m).first() or NumericGrade(activity=a, member=m)
+            g.value = v
+            g.flag = 'GRAD'
+            g.save(entered_by='ggbaker')
+            check()
+        bulk_save_grades(a, {members[1]: 6, members[2]: 6}, entered_by='ggbaker')
+        check()
+        g = NumericGrade.objects.get(activity=a, member=members[5])
+        g.flag = 'NOGR'
+        g.save(entered_by='ggbaker')
+        check()
+
+        stats, _ = generate_numeric_activity_stat(a, 'INST')
+        values = [5, 6, 6, 0, 12]
+        mean = sum(values)/5.0
+        self.assertEqual((stats.count, stats.min, stats.max, stats.median), (5, '0.00', '12.00', '6.00'))
+        self.assertEqual(stats.average, '%.2f' % (mean,))
+        self.assertEqual(stats.stddev, '%.2f' % ((sum((v - mean)**2 for v in values)/5.0)**0.5,))
+        self.assertEqual([r.stud_count for r in stats.grade_range_stat_list],
+                         [r.stud_count for r in generate_grade_range_stat([v*10 for v in values])])
+        self.assertEqual(stats.grade_range_stat_list[-1].grade_range, '>100%')
+
+        # changing the activity or a student's role throws the stats away
+        a.max_grade = 20
+        a.save()
+        self.assertFalse(ActivityStats.objects.filter(activity=a).exists())
+        stats, _ = generate_numeric_activity_stat(a, 'INST')
+        self.assertEqual([(r.grade_range, r.stud_count) for r in stats.grade_range_stat_list],
+                         [(r.grade_range, r.stud_count) for r in generate_grade_range_stat([v*5 for v in values])])
+        members[0].role = 'DROP'
+        members[0].save()
+        self.assertFalse(ActivityStats.objects.filter(activity=a).exists())
+        stats, _ = generate_numeric_activity_stat(a, 'INST')
+        self.assertEqual(stats.count, 4)
+
+        # letter grades
+        bulk_save_grades(la, {members[1]: 'B', members[2]: 'A', members[3]: 'B+', members[4]: 'F'},
+                         entered_by='ggbaker')
+        stats, _ = generate_letter_activity_stat(la, 'INST')
+        self.assertEqual((stats.count, stats.median, stats.max, stats.min), (4, 'B+/B', 'A', 'F'))
+        bulk_save_grades(la, {members[4]: 'A'}, entered_by='ggbaker')
+        stats, _ = generate_letter_activity_stat(la, 'INST')
+        self.assertEqual((stats.count, stats.median, stats.max, stats.min), (4, 'A/B+', 'A', 'B'))
+
+    def test_gradebook_matrix(self):
+        """
+        Test the cached gradebook matrix, and that changes to grades/activities/members invalidate it.
+        """
+        s, c = create_offering()
+        members = []
+        for i in range(3):
+            m = Member(person=Person.objects.get(userid="0aaa%i" % (i,)), offering=c, role="STUD", credits=3,
+                       added_reason="UNK")
+            m.save()
+            members.append(m)
+        a = NumericActivity(name="Assignment 1", short_name="A1", status="URLS", offering=c, position=1, max_grade=10)
+        a.save()
+        la = LetterActivity(name="Project", short_name="Proj", status="URLS", offering=c, position=2)
+        la.save()
+        NumericGrade(activity=a, member=members[0], value=decimal.Decimal('7.25'), flag="GRAD", comment="Nice").save(entered_by='ggbaker')
+        NumericGrade(activity=a, member=members[1], value=0, flag="NOGR").save(entered_by='ggbaker')
+        LetterGrade(activity=la, member=members[0], letter_grade='B+', flag="GRAD").save(entered_by='ggbaker')
+
+        with self.assertNumQueries(2):
+            matrix = GradebookMatrix.for_offering(c)
+        with self.assertNumQueries(0):
+            matrix = GradebookMatrix.for_offering(c)
+        g = matrix.get(members[0].id, a.id)
+        self.assertEqual((g.value, g.flag, g.comment, g.display_staff_short()), (decimal.Decimal('7.25'), 'GRAD', 'Nice', '7.2'))
+        self.assertEqual(matrix.get(members[1].id, a.id).export_value(), '')
+        self.assertEqual(matrix.get(members[0].id, la.id).export_value(), 'B+')
+        self.assertIsNone(matrix.get(members[2].id, a.id))
+        self.assertIsNone(matrix.get(members[2].id, la.id))
+
+        # each kind of change bumps the version, so the next read sees it
+        version = grade_version(c.id)
+        g = NumericGrade.objects.get(activity=a, member=members[1])
+        g.value = 3
+        g.flag = 'GRAD'
+        g.save(entered_by='ggbaker')
+        self.assertNotEqual(grade_version(c.id), version)
+        self.assertEqual(GradebookMatrix.for_offering(c).get(members[1].id, a.id).value, 3)
+
+        version = grade_version(c.id)
+        bulk_save_grades(a, {members[2]: 4}, entered_by='ggbaker')
+        self.assertNotEqual(grade_version(c.id), version)
+        self.assertEqual(GradebookMatrix.for_offering(c).get(members[2].id, a.id).value, 4)
+
+        version = grade_version(c.id)
+        a.name = "Assignment One"
+        a.save()
+        self.assertNotEqual(grade_version(c.id), version)
+
+        version = grade_version(c.id)
+        members[2].role = 'DROP'
+        members[2].save()
+        self.assertNotEqual(grade_version(c.id), version)
+
+        # ... and again when committed, in case someone built from the pre-commit data in between
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_grade_version(c.id)
+            version = grade_version(c.id)
+        self.assertNotEqual(grade_version(c.id), version)
+
+        # a grade changing during a build doesn't leave the old matrix cached under the new version
+        build = GradebookMatrix.build
+        def build_then_change(offering):
+            matrix = build(offering)
+            bump_grade_version(offering.id)
+            return matrix
+        with patch.object(GradebookMatrix, 'build', side_effect=build_then_change):
+            GradebookMatrix.for_offering(c)
+        self.assertIsNone(GradebookMatrix.cached(c))
+
+        # the views agree with the matrix
+        Member(person=Person.objects.get(userid="ggbaker"), offering=c, role="INST", added_reason="UNK").save()
+        client = Client()
+        client.login_user('ggbaker')
+        resp = client.get(reverse('offering:all_grades_csv', kwargs={'course_slug': c.slug}))
+        self.assertEqual(resp.status_code, 200)
+        content = b''.join(resp.streaming_content).decode('utf-8')
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0][-2:], ['A1', 'Proj'])
+        self.assertEqual(sorted(r[-2:] for r in rows[1:]), [['3.00', ''], ['7.25', 'B+']])
+
+        # streamed in small chunks from the database, the rows are the same
+        bump_grade_version(c.id)
+        with patch('grades.gradebook.GRADEBOOK_EXPORT_CHUNK', 1):
+            self.assertEqual([[str(v) for v in r] for r in gradebook_rows(c)], rows)
+
+        resp = client.get(reverse('offering:export_all', kwargs={'course_slug': c.slug}))
+        self.assertEqual(resp.status_code, 200)
+        z = zipfile.ZipFile(io.BytesIO(b''.join(resp.streaming_content)))
+        self.assertEqual(z.read('grades.csv').decode('utf-8'), content)
+
+    def test_benchmark_report(self):
+        """
+        Check that the grades benchmark runs and leaves nothing behind.
+        """
+        offerings = CourseOffering.objects.count()
+        out = io.StringIO()
+        call_command('benchmark_grades', students=5, numeric=2, calculated=2, stdout=out, stderr=io.StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['students'], 5)
+        names = [r['name'] for r in report['results']]
+        self.assertIn('calculate_numeric_grade', names)
+        self.assertIn('export_all', names)
+        for r in report['results']:
+            self.assertGreater(r['queries'], 0)
+        self.assertEqual(CourseOffering.objects.count(), offerings)
+
+    def test_grade_release(self):
+        """
+        Test the history, news items and emails created when grades are released.
+        """
+        from django.core import mail
+        from grades.tasks import _create_grade_released_history, _send_grade_released_news, grade_release_progress
+        s, c = create_offering()
+        members = []
+        for i in range(5):
+            m = Member(person=Person.objects.get(userid="0aaa%i" % (i,)), offering=c, role="STUD", credits=3,
+                       added_reason="UNK")
+            m.save()
+            members.append(m)
+        UserConfig(user=members[0].person, key='newsitems', value={'email': False}).save()
+        a = NumericActivity(name="Assignment 1", short_name="A1", status="URLS", offering=c, position=1, max_grade=10)
+        a.save()
+        bulk_save_grades(a, dict((m, i) for i, m in enumerate(members[:4])), entered_by='ggbaker')
+        la = LetterActivity(name="Project", short_name="Proj", status="URLS", offering=c, position=2)
+        la.save()
+        bulk_save_grades(la, {members[0]: 'A'}, entered_by='ggbaker')
+
+        mail.outbox = []
+        a.status = 'RLS'
+        a.save(entered_by='ggbaker')
+        history = GradeHistory.objects.filter(activity=a, status_change=True)
+        self.assertEqual(sorted(history.values_list('member_id', 'numeric_grade')),
+                         [(m.id, i) for i, m in enumerate(members[:4])])
+        self.assertEqual(GradeHistory.objects.filter(activity=la, status_change=True).count(), 0)
+        news = NewsItem.objects.filter(course=c, title="Assignment 1 grade released")
+        self.assertEqual(news.count(), 5)
+        self.assertEqual(len(mail.outbox), 4) # members[0] doesn't want email
+        self.assertEqual(grade_release_progress(a.id), {'history': (4, 4), 'news': (5, 5)})
+
+        # a retried task for the same release doesn't duplicate anything
+        released_at = history.order_by('timestamp').first().timestamp - datetime.timedelta(seconds=1)
+        _create_grade_released_history(a.id, Person.objects.get(userid='ggbaker').id, released_at.isoformat())
+        _send_grade_released_news(a.id, released_at.isoformat())
+        self.assertEqual(history.count(), 4)
+        self.assertEqual(news.count(), 5)
+        self.assertEqual(len(mail.outbox), 4)
+
     def test_sort_letter(self):
         """
         Test sorting letter grades
@@ -27,6 +27,7 @@ activity_patterns = [ # prefix /COURSE_SLUG/+ACTIVITY_SLUG/
     #url(r'^' + USERID_SLUG + '/cal_idv$', grades_views.calculate_individual, name='calculate_individual'),
     url(r'^edit$', grades_views.edit_activity, name='edit_activity'),
     url(r'^cutoffs$', grades_views.edit_cutoffs, name='edit_cutoffs'),
+    url(r'^cutoffs/preview$', grades_views.preview_cutoffs, name='preview_cutoffs'),
     url(r'^groups$', grades_views.activity_info_with_groups, name='activity_info_with_groups'),
     url(r'^release$', grades_views.release_activity, name='release_activity'),
     url(r'^delete$', grades_views.delete_activity, name='delete_activity'),
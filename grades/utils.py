@@ -4,12 +4,16 @@ This module collects classes and functions that are for the display purpose of G
 
 from grades.models import Activity, NumericActivity, LetterActivity, NumericGrade, \
                           LetterGrade, ACTIVITY_TYPES, FLAGS, \
-                          CalNumericActivity,CalLetterActivity, median_letters, min_letters, max_letters,sorted_letters
+                          CalNumericActivity,CalLetterActivity, median_letters, min_letters, max_letters,sorted_letters, \
+                          bulk_save_grades, ActivityStats
 from coredata.models import CourseOffering, Member
-from grades.formulas import parse, activities_dictionary, cols_used, eval_parse, EvalException
+from grades.formulas import parse, activities_dictionary, cols_used, EvalException, CompiledFormula, load_grade_matrix
 from pyparsing import ParseException
+import bisect
+import itertools
 import math
 import decimal
+from django.core.cache import cache
 
 ORDER_TYPE = {'UP': 'up', 'DN': 'down'}
 _NO_GRADE = '\u2014'
@@ -249,8 +253,8 @@ def generate_numeric_activity_stat(activity, role):
     if role == 'STUD' and activity.status != 'RLS':
         return None, 'Summary statistics disabled for unreleased activities.'
 
-    student_grade_list = fetch_students_numeric_grade(activity)
-    if not student_grade_list:
+    grade_stats = ActivityStats.for_activity(activity)
+    if grade_stats.count == 0:
         if role == 'STUD':
             return None, 'Summary statistics disabled for small classes.'
         else:
@@ -258,34 +262,16 @@ def generate_numeric_activity_stat(activity, role):
     if role == 'STUD' and not activity.showstats():
         return None, 'Summary stats disabled by instructor.'
 
-    student_grade_list.sort()
-    student_grade_list_count = len(student_grade_list)
-    average = sum(student_grade_list)
-    average = float(average) / student_grade_list_count
-
-    if student_grade_list_count % 2 == 0:
-        median = (student_grade_list[(student_grade_list_count - 1) // 2] +
-                    student_grade_list[(student_grade_list_count) // 2]) / 2
-    else:
-        median = student_grade_list[(student_grade_list_count - 1) // 2]
-
-    stddev = math.sqrt(sum([(float(student_grade) - average) ** 2 for student_grade in student_grade_list]) / student_grade_list_count)
-
-    # normalize the grade into 100 based in order to generate the grade range stat
-    if activity.max_grade == 0:
-        normalized_student_grade_list = [100 for student_grade in student_grade_list]
-    else:
-        normalized_student_grade_list = [ float(student_grade)/float(activity.max_grade)*100
-                                        for student_grade in student_grade_list ]
+    values_sorted = grade_stats.values_sorted()
     if role == 'STUD' and not activity.showhisto():
         grade_range_stat_list = []
     else:
-        grade_range_stat_list = generate_grade_range_stat(normalized_student_grade_list)
+        grade_range_stat_list = grade_range_stat_from_histogram(grade_stats.histogram())
 
-    stats = ActivityStat(format_number(average, _DECIMAL_PLACE), format_number(student_grade_list[0], _DECIMAL_PLACE),
-                        format_number(student_grade_list[student_grade_list_count - 1], _DECIMAL_PLACE),
-                        format_number(median, _DECIMAL_PLACE),
-                        format_number(stddev, _DECIMAL_PLACE), grade_range_stat_list, student_grade_list_count)
+    stats = ActivityStat(format_number(grade_stats.average(), _DECIMAL_PLACE), format_number(values_sorted[0][0], _DECIMAL_PLACE),
+                        format_number(values_sorted[-1][0], _DECIMAL_PLACE),
+                        format_number(grade_stats.median(), _DECIMAL_PLACE),
+                        format_number(grade_stats.stddev(), _DECIMAL_PLACE), grade_range_stat_list, grade_stats.count)
 
     reason_msg = ''
     if role == 'STUD' and (stats is None or stats.count < STUD_NUM_TO_DISP_ACTSTAT):
@@ -302,8 +288,8 @@ def generate_letter_activity_stat(activity, role):
     if role == 'STUD' and activity.status != 'RLS':
         return None, 'Summary statistics disabled for unreleased activities.'
 
-    student_grade_list = fetch_students_letter_grade(activity)
-    sorted_grades = sorted_letters(student_grade_list) 
+    grade_stats = ActivityStats.for_activity(activity)
+    sorted_grades = [g for g, c in grade_stats.values_sorted() for _ in range(c)]
     if not sorted_grades:
         if role == 'STUD':
             return None, 'Summary statistics disabled for small classes.'
@@ -312,11 +298,11 @@ def generate_letter_activity_stat(activity, role):
     if role == 'STUD' and not activity.showstats():
         return None, 'Summary stats disabled by instructor.'
 
-    student_grade_list_count = len(student_grade_list)
+    student_grade_list_count = len(sorted_grades)
     if role == 'STUD' and not activity.showhisto():
         grade_range_stat_list = []
     else:
-        grade_range_stat_list = generate_grade_range_stat_lettergrade(student_grade_list)
+        grade_range_stat_list = generate_grade_range_stat_lettergrade(sorted_grades)
     median=median_letters(sorted_grades)
     max=max_letters(sorted_grades)
     min=min_letters(sorted_grades)
@@ -376,6 +362,23 @@ def generate_grade_range_stat(student_grade_list, grade_range=10):
     return stats
 
 
+def grade_range_stat_from_histogram(histogram):
+    """
+    The generate_grade_range_stat result for the grades counted in histogram (as maintained in ActivityStats).
+    """
+    stats = [GradeRangeStat("<0%", histogram[0])] \
+            + [GradeRangeStat("%i\u2013%i%%" % (i*10, (i+1)*10), histogram[i+1]) for i in range(10)] \
+            + [GradeRangeStat(">100%", histogram[-1])]
+
+    # remove extreme bins if not used
+    if stats[0].stud_count == 0:
+        stats = stats[1:]
+    if stats[-1].stud_count == 0:
+        stats = stats[:-1]
+
+    return stats
+
+
 def generate_grade_range_stat_lettergrade(student_lettergrade_list,grade_range=11):
     if grade_range ==11:
         grade_range_stat_list = [GradeRangeStat('other', 0), GradeRangeStat('F', 0), GradeRangeStat('D', 0), GradeRangeStat('C-', 0),
@@ -419,48 +422,17 @@ def fetch_students_numeric_grade(activity):
     """
     This function return a list of all students' grade in a course activity.
     """
-    student_list = activity.offering.members.filter(person__role='STUD')
-    grade_list = NumericGrade.objects.filter(activity=activity).exclude(flag="NOGR")\
-                        .select_related('member','member__person') 
-
-    student_grade_list = []
-    for student in student_list:
-    #student_found = False
-        for grade in grade_list:
-            if grade.member.person == student:
-            #student_found = True
-                student_grade_list.append(grade.value)
-                break
-        #if not student_found:
-        #    student_grade_list.append(_DEFAULT_NUMERIC_GRADE)
-
-    return student_grade_list
+    return list(NumericGrade.objects.filter(activity=activity, member__role='STUD').exclude(flag="NOGR")
+                .values_list('value', flat=True))
 
 def fetch_students_letter_grade(activity):
     """
-    This function return a list of all students' grade in a course activity. If student does not
-    have any grade yet, the numeric grade is default to 0.
+    This function return a list of all students' letter grade in a course activity.
     """
+    return list(LetterGrade.objects.filter(activity=activity, member__role='STUD').exclude(flag="NOGR")
+                .values_list('letter_grade', flat=True))
 
-
-    student_list = activity.offering.members.filter(person__role='STUD')
-    grade_list = LetterGrade.objects.filter(activity=activity).exclude(flag="NOGR")\
-                        .select_related('member','member__person') 
-
-    student_grade_list = []
-    for student in student_list:
-        #student_found = False
-        for grade in grade_list:
-            if grade.member.person == student:
-                #student_found = True
-                student_grade_list.append(grade.letter_grade)
-                break
-        #if not student_found:
-        #    student_grade_list.append(_DEFAULT_NUMERIC_GRADE)
-
-    return student_grade_list
-
-def calculate_letter_grade(course, activity):
+def calculate_letter_grade(course, activity, student=None):
     """
     Calculate all the student's grade in the course's CalletterActivity.
     If student param is specified, this student's grade is calculated instead
@@ -472,79 +444,111 @@ def calculate_letter_grade(course, activity):
     if not isinstance(activity, CalLetterActivity):
         raise TypeError('CalLetterActivity type is required')
 
-    # calculate for all student
-    student_list = Member.objects.filter(offering=course, role='STUD')
-    letter_grade_list = LetterGrade.objects.filter(activity = activity).select_related('member') 
+    if student != None: # calculate for one student
+        if not isinstance(student, Member):
+            raise TypeError('Member type is required')
+        student_list = [student]
+    else: # calculate for all student
+        student_list = Member.objects.filter(offering=course, role='STUD')
 
-    ignored = 0
-    for s in student_list:
-        # calculate grade
+    results = letter_grades_for(activity, student_list)
 
-        result = generate_lettergrades(s,activity)
-
-        # save grade
-        member_found = False
-        for letter_grade in letter_grade_list:
-            if letter_grade.member == s:
-                member_found = True     
-                if letter_grade.flag != "CALC":
-                    ignored += 1
-                elif result != letter_grade.letter_grade or letter_grade.flag != "CALC":
-                    # ignore manually-set grades; only save when the value changes
-                    letter_grade.letter_grade = result
-                    letter_grade.flag = "CALC"
-                    letter_grade.save(newsitem=False, entered_by=None)
-                break
-        if not member_found:
-            letter_grade = LetterGrade(activity=activity, member=s,
-                                         letter_grade=result, flag='CALC')
-            letter_grade.save(newsitem=False, entered_by=None)
-    return ignored
-
-def generate_lettergrades(s,activity):
-
-    cutoffs=activity.get_cutoffs()
-    numeric_source = activity.numeric_activity
-    exam_activity=activity.exam_activity
-
-    if exam_activity:
-        # handle the N and DE logic from the exam activity
-        exam_grades = NumericGrade.objects.filter(activity=exam_activity, member=s) or LetterGrade.objects.filter(activity=exam_activity, member=s)
-        if len(exam_grades)==0 or exam_grades[0].flag == 'NOGR':
-            return 'N'
-        elif exam_grades[0].flag == 'EXCU':
-            return 'DE'
-
-    grades = NumericGrade.objects.filter(activity=numeric_source, member=s)
-    if len(grades)==0 or grades[0].flag=='NOGR':
-        return 'N'
-
-    grade = grades[0].value
-
-    if grade>=cutoffs[0]:
-        letter_grade='A+'
-    elif grade>=cutoffs[1]:
-        letter_grade='A'
-    elif grade>=cutoffs[2]:
-        letter_grade='A-'
-    elif grade>=cutoffs[3]:
-        letter_grade='B+'
-    elif grade>=cutoffs[4]:
-        letter_grade='B'
-    elif grade>=cutoffs[5]:
-        letter_grade='B-'
-    elif grade>=cutoffs[6]:
-        letter_grade='C+'
-    elif grade>=cutoffs[7]:
-        letter_grade='C'
-    elif grade>=cutoffs[8]:
-        letter_grade='C-'
-    elif grade>=cutoffs[9]:
-        letter_grade='D'
-    else:
-        letter_grade='F'
+    # save grades, ignoring manually-set grades and only saving when the value changes
+    changes = bulk_save_grades(activity, results, entered_by=None, flag='CALC', keep_manual=True, newsitem=False)
+    return changes.ignored
+
+
+# CalLetterActivity.LETTERS from lowest to highest, to go with ascending cutoffs
+_LETTERS_ASCENDING = list(reversed(CalLetterActivity.LETTERS))
+
+def letter_for_grade(grade, ascending_cutoffs):
+    """
+    The letter for this numeric grade: ascending_cutoffs is reversed(activity.get_cutoffs()) (so the lower bounds
+    for D, C-, ..., A+).
+    """
+    return _LETTERS_ASCENDING[bisect.bisect_right(ascending_cutoffs, grade)]
+
+def load_letter_sources(activity, members=None):
+    """
+    Fetch the grades a CalLetterActivity is calculated from, in two queries.
 
-    return letter_grade
+    Returns (source, exam): dicts of member_id -> (grade, flag) for the numeric source activity and the exam
+    activity (which is empty if there's no exam activity).
+    """
+    source = NumericGrade.objects.filter(activity_id=activity.numeric_activity_id)
+    if members is not None:
+        source = source.filter(member__in=members)
+    source = dict((m, (v, f)) for m, v, f in source.values_list('member_id', 'value', 'flag'))
+
+    exam = {}
+    if activity.exam_activity_id:
+        # the exam activity could be numeric or letter: only one of these will find anything
+        exam_grades = [NumericGrade.objects.filter(activity_id=activity.exam_activity_id),
+                       LetterGrade.objects.filter(activity_id=activity.exam_activity_id)]
+        for grades in exam_grades:
+            if members is not None:
+                grades = grades.filter(member__in=members)
+            exam.update((m, (None, f)) for m, f in grades.values_list('member_id', 'flag'))
+    return source, exam
+
+def letter_grades_for(activity, members, cutoffs=None, sources=None):
+    """
+    Calculate the CalLetterActivity's letter grade for each of the members: returns a dict of member -> letter.
+
+    Uses the activity's cutoffs, unless others are given. sources is the result of load_letter_sources, if the
+    caller already has it.
+    """
+    members = list(members)
+    if cutoffs is None:
+        cutoffs = activity.get_cutoffs()
+    ascending_cutoffs = list(reversed(cutoffs))
+    if sources is None:
+        sources = load_letter_sources(activity, members if len(members) == 1 else None)
+    source, exam = sources
+
+    results = {}
+    for m in members:
+        if activity.exam_activity_id:
+            # handle the N and DE logic from the exam activity
+            _, exam_flag = exam.get(m.id, (None, 'NOGR'))
+            if exam_flag == 'NOGR':
+                results[m] = 'N'
+                continue
+            elif exam_flag == 'EXCU':
+                results[m] = 'DE'
+                continue
+
+        grade, flag = source.get(m.id, (None, 'NOGR'))
+        if flag == 'NOGR':
+            results[m] = 'N'
+        else:
+            results[m] = letter_for_grade(grade, ascending_cutoffs)
+    return results
+
+def generate_lettergrades(s, activity):
+    """
+    Calculate the CalLetterActivity's letter grade for one student.
+    """
+    return letter_grades_for(activity, [s])[s]
+
+def preview_letter_grades(activity, cutoffs):
+    """
+    What-if for proposed cutoffs: the histogram of letter grades (a dict of letter -> count) the class would get,
+    without saving anything.
+
+    Manually-set grades aren't overwritten by calculate_letter_grade, so they are counted as they are.
+    """
+    students = list(Member.objects.filter(offering_id=activity.offering_id, role='STUD'))
+    manual = dict((m, (l, f)) for m, l, f
+                  in LetterGrade.objects.filter(activity_id=activity.id, member__role='STUD').exclude(flag='CALC')
+                  .values_list('member_id', 'letter_grade', 'flag'))
+    results = letter_grades_for(activity, [s for s in students if s.id not in manual], cutoffs=cutoffs)
+    manual_letters = [l for l, f in manual.values() if f != 'NOGR']
+
+    histogram = dict((l, 0) for l in CalLetterActivity.LETTERS + ['N', 'DE'])
+    for letter in itertools.chain(results.values(), manual_letters):
+        histogram[letter] = histogram.get(letter, 0) + 1
+    return histogram
 
 ###############################################################################################################   
 def format_number(value, decimal_places):
@@ -608,44 +612,161 @@ def calculate_numeric_grade(course, activity, student=None):
         if not isinstance(student, Member):
             raise TypeError('Member type is required')
         student_list = [student]
-        numeric_grade_list = NumericGrade.objects.filter(activity=activity, member=student)
     else: # calculate for all student
-        student_list = Member.objects.filter(offering=course, role='STUD')
-        numeric_grade_list = NumericGrade.objects.filter(activity = activity).select_related('member')
+        student_list = Member.objects.filter(offering=course, role='STUD').select_related('person')
 
-    ignored = 0
     visible = activity.status=="RLS"
+    # compile the formula once, and fetch all of the grades it needs in one query
+    formula = CompiledFormula(parsed_expr, activity, act_dict, visible)
+    grade_matrix = load_grade_matrix(formula.activities.values(), None if student is None else student_list)
+    results = {}
     for s in student_list:
         # calculate grade
         try:
-            result = eval_parse(parsed_expr, activity, act_dict, s, visible)
-            result = decimal.Decimal(str(result)) # convert to decimal
+            result = formula(grade_matrix.get(s.id, {}))
+            results[s] = decimal.Decimal(str(result)) # convert to decimal
         except EvalException:
             raise EvalException("Formula Error: Can not evaluate formula for student: '%s'" % s.person.name())
 
-        # save grade
-        member_found = False
-        for numeric_grade in numeric_grade_list:
-            if numeric_grade.member == s:
-                member_found = True     
-                if numeric_grade.flag != "CALC":
-                    # ignore manually-set grades
-                    ignored += 1
-                elif result != numeric_grade.value:
-                    # only save when the value changes
-                    numeric_grade.value = result
-                    numeric_grade.flag = "CALC"
-                    numeric_grade.save(newsitem=False, entered_by=None)
-                break
-        if not member_found:
-            numeric_grade = NumericGrade(activity=activity, member=s,
-                                         value=str(result), flag='CALC')
-            numeric_grade.save(newsitem=False, entered_by=None)
+    # save grades, ignoring manually-set grades and only saving when the value changes
+    changes = bulk_save_grades(activity, results, entered_by=None, flag='CALC', keep_manual=True, newsitem=False)
 
     uses_unreleased = True in (act_dict[c].status != 'RLS' for c in cols_used(parsed_expr))
     hiding_info = visible and uses_unreleased and not activity.calculation_leak()
 
     if student != None:
+        numeric_grade = changes.grades[student.id]
         return StudentActivityInfo(student, activity, FLAGS['CALC'], numeric_grade.value, None).display_grade_staff(), hiding_info
     else:
-        return ignored, hiding_info
+        return changes.ignored, hiding_info
+
+
+DEPENDENCY_CACHE_TIMEOUT = 24*3600
+
+def _dependency_cache_key(offering_id):
+    return 'grades_dependency_graph_%i' % (offering_id,)
+
+def invalidate_dependency_graph(offering_id):
+    """
+    Forget the cached dependency graph for this offering: must be called when activities (or their formulas) change.
+    """
+    cache.delete(_dependency_cache_key(offering_id))
+
+def _build_dependency_graph(course):
+    """
+    Build the dependency graph for the offering's activities, from the calculated activities' formulas.
+    """
+    numeric_activities = NumericActivity.objects.filter(offering=course, deleted=False)
+    act_dict = activities_dictionary(numeric_activities)
+
+    dependents = {} # activity.id -> set of ids of calculated activities that use it directly
+    calculated = []
+    for activity in CalNumericActivity.objects.filter(offering=course, deleted=False):
+        calculated.append(activity.id)
+        try:
+            parsed_expr = parse(activity.formula, course, activity)
+        except ParseException:
+            continue
+        for col in cols_used(parsed_expr):
+            if col in act_dict:
+                dependents.setdefault(act_dict[col].id, set()).add(activity.id)
+
+    for activity in CalLetterActivity.objects.filter(offering=course, deleted=False):
+        calculated.append(activity.id)
+        dependents.setdefault(activity.numeric_activity_id, set()).add(activity.id)
+        if activity.exam_activity_id:
+            dependents.setdefault(activity.exam_activity_id, set()).add(activity.id)
+
+    # topological order of the calculated activities (Kahn's algorithm). Anything in a reference cycle can never be
+    # calculated sensibly, so is left out of the order (and never recalculated automatically).
+    calculated = set(calculated)
+    in_degree = dict((a, 0) for a in calculated)
+    for source, targets in dependents.items():
+        for t in targets:
+            if source in calculated:
+                in_degree[t] += 1
+    ready = sorted(a for a, d in in_degree.items() if d == 0)
+    order = []
+    while ready:
+        a = ready.pop(0)
+        order.append(a)
+        for t in sorted(dependents.get(a, [])):
+            in_degree[t] -= 1
+            if in_degree[t] == 0:
+                ready.append(t)
+
+    return {
+        'dependents': dict((source, sorted(targets)) for source, targets in dependents.items()),
+        'order': order,
+    }
+
+def activity_dependency_graph(course):
+    """
+    Return the dependency graph for the offering's activities: a dict with
+      'dependents': activity.id -> list of ids of calculated activities that use it directly,
+      'order': ids of calculated activities in an order they can safely be calculated in.
+
+    Cached per offering, and invalidated when any of its activities are saved.
+    """
+    key = _dependency_cache_key(course.id)
+    graph = cache.get(key)
+    if graph is None:
+        graph = _build_dependency_graph(course)
+        cache.set(key, graph, DEPENDENCY_CACHE_TIMEOUT)
+    return graph
+
+def dependent_activities(course, activity_id):
+    """
+    Ids of the calculated activities that depend on this activity, directly or transitively, in calculation order.
+    """
+    graph = activity_dependency_graph(course)
+    dependents = graph['dependents']
+    found = set()
+    todo = [activity_id]
+    while todo:
+        a = todo.pop()
+        for t in dependents.get(a, []):
+            if t not in found:
+                found.add(t)
+                todo.append(t)
+
+    return [a for a in graph['order'] if a in found]
+
+def recalculate_dependents(activity, member=None):
+    """
+    Recalculate this member's grades in every calculated activity that depends on the given activity, in dependency
+    order. If member is None, recalculate for the whole class. Activities whose formula can't currently be evaluated
+    are skipped.
+
+    Returns the list of recalculated activities.
+    """
+    course = activity.offering
+    if member is not None and member.role != 'STUD':
+        return []
+
+    recalculated = []
+    for activity_id in dependent_activities(course, activity.id):
+        calc_activity = _calculated_activity(activity_id)
+        if calc_activity is None:
+            continue
+        try:
+            if isinstance(calc_activity, CalNumericActivity):
+                calculate_numeric_grade(course, calc_activity, member)
+            elif isinstance(calc_activity, CalLetterActivity):
+                calculate_letter_grade(course, calc_activity, member)
+        except (ValidationError, EvalException, KeyError):
+            continue
+        recalculated.append(calc_activity)
+
+    return recalculated
+
+def _calculated_activity(activity_id):
+    """
+    Return the calculated activity with this id, as its most specific class (or None if it's gone).
+    """
+    for ActivityType in [CalNumericActivity, CalLetterActivity]:
+        try:
+            return ActivityType.objects.select_related('offering').get(id=activity_id, deleted=False)
+        except ActivityType.DoesNotExist:
+            pass
+    return None
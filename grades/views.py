@@ -6,7 +6,7 @@ import urllib.request, urllib.parse, urllib.error
 
 from django.core.cache import cache
 from django.urls import reverse
-from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.http import HttpResponseRedirect, HttpResponse, Http404, StreamingHttpResponse, JsonResponse
 from django.db.models import Q
 from django.db.models.aggregates import Max
 from django.shortcuts import render, get_object_or_404
@@ -27,6 +27,7 @@ from grades.models import Activity, NumericActivity, LetterActivity, CalNumericA
 from grades.models import NumericGrade, LetterGrade
 from grades.models import CalLetterActivity, ACTIVITY_TYPES, FLAGS
 from grades.models import neaten_activity_positions
+from grades.gradebook import GradebookMatrix, gradebook_rows
 from grades.forms import NumericActivityForm, LetterActivityForm, CalNumericActivityForm, MessageForm
 from grades.forms import ActivityFormEntry, FormulaFormEntry, StudentSearchForm, FORMTYPE
 from grades.forms import GROUP_STATUS_MAP, CourseConfigForm, CalLetterActivityForm, CutoffForm
@@ -34,7 +35,7 @@ from grades.formulas import EvalException, activities_dictionary, eval_parse
 from grades.utils import reorder_course_activities
 from grades.utils import ORDER_TYPE, FormulaTesterActivityEntry, FakeActivity, FakeEvalActivity
 from grades.utils import generate_numeric_activity_stat,generate_letter_activity_stat
-from grades.utils import ValidationError, calculate_numeric_grade, calculate_letter_grade
+from grades.utils import ValidationError, calculate_numeric_grade, calculate_letter_grade, preview_letter_grades
 
 from marking.models import get_group_mark, StudentActivityMark, GroupActivityMark, ActivityComponent
 
@@ -533,6 +534,23 @@ def edit_cutoffs(request, course_slug, activity_slug):
     return resp
 
 
+@requires_course_staff_by_slug
+def preview_cutoffs(request, course_slug, activity_slug):
+    """
+    Ajax what-if for the edit_cutoffs page: the letter grade histogram the proposed cutoffs would give, as JSON.
+    Nothing is saved.
+    """
+    course = get_object_or_404(CourseOffering, slug=course_slug)
+    activity = get_object_or_404(CalLetterActivity, slug=activity_slug, offering=course, deleted=False)
+    form = CutoffForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    histogram = preview_letter_grades(activity, form.cleaned_data['cutoffs'])
+    letters = CalLetterActivity.LETTERS + ['N', 'DE']
+    return JsonResponse({'histogram': [[l, histogram[l]] for l in letters]})
+
+
 def _cutoffsdict(cutoff):
     data = dict()
     data['ap'] = cutoff[0]
@@ -1178,72 +1196,32 @@ def all_grades(request, course_slug):
     students = Member.objects.filter(offering=course, role="STUD").select_related('person', 'offering')
     
     # get grade data into a format we can work with
-    grades = {}
-    for a in activities:
-        grades[a.slug] = {}
-        if hasattr(a, 'numericgrade_set'):
-            gs = a.numericgrade_set.all().select_related('member', 'member__person')
-        else:
-            gs = a.lettergrade_set.all().select_related('member', 'member__person')
-        for g in gs:
-            grades[a.slug][g.member.person.userid] = g
+    grades = GradebookMatrix.for_offering(course).grades_by_slug(activities, students)
 
     context = {'course': course, 'students': students, 'activities': activities, 'grades': grades}
     return render(request, 'grades/all_grades.html', context)
 
 
-def _all_grades_output(response, course):
-    activities = all_activities_filter(offering=course)
-    students = Member.objects.filter(offering=course, role="STUD").select_related('person')
+class _Echo(object):
+    """
+    File-like object for csv.writer that just returns the data written, so rows can be streamed.
+    """
+    def write(self, value):
+        return value
+
+
+def _all_grades_csv_chunks(course):
+    writer = csv.writer(_Echo())
+    for row in gradebook_rows(course):
+        yield writer.writerow(row)
 
-    # get grade data into a format we can work with
-    labtut = course.labtut
-    grades = {}
-    for a in activities:
-        grades[a.slug] = {}
-        if hasattr(a, 'numericgrade_set'):
-            gs = a.numericgrade_set.all().select_related('member', 'member__person')
-        else:
-            gs = a.lettergrade_set.all().select_related('member', 'member__person')
-        for g in gs:
-            grades[a.slug][g.member.person.userid] = g
-    
-    # output results
-    writer = csv.writer(response)
-    row = ['Last name', 'First name', Person.userid_header(), Person.emplid_header()]
-    if labtut:
-        row.append('Lab/Tutorial')
-    for a in activities:
-        row.append(a.short_name)
-    writer.writerow(row)
-    
-    for s in students:
-        row = [s.person.last_name, s.person.first_name, s.person.userid, s.person.emplid]
-        if labtut:
-            row.append(s.labtut_section or '')
-        for a in activities:
-            try:
-                gr = grades[a.slug][s.person.userid]
-                if gr.flag=='NOGR':
-                    g = ''
-                else:
-                    if a.is_numeric():
-                        g = gr.value
-                    else:
-                        g = gr.letter_grade
-            except KeyError:
-                g = ''
-            row.append(g)
-        writer.writerow(row)
 
 @requires_course_staff_by_slug
 def all_grades_csv(request, course_slug):
     course = get_object_or_404(CourseOffering, slug=course_slug)
     
-    response = HttpResponse(content_type='text/csv')
+    response = StreamingHttpResponse(_all_grades_csv_chunks(course), content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="%s.csv"' % (course_slug)
-    
-    _all_grades_output(response, course)        
     return response
 
 
@@ -1485,40 +1463,37 @@ def export_all(request, course_slug):
     """
     Export everything we can about this offering
     """
-    import io, tempfile, zipfile, os, json
-    from django.http import StreamingHttpResponse
-    from wsgiref.util import FileWrapper
+    import io, os, json
+    from courselib.zipstream import ZipStream
     from marking.views import _mark_export_data, _DecimalEncoder
     from discuss.models import DiscussionTopic
 
     course = get_object_or_404(CourseOffering, slug=course_slug)
-
-    handle, filename = tempfile.mkstemp('.zip')
-    os.close(handle)
-    z = zipfile.ZipFile(filename, 'w')
+    z = ZipStream()
 
     # add all grades CSV
-    allgrades = io.StringIO()
-    _all_grades_output(allgrades, course)    
-    z.writestr("grades.csv", allgrades.getvalue())
-    allgrades.close()
-    
+    z.write_iter("grades.csv", _all_grades_csv_chunks(course))
+
     # add marking data
+    def add_marking(z, a):
+        markingdata = _mark_export_data(a)
+        markout = io.StringIO()
+        json.dump({'marks': markingdata}, markout, cls=_DecimalEncoder, indent=1)
+        z.writestr(a.slug + "-marking.json", markout.getvalue())
+
     acts = all_activities_filter(course)
     for a in acts:
         if ActivityComponent.objects.filter(numeric_activity_id=a.id):
-            markingdata = _mark_export_data(a)
-            markout = io.StringIO()
-            json.dump({'marks': markingdata}, markout, cls=_DecimalEncoder, indent=1)
-            z.writestr(a.slug + "-marking.json", markout.getvalue())
-            del markout, markingdata
-    
+            z.write_later(lambda z, a=a: add_marking(z, a))
+
     # add submissions
-    acts = all_activities_filter(course)
-    for a in acts:
-        submission_info = SubmissionInfo.for_activity(a)
-        submission_info.get_all_components()
-        submission_info.generate_submission_contents(z, prefix=a.slug+'-submissions' + os.sep, always_summary=False)
+    def add_submissions(z):
+        submission_infos = SubmissionInfo.for_activities(acts)
+        SubmissionInfo.load_components(submission_infos, all_components=True)
+        for a, submission_info in zip(acts, submission_infos):
+            submission_info.generate_submission_contents(z, prefix=a.slug+'-submissions' + os.sep, always_summary=False)
+
+    z.write_later(add_submissions)
 
     # add discussion
     if course.discussion():
@@ -1529,14 +1504,4 @@ def export_all(request, course_slug):
         z.writestr("discussion.json", discussout.getvalue())
         del discussion_data, discussout
 
-    # return the zip file
-    z.close()
-    zipdata = open(filename, 'rb')
-    response = StreamingHttpResponse(FileWrapper(zipdata), content_type='application/zip')
-    response['Content-Length'] = os.path.getsize(filename)    
-    response['Content-Disposition'] = 'attachment; filename="' + course.slug + '.zip"'
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
-    return response
+    return z.response(course.slug + '.zip')
@@ -20,7 +20,7 @@ from .models import get_activity_mark_by_id, get_activity_mark_for_student, get_
 from .models import copyCourseSetup, neaten_activity_positions, activity_marks_from_JSON
 from coredata.models import Person, CourseOffering, Member
 from grades.models import FLAGS, Activity, NumericActivity, NumericGrade
-from grades.models import LetterActivity, LetterGrade, LETTER_GRADE_CHOICES_IN, get_entry_person
+from grades.models import LetterActivity, LetterGrade, LETTER_GRADE_CHOICES_IN, get_entry_person, bulk_save_grades
 from log.models import LogEntry
 from groups.models import Group, GroupMember, all_activities_filter
 
@@ -1110,46 +1110,44 @@ def _mark_all_students_letter(request, course, activity):
         memberships = Member.objects.select_related('person').filter(offering = course, role = 'STUD')
 
         if request.method == 'POST' and request.GET.get('import') != 'true':
-            lgrades = []   
+            lgrades = []
+            existing_grades = dict((g.member_id, g) for g in LetterGrade.objects.filter(activity=activity))
             # get data from the mark entry forms
-            for member in memberships: 
-                student = member.person  
+            for member in memberships:
+                student = member.person
                 entry_form = MarkEntryForm_LetterGrade(data = request.POST, prefix = student.userid)
                 if not entry_form.is_valid():
                     error_info.append("Error found")
-                lgrade = None
-                try:
-                    lgrade = LetterGrade.objects.get(activity = activity, member = member)
-                except LetterGrade.DoesNotExist:
+                lgrade = existing_grades.get(member.id)
+                if lgrade is None:
                     current_grade = 'no grade'
                 else:
-                    current_grade = lgrade.letter_grade                    
-                lgrades.append(lgrade) 
-                rows.append({'student': student, 'member': member, 'current_grade' : current_grade, 'form' : entry_form})    
-           
-            # save if needed 
+                    current_grade = lgrade.letter_grade
+                lgrades.append(lgrade)
+                rows.append({'student': student, 'member': member, 'current_grade' : current_grade, 'form' : entry_form})
+
+            # save if needed
             if not error_info:
                 entered_by = get_entry_person(request.user.username)
-                updated = 0                 
+                new_values = {}
                 for i in range(len(memberships)):
-                    student = memberships[i].person  
                     lgrade = lgrades[i]
-                    new_value = rows[i]['form'].cleaned_data['value'] 
+                    new_value = rows[i]['form'].cleaned_data['value']
                     # the new mark is blank or the new mark is the same as the old one, do nothing
-                    if new_value not in LETTER_GRADE_CHOICES_IN:  
+                    if new_value not in LETTER_GRADE_CHOICES_IN:
                         continue
                     if lgrade is not None and lgrade.letter_grade == new_value:
                         # if the student originally has a grade status other than 'GRAD',
                         # we do not override that status
-                        continue 
-                    # save data 
-                    if not lgrade:
-                        lgrade = LetterGrade(activity = activity, member = memberships[i]);
-                    lgrade.letter_grade = new_value
-                    lgrade.flag = "GRAD"
-                    lgrade.save(entered_by=entered_by)
-                   
-                    updated += 1    
+                        continue
+                    new_values[memberships[i]] = new_value
+
+                # save data
+                changes = bulk_save_grades(activity, new_values, entered_by=entered_by, flag="GRAD")
+                updated = len(changes.changed)
+                for lgrade in changes.changed:
+                    student = lgrade.member.person
+                    new_value = lgrade.letter_grade
 
                     # LOG EVENT
                     l = LogEntry(userid=request.user.username,
@@ -1254,29 +1252,27 @@ def _mark_all_students_numeric(request, course, activity):
         memberships = Member.objects.select_related('person').filter(offering=course, role='STUD')   
         
         if request.method == 'POST' and request.GET.get('import') != 'true':
-            ngrades = []   
+            ngrades = []
+            existing_grades = dict((g.member_id, g) for g in NumericGrade.objects.filter(activity=activity))
             # get data from the mark entry forms
-            for member in memberships: 
-                student = member.person  
+            for member in memberships:
+                student = member.person
                 entry_form = MarkEntryForm(data = request.POST, prefix=student.userid)
                 if not entry_form.is_valid():
                     error_info.append("Error found")
-                ngrade = None
-                try:
-                    ngrade = NumericGrade.objects.get(activity=activity, member=member)
-                except NumericGrade.DoesNotExist:
+                ngrade = existing_grades.get(member.id)
+                if ngrade is None:
                     current_grade = 'no grade'
                 else:
-                    current_grade = ngrade.value                    
-                ngrades.append(ngrade) 
+                    current_grade = ngrade.value
+                ngrades.append(ngrade)
                 rows.append({'student': student, 'member': member, 'current_grade' : current_grade, 'form' : entry_form})
 
-            # save if needed 
+            # save if needed
             if not error_info:
                 entered_by = get_entry_person(request.user.username)
-                updated = 0                 
+                new_values = {}
                 for i in range(len(memberships)):
-                    student = memberships[i].person  
                     ngrade = ngrades[i]
                     new_value = rows[i]['form'].cleaned_data['value']
                     # the new mark is blank or the new mark is the same as the old one, do nothing
@@ -1285,26 +1281,26 @@ def _mark_all_students_numeric(request, course, activity):
                     if ngrade is not None and ngrade.value == new_value:
                         # if the student originally has a grade status other than 'GRAD',
                         # we do not override that status
-                        continue 
-                    # save data 
-                    if not ngrade:
-                        ngrade = NumericGrade(activity=activity, member=memberships[i]);
-                    ngrade.value = new_value
-                    ngrade.flag = "GRAD"
-                    ngrade.save(entered_by=entered_by)
-                    
-                    updated += 1     
+                        continue
+                    new_values[memberships[i]] = new_value
+
+                # save data
+                changes = bulk_save_grades(activity, new_values, entered_by=entered_by, flag="GRAD")
+                updated = len(changes.changed)
+                for ngrade in changes.changed:
+                    student = ngrade.member.person
+                    new_value = ngrade.value
                     if new_value < 0:
                         warning_info.append("Negative mark given to %s on %s" %(student.userid, activity.name))
                     elif new_value > activity.max_grade:
                         warning_info.append("Bonus mark given to %s on %s" %(student.userid, activity.name))
-                   
+
                     #LOG EVENT
                     l = LogEntry(userid=request.user.username,
                           description=("bulk marked %s for %s: %s/%s") % (activity, student.userid, new_value, activity.max_grade),
                           related_object=ngrade)
-                    l.save()                  
-               
+                    l.save()
+
                 if updated > 0:
                     messages.add_message(request, messages.SUCCESS, "Marks for all students on %s saved (%s students' grades updated)!" % (activity.name, updated))
                     for warning in warning_info:
@@ -78,7 +78,10 @@ class Page(models.Model):
     def save(self, *args, **kwargs):
         assert self.label_okay(self.label) is None
         self.expire_offering_cache()
+        adding = self._state.adding
         super(Page, self).save(*args, **kwargs)
+        if adding:
+            CourseOffering.update_content_counts(self.offering_id)
 
     def releasedate(self):
         d = self.releasedate_txt()
@@ -463,6 +466,12 @@ def clear_offering_cache(instance, **kwargs):
 models.signals.post_save.connect(clear_offering_cache)
 
 
+def _page_deleted(instance, **kwargs):
+    CourseOffering.update_content_counts(instance.offering_id)
+
+models.signals.post_delete.connect(_page_deleted, sender=Page)
+
+
 class PagePermission(models.Model):
     """
     An additional person who has permission to view pages for this offering
@@ -0,0 +1,240 @@
+"""
+A local-disk cache of the "all submissions" ZIP file for each activity.
+
+Instructors download the activity's submissions repeatedly while marking. The archive built the first time is kept in
+settings.ARCHIVE_CACHE_PATH, along with a JSON manifest recording which file each entry came from, and is served
+directly as long as its entries are still the ones the archive would be built from (so any change to the
+submissions, components or groups is noticed). When they aren't, only the new files are compressed and appended: files already in the archive are never recompressed unless one of them has been superseded (by a
+resubmission in an activity that only keeps the most recent), which forces a full rebuild.
+
+The small generated entries (summary.csv, LATE.txt, text and URL submissions) are kept at the end of the archive and
+rewritten on every build. Least-recently-used archives are removed when the cache grows past
+settings.ARCHIVE_CACHE_MAX_SIZE.
+"""
+
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse
+
+from courselib.zipstream import ZipStream, compress_type_for
+
+ARCHIVE_CACHE_STATS = ['hit', 'append', 'rebuild']
+
+
+def _count(stat):
+    key = 'archive-cache-' + stat
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # expired between the add and incr
+        pass
+
+
+def archive_cache_stats():
+    """
+    Number of archives served from the cache, extended, and completely rebuilt.
+    """
+    values = cache.get_many(['archive-cache-' + s for s in ARCHIVE_CACHE_STATS])
+    return dict((s, values.get('archive-cache-' + s, 0)) for s in ARCHIVE_CACHE_STATS)
+
+
+def cached_archives():
+    """
+    List of (path, size, last used) for the archives currently in the cache, least-recently used first.
+    """
+    try:
+        names = os.listdir(settings.ARCHIVE_CACHE_PATH)
+    except FileNotFoundError:
+        return []
+
+    archives = []
+    for n in names:
+        if not n.endswith('.zip'):
+            continue
+        path = os.path.join(settings.ARCHIVE_CACHE_PATH, n)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        archives.append((path, st.st_size, st.st_mtime))
+    archives.sort(key=lambda a: a[2])
+    return archives
+
+
+def evict(max_size=None):
+    """
+    Remove least-recently used archives until the cache is no bigger than max_size bytes.
+    """
+    if max_size is None:
+        max_size = settings.ARCHIVE_CACHE_MAX_SIZE
+    archives = cached_archives()
+    total = sum(size for _, size, _ in archives)
+    for path, size, _ in archives:
+        if total <= max_size:
+            break
+        for p in [path, path[:-4] + '.json']:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def archive_key(files, generated):
+    """
+    A digest of the archive's entries (as returned by _archive_entries): changes whenever the archive would.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([(arcname, ident, compress_type) for arcname, _, ident, compress_type in files]).encode('utf8'))
+    for arcname, data, compress_type in generated:
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        h.update(json.dumps([arcname, len(data), compress_type]).encode('utf8'))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _archive_entries(submission_info):
+    """
+    Collect the entries for the activity's archive, split into the submitted files (with an identity that changes
+    if the file does) and the generated contents.
+    """
+    submission_info.get_all_components()
+    z = ZipStream()
+    submission_info.generate_submission_contents(z, prefix='')
+
+    files = []
+    generated = []
+    for kind, arcname, content, compress_type in z.entries:
+        if kind == 'file':
+            st = os.stat(content)
+            files.append((arcname, content, [content, st.st_size, st.st_mtime_ns], compress_type))
+        elif kind == 'data':
+            generated.append((arcname, content, compress_type))
+        else:
+            raise ValueError('unexpected %r entry in activity archive' % (kind,))
+    return files, generated
+
+
+def _write_files(z, files):
+    for arcname, path, _, compress_type in files:
+        z.write(path, arcname, compress_type=compress_type or compress_type_for(arcname))
+    return z.fp.tell()
+
+
+def _write_generated(z, generated):
+    for arcname, data, compress_type in generated:
+        zinfo = zipfile.ZipInfo(arcname, date_time=datetime.datetime.now().timetuple()[:6])
+        zinfo.external_attr = 0o600 << 16
+        z.writestr(zinfo, data, compress_type=compress_type or compress_type_for(arcname))
+
+
+def _drop_tail(z, offset):
+    """
+    Forget the entries in the ZipFile (opened in 'a' mode) from this offset on, so new entries overwrite them.
+    """
+    keep = [zi for zi in z.filelist if zi.header_offset < offset]
+    z.filelist = keep
+    z.NameToInfo = dict((zi.filename, zi) for zi in keep)
+    z.start_dir = offset
+    z.fp.seek(offset)
+    z.fp.truncate()
+
+
+def _build(files, generated, key, zippath, manifestpath):
+    """
+    Bring the cached archive up to date. Returns 'append' or 'rebuild' depending on what was necessary.
+    """
+    try:
+        with open(manifestpath, 'r') as fh:
+            manifest = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        manifest = None
+
+    old = manifest['files'] if manifest and os.path.exists(zippath) else None
+    new = dict((arcname, ident) for arcname, _, ident, _ in files)
+    # can only append if every file in the old archive is still there unchanged
+    append = old is not None and all(new.get(arcname) == ident for arcname, ident in old.items())
+
+    handle, tmppath = tempfile.mkstemp(dir=settings.ARCHIVE_CACHE_PATH, suffix='.tmp')
+    os.close(handle)
+    try:
+        if append:
+            # copy (not recompress) what we have, so anyone still downloading the old archive isn't disturbed
+            shutil.copyfile(zippath, tmppath)
+            with zipfile.ZipFile(tmppath, 'a', allowZip64=True) as z:
+                _drop_tail(z, manifest['data_offset'])
+                data_offset = _write_files(z, [f for f in files if f[0] not in old])
+                _write_generated(z, generated)
+        else:
+            with zipfile.ZipFile(tmppath, 'w', allowZip64=True) as z:
+                data_offset = _write_files(z, files)
+                _write_generated(z, generated)
+
+        os.replace(tmppath, zippath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    manifest = {'key': key, 'files': new, 'data_offset': data_offset}
+    with open(manifestpath + '.tmp', 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(manifestpath + '.tmp', manifestpath)
+
+    return 'append' if append else 'rebuild'
+
+
+def activity_archive_response(submission_info):
+    """
+    Response with the activity's ZIP file of submissions, from the cache if possible.
+    """
+    activity = submission_info.activity
+    filename = '%s.zip' % (activity.slug,)
+    if settings.ARCHIVE_CACHE_MAX_SIZE <= 0:
+        submission_info.get_all_components()
+        z = ZipStream()
+        submission_info.generate_submission_contents(z, prefix='')
+        return z.response(filename)
+
+    os.makedirs(settings.ARCHIVE_CACHE_PATH, exist_ok=True)
+    base = os.path.join(settings.ARCHIVE_CACHE_PATH, 'activity-%i' % (activity.id,))
+    zippath = base + '.zip'
+    manifestpath = base + '.json'
+
+    with open(base + '.lock', 'w') as lock:
+        # one process at a time updates each activity's archive
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # collecting the entries is cheap: nothing is read or compressed until the archive is written
+        files, generated = _archive_entries(submission_info)
+        key = archive_key(files, generated)
+        try:
+            with open(manifestpath, 'r') as fh:
+                hit = json.load(fh)['key'] == key and os.path.exists(zippath)
+        except (FileNotFoundError, ValueError, KeyError):
+            hit = False
+
+        if hit:
+            stat = 'hit'
+            os.utime(zippath) # mark as recently used
+        else:
+            stat = _build(files, generated, key, zippath, manifestpath)
+
+        # once it's open, we can keep sending this version even if it is replaced or evicted
+        fh = open(zippath, 'rb')
+
+    _count(stat)
+    if stat != 'hit':
+        evict()
+
+    return FileResponse(fh, as_attachment=True, filename=filename, content_type='application/zip')
@@ -3,6 +3,7 @@ from django.forms import ModelForm
 from django.conf import settings
 from django.utils.safestring import mark_safe
 import gzip, zipfile
+from submission.upload import check_zip_limits, UploadRejected
 
 
 class ComponentForm(ModelForm):
@@ -142,6 +143,14 @@ class SubmissionForm(ModelForm):
     def check_uploaded_data(self, data):
         if self.check_is_empty(data):
             raise forms.ValidationError("No file submitted.")
+        if getattr(data, 'upload_error', None):
+            # rejected by SubmissionUploadHandler as it arrived
+            raise forms.ValidationError(data.upload_error)
+        if not getattr(data, 'zip_checked', False):
+            try:
+                check_zip_limits(data)
+            except UploadRejected as e:
+                raise forms.ValidationError(str(e))
         self.check_type(data)
         self.check_filename(data)
         if not self.check_size(data):
@@ -162,3 +171,18 @@ def make_form_from_list(component_list, request=None):
         component_form_list.append(data)
     return component_form_list
 
+
+def upload_limits(component_list):
+    """
+    Function to give SubmissionUploadHandler the limits for each of these components' form fields.
+    """
+    components = dict((str(c.id), c) for c in component_list)
+    def limits_for_field(field_name):
+        prefix, _, _ = field_name.partition('-')
+        component = components.get(prefix)
+        if component is None:
+            return None
+        allowed_types = getattr(component.Type.Component, 'allowed_types', None)
+        return component.max_size * 1024, list(allowed_types) if allowed_types else None
+    return limits_for_field
+
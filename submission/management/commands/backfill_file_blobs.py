@@ -0,0 +1,56 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from submission.models import ALL_TYPE_CLASSES, SubmittedComponent, SubmittedFileBlob
+
+
+class Command(BaseCommand):
+    help = 'Move submitted files that predate the blob store into it, recording their hashes and sharing the disk ' \
+           'space of identical files. With --recount, also fix the blob reference counts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true', dest='recount',
+                            help='recalculate the blob reference counts from the submitted components')
+
+    def _backfill(self):
+        count = 0
+        missing = 0
+        for Type in ALL_TYPE_CLASSES:
+            SubmittedType = Type.SubmittedComponent
+            for sc in SubmittedType.objects.filter(sha256__isnull=True).iterator():
+                f = sc.get_fieldfile()
+                if not f:
+                    continue
+                if not os.path.isfile(f.path):
+                    missing += 1
+                    continue
+                sha256 = SubmittedFileBlob.adopt(f.path)
+                # update rather than save, so nothing else about the component changes
+                SubmittedComponent.objects.filter(id=sc.id).update(sha256=sha256)
+                count += 1
+        return count, missing
+
+    def _recount(self):
+        counts = dict(SubmittedComponent.objects.filter(sha256__isnull=False).values_list('sha256')
+                      .annotate(n=Count('id')).values_list('sha256', 'n'))
+        fixed = 0
+        for blob in SubmittedFileBlob.objects.all().iterator():
+            n = counts.get(blob.sha256, 0)
+            if n != blob.refcount:
+                fixed += 1
+                if n == 0:
+                    SubmittedFileBlob.objects.filter(sha256=blob.sha256).update(refcount=1)
+                    SubmittedFileBlob.release(blob.sha256)
+                else:
+                    SubmittedFileBlob.objects.filter(sha256=blob.sha256).update(refcount=n)
+        return fixed
+
+    def handle(self, *args, **options):
+        count, missing = self._backfill()
+        self.stdout.write('%i files added to the blob store (%i missing from disk).' % (count, missing))
+
+        if options['recount']:
+            fixed = self._recount()
+            self.stdout.write('%i blob reference counts corrected.' % (fixed,))
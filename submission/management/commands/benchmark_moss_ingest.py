@@ -0,0 +1,124 @@
+import json
+import os
+import re
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from coredata.devtest_data_generator import create_benchmark_offering
+from grades.models import NumericActivity
+from submission import moss
+from submission.models.base import SimilarityResult, SimilarityData
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'testfiles', 'moss-output')
+FIXTURE_CODE_DIR = '/tmp/tmpk2x9moss/code'
+FIXTURE_OFFERING = '2020sp-cmpt-120-d1'
+
+
+class _Rollback(Exception):
+    pass
+
+
+def build_report(outdir, matches):
+    """
+    Fill outdir with a MOSS report of this many matches, by repeating the recorded one in testfiles/moss-output.
+    Returns the file_submissions map for ingest_moss_output.
+    """
+    with open(os.path.join(FIXTURE_DIR, 'index.html'), 'rt', encoding='utf8') as fh:
+        index = fh.read()
+    head, rest = index.split('<TR><TD>', 1)
+    rows, tail = rest.rsplit('</TABLE>', 1)
+    rows = ['<TR><TD>' + r for r in rows.split('<TR><TD>')]
+    pages = {}
+    for f in os.listdir(FIXTURE_DIR):
+        m = re.match(r'^match(\d+)(.*)$', f)
+        if m:
+            with open(os.path.join(FIXTURE_DIR, f), 'rt', encoding='utf8') as fh:
+                pages[(int(m.group(1)), m.group(2))] = fh.read()
+
+    # each copy of the report is for different students, so it's a different file and submission
+    file_submissions = {}
+    index_rows = []
+    for n in range(matches):
+        orig = n % len(rows)
+        copy = '_%i/' % (n // len(rows),)
+        index_rows.append(rows[orig].replace('match%i.html' % (orig,), 'match%i.html' % (n,))
+                          .replace('/prog.py', copy + 'prog.py'))
+        for (i, suffix), content in pages.items():
+            if i != orig:
+                continue
+            content = re.sub(r'match%i([-.])' % (orig,), r'match%i\1' % (n,), content)
+            content = content.replace('/prog.py', copy + 'prog.py')
+            with open(os.path.join(outdir, 'match%i%s' % (n, suffix)), 'wt', encoding='utf8') as fh:
+                fh.write(content)
+            for fn in re.findall(re.escape(FIXTURE_CODE_DIR) + r'/(\S+prog\.py)', content):
+                file_submissions[fn] = None
+
+    with open(os.path.join(outdir, 'index.html'), 'wt', encoding='utf8') as fh:
+        fh.write(head + ''.join(index_rows) + '</TABLE>' + tail)
+    return file_submissions
+
+
+class Command(BaseCommand):
+    help = 'Time ingesting a large MOSS report (built from the recorded one in submission/testfiles/moss-output) ' \
+           'serially, in parallel, and from the parsed-report cache. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--matches', type=int, default=250, dest='matches', help='matches in the report')
+        parser.add_argument('--processes', type=int, default=None, dest='processes',
+                            help='worker processes for the parallel run (default: number of CPUs)')
+        parser.add_argument('--output', type=str, dest='output', help='file for the JSON report (default stdout)')
+
+    def _measure(self, name, func):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        self.stderr.write('%-30s %9.3f s %7i queries' % (name, elapsed, len(queries)))
+        return {'name': name, 'seconds': round(elapsed, 4), 'queries': len(queries)}
+
+    def handle(self, *args, **options):
+        report = {'database': connection.vendor, 'matches': options['matches'], 'processes': options['processes']}
+        with tempfile.TemporaryDirectory() as outdir, tempfile.TemporaryDirectory() as cachedir, \
+                override_settings(MOSS_REPORT_CACHE_PATH=cachedir):
+            file_submissions = build_report(outdir, options['matches'])
+            report['files'] = len(os.listdir(outdir))
+            try:
+                with transaction.atomic():
+                    offering = create_benchmark_offering(students=1, numeric_activities=1, calculated_activities=0)
+                    result = SimilarityResult(activity=NumericActivity.objects.filter(offering=offering).first(),
+                                              generator='MOSS', config={})
+                    result.save()
+
+                    def ingest(processes):
+                        def run():
+                            moss.ingest_moss_output(outdir, FIXTURE_CODE_DIR, FIXTURE_OFFERING, file_submissions,
+                                                    result, processes=processes)
+                        return run
+
+                    def clear():
+                        # deleting (rather than rolling back) the rows removes their files too
+                        SimilarityData.objects.filter(result=result).delete()
+                        for f in os.listdir(cachedir):
+                            os.remove(os.path.join(cachedir, f))
+
+                    report['results'] = [self._measure('serial', ingest(1))]
+                    clear()
+                    report['results'].append(self._measure('parallel', ingest(options['processes'])))
+                    SimilarityData.objects.filter(result=result).delete()
+                    report['results'].append(self._measure('cached', ingest(options['processes'])))
+                    clear()
+                    raise _Rollback()
+            except _Rollback:
+                pass
+
+        data = json.dumps(report, indent=1)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(data + '\n')
+        else:
+            self.stdout.write(data)
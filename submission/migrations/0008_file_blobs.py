@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submission', '0007_merge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmittedFileBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='submittedcomponent',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, help_text='hash of the file contents, if this component has a file', max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submission', '0008_file_blobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='similarityresult',
+            name='generator',
+            field=models.CharField(choices=[('MOSS', 'MOSS'), ('WINN', 'Local winnowing')], help_text='tool that generated the similarity results', max_length=4),
+        ),
+        migrations.CreateModel(
+            name='SimilarityFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(help_text='hex sha256 of the file contents', max_length=64)),
+                ('language', models.CharField(max_length=10)),
+                ('version', models.PositiveSmallIntegerField(help_text='submission.winnow.WINNOW_VERSION that created this')),
+                ('data', models.BinaryField(help_text='packed (hash, first line, last line) fingerprints')),
+            ],
+            options={
+                'unique_together': {('sha256', 'language', 'version')},
+            },
+        ),
+    ]
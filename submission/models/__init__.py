@@ -1,21 +1,18 @@
-import threading
-import zipfile
-import tempfile
 import os
 import errno
 import io
 import csv
 from pipes import quote
 from datetime import datetime
-from typing import List
 
-from wsgiref.util import FileWrapper
-from django.http import StreamingHttpResponse
+from django.db.models import Count
 
-from .base import SubmissionComponent, Submission, StudentSubmission, GroupSubmission, SubmittedComponent
+from .base import SubmissionComponent, Submission, StudentSubmission, GroupSubmission, SubmittedComponent, \
+    SubmittedFileBlob
 from coredata.models import Person
 from groups.models import GroupMember
 from courselib.branding import help_email
+from courselib.zipstream import ZipStream
 
 from .url import URL
 from .archive import Archive
@@ -41,63 +38,75 @@ def find_type_by_label(label):
     return None
 
 
+def load_polymorphic(Models, **filters):
+    """
+    Load the objects matching filters from all of these Models (which must be subclasses of the same concrete model,
+    like the Component or SubmittedComponent classes of ALL_TYPE_CLASSES), each as its most specific class.
+
+    One query, joining the parent table to each subclass table, finds which types are present: then there is one
+    query for each type that actually appears.
+    """
+    Base = Models[0]._meta.get_parent_list()[0]
+    # the reverse one-to-one from the parent table to each subclass is named for the subclass
+    counts = Base.objects.filter(**filters) \
+        .aggregate(**dict(('n_' + M._meta.model_name, Count(M._meta.model_name)) for M in Models))
+    objects = []
+    for M in Models:
+        if counts['n_' + M._meta.model_name]:
+            objects.extend(M.objects.filter(**filters))
+    return objects
+
+
+def select_components(activity_ids, include_deleted=False):
+    """
+    Return all components for these activities as their most specific class, as a dict of activity_id -> list.
+    """
+    filters = {'activity_id__in': activity_ids}
+    if not include_deleted:
+        filters['deleted'] = False
+    components = dict((aid, []) for aid in activity_ids)
+    for c in load_polymorphic([Type.Component for Type in ALL_TYPE_CLASSES], **filters):
+        components[c.activity_id].append(c)
+    for comps in components.values():
+        comps.sort()
+    return components
+
+
 def select_all_components(activity, include_deleted=False):
     """
     Return all components for this activity as their most specific class.
     """
-    components = [] # list of components
-    found = set() # keep track of what has been found so we can exclude less-specific duplicates.
-    for Type in ALL_TYPE_CLASSES:
-        if include_deleted:
-            comps = list(Type.Component.objects.filter(activity_id=activity.id))
-        else:
-            comps = list(Type.Component.objects.filter(activity_id=activity.id, deleted=False))
-        components.extend( (c for c in comps if c.id not in found) )
-        found.update( (c.id for c in comps) )
-
-    components.sort()
-    return components
+    return select_components([activity.id], include_deleted=include_deleted)[activity.id]
 
 
 def select_all_submitted_components(activity_id):
-    submitted_component = [] # list of submitted component
-    found = set() # keep track of what has been found so we can exclude less-specific duplicates.
-    for Type in ALL_TYPE_CLASSES:
-        subs = list(Type.SubmittedComponent.objects.filter(submission__activity_id=activity_id))
-        submitted_component.extend(s for s in subs if s.id not in found)
-        found.update( (s.id for s in subs) )
+    submitted_component = load_polymorphic([Type.SubmittedComponent for Type in ALL_TYPE_CLASSES],
+                                           submission__activity_id=activity_id)
     submitted_component.sort()
     return submitted_component
 
 
+def _get_one(Models, kwargs):
+    res = load_polymorphic(Models, **kwargs)
+    if len(res) > 1:
+        raise ValueError("Search returned multiple values.")
+    elif len(res) == 1:
+        return res[0]
+    return None
+
+
 def get_component(**kwargs):
     """
     Find the submission component (with the most specific type).  Returns None if doesn't exist.
     """
-    for Type in ALL_TYPE_CLASSES:
-        res = Type.Component.objects.filter(**kwargs)
-        res = list(res)
-        if len(res) > 1:
-            raise ValueError("Search returned multiple values.")
-        elif len(res) == 1:
-            return res[0]
-
-    return None
+    return _get_one([Type.Component for Type in ALL_TYPE_CLASSES], kwargs)
 
 
 def get_submitted_component(**kwargs):
     """
     Find the submitted component (with the most specific type).  Returns None if doesn't exist.
     """
-    for Type in ALL_TYPE_CLASSES:
-        res = Type.SubmittedComponent.objects.filter(**kwargs)
-        res = list(res)
-        if len(res) > 1:
-            raise ValueError("Search returned multiple values.")
-        elif len(res) == 1:
-            return res[0]
-
-    return None
+    return _get_one([Type.SubmittedComponent for Type in ALL_TYPE_CLASSES], kwargs)
 
 
 class SubmissionInfo(object):
@@ -120,6 +129,7 @@ class SubmissionInfo(object):
         self.submitted_components = None
         self.all_submitted_components = None
         self.is_group = self.activity.group
+        self.whole_activity = False # are self.submissions all of the activity's submissions?
 
         if student:
             if self.activity.group:
@@ -163,16 +173,40 @@ class SubmissionInfo(object):
         Gather info for a whole class on the activity.
         """
         si = cls(activity=activity)
+        si.whole_activity = True
 
         if si.activity.group:
-            si.submissions = GroupSubmission.objects.filter(activity=activity)
+            si.submissions = GroupSubmission.objects.filter(activity=activity).select_related('group')
         else:
-            si.submissions = StudentSubmission.objects.filter(activity=activity)
+            si.submissions = StudentSubmission.objects.filter(activity=activity).select_related('member__person')
 
         si.submissions = si.submissions.order_by('-created_at')
 
         return si
 
+    @classmethod
+    def for_activities(cls, activities):
+        """
+        Gather info for a whole class on each of these activities, with a constant number of queries.
+        """
+        infos = [cls(activity=a) for a in activities]
+        student_ids = [a.id for a in activities if not a.group]
+        group_ids = [a.id for a in activities if a.group]
+        submissions = dict((a.id, []) for a in activities)
+        if student_ids:
+            for s in StudentSubmission.objects.filter(activity_id__in=student_ids).select_related('member__person') \
+                    .order_by('-created_at'):
+                submissions[s.activity_id].append(s)
+        if group_ids:
+            for s in GroupSubmission.objects.filter(activity_id__in=group_ids).select_related('group') \
+                    .order_by('-created_at'):
+                submissions[s.activity_id].append(s)
+
+        for si in infos:
+            si.whole_activity = True
+            si.submissions = submissions[si.activity.id]
+        return infos
+
 
 
 
@@ -191,15 +225,62 @@ class SubmissionInfo(object):
 
     # State-updating methods
 
+    @staticmethod
+    def load_components(infos, most_recent=False, all_components=False):
+        """
+        Fill in .components for each of these SubmissionInfos and, if requested, their .submitted_components
+        (most_recent) and .all_submitted_components (all_components), with a constant number of queries.
+        """
+        need = [si for si in infos if not si.components]
+        if need:
+            activity_ids = list(set(si.activity.id for si in need))
+            include_deleted = any(si.include_deleted for si in need)
+            components = select_components(activity_ids, include_deleted=include_deleted)
+            for si in need:
+                si.components = [c for c in components[si.activity.id] if si.include_deleted or not c.deleted]
+
+        todo = [si for si in infos if (most_recent and si.submitted_components is None)
+                or (all_components and si.all_submitted_components is None)]
+        if not todo:
+            return
+
+        submissions = dict((s.id, s) for si in todo for s in si.submissions)
+        components = dict((c.id, c) for si in todo for c in si.components)
+        if all(si.whole_activity for si in todo):
+            filters = {'submission__activity_id__in': list(set(si.activity.id for si in todo))}
+        else:
+            filters = {'submission_id__in': list(submissions.keys())}
+
+        # submission_id -> component_id -> SubmittedComponent
+        by_submission = {}
+        for sc in load_polymorphic([Type.SubmittedComponent for Type in ALL_TYPE_CLASSES], **filters):
+            if sc.submission_id not in submissions or sc.component_id not in components:
+                continue
+            # use the objects we already have, so following these relations doesn't cost queries
+            sc.submission = submissions[sc.submission_id]
+            sc.component = components[sc.component_id]
+            subcomps = by_submission.setdefault(sc.submission_id, {})
+            if sc.component_id not in subcomps or subcomps[sc.component_id].submit_time < sc.submit_time:
+                subcomps[sc.component_id] = sc
+
+        for si in todo:
+            if all_components and si.all_submitted_components is None:
+                si.all_submitted_components = [[by_submission.get(s.id, {}).get(c.id, None) for c in si.components]
+                                               for s in si.submissions]
+            if most_recent and si.submitted_components is None:
+                submitted_components = []
+                for c in si.components:
+                    scs = [by_submission[s.id][c.id] for s in si.submissions if c.id in by_submission.get(s.id, {})]
+                    submitted_components.append(max(scs, key=lambda sc: sc.submit_time) if scs else None)
+                si.submitted_components = submitted_components
+
     def ensure_components(self):
         """
         Make sure self.component_list is populated.
 
         Fills self.components.
         """
-        if self.components:
-            return
-        self.components = select_all_components(self.activity, include_deleted=self.include_deleted)
+        self.load_components([self])
 
     def get_most_recent_components(self):
         """
@@ -207,24 +288,7 @@ class SubmissionInfo(object):
 
         Fills self.submitted_components.
         """
-        if self.submitted_components is not None:
-            return
-
-        self.ensure_components()
-
-        submitted_components = []
-        for component in self.components:
-            SubmittedComponent = component.Type.SubmittedComponent
-            submits = SubmittedComponent.objects.filter(component=component,
-                    submission__in=self.submissions).order_by('-submit_time')
-            if submits:
-                sub = submits[0]
-            else:
-                # this component has never been submitted
-                sub = None
-            submitted_components.append(sub)
-
-        self.submitted_components = submitted_components
+        self.load_components([self], most_recent=True)
 
     def get_all_components(self):
         """
@@ -235,29 +299,8 @@ class SubmissionInfo(object):
         self.all_submitted_components and self.submissions correspond, so can be zipped.
         self.all_submitted_components[i] and self.components correspond, so can be zipped.
         """
-        if self.all_submitted_components is not None:
-            return
-
-        self.ensure_components()
         assert self.submissions is not None
-
-        # build dict-of-dicts to map submission -> component -> submittedcomponent
-        subcomps = {s.id: {} for s in self.submissions}
-
-        for component in self.components:
-            SubmittedComponent = component.Type.SubmittedComponent
-            scs = SubmittedComponent.objects.filter(component=component,
-                    submission__in=self.submissions).order_by('-submission__created_at').select_related('submission')
-            for sc in scs:
-                sub = subcomps[sc.submission.id]
-                sub[sc.component.id] = sc
-
-        self.all_submitted_components = []
-        for s in self.submissions:
-            scs = []
-            for c in self.components:
-                scs.append(subcomps.get(s.id, {}).get(c.id, None))
-            self.all_submitted_components.append(scs)
+        self.load_components([self], all_components=True)
 
 
     # Status/read-state methods
@@ -330,51 +373,22 @@ class SubmissionInfo(object):
             self.get_most_recent_components()
             compsub = self.components_and_submitted()
 
-        handle, filename = tempfile.mkstemp('.zip')
-        os.close(handle)
-        z = zipfile.ZipFile(filename, 'w')
-
+        z = ZipStream()
         self._add_to_zip(z, self.activity, compsub, self.submissions[0].created_at,
                 slug=self.submissions[0].file_slug(), multi=multi)
-
-        z.close()
-
-        file = open(filename, 'rb')
-        response = StreamingHttpResponse(FileWrapper(file), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename="%s_%s.zip"' % (
-                self.submissions[0].file_slug(), self.activity.slug)
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-        return response
+        return z.response("%s_%s.zip" % (self.submissions[0].file_slug(), self.activity.slug))
 
     def generate_activity_zip(self):
         """
         Create ZIP file for this activity
         """
-        handle, filename = tempfile.mkstemp('.zip')
-        os.close(handle)
-
-        z = zipfile.ZipFile(filename, 'w')
-        self.generate_submission_contents(z, prefix='')
-        z.close()
-
-        file = open(filename, 'rb')
-        response = StreamingHttpResponse(FileWrapper(file), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % (self.activity.slug)
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-        return response
+        from submission.archive_cache import activity_archive_response
+        return activity_archive_response(self)
 
     @staticmethod
     def _add_to_zip(zipf, activity, components_and_submitted, created_at, prefix='', slug=None, multi=False):
         """
-        Add this list of (SubmissionComponent, SubmittedComponent) pairs to the zip file.
+        Add this list of (SubmissionComponent, SubmittedComponent) pairs to the zip file (a ZipFile or ZipStream).
         """
         for component, subcomp in components_and_submitted:
             if subcomp:
@@ -430,15 +444,6 @@ class SubmissionInfo(object):
 
         return found, individual_subcomps, last_submission
 
-    @staticmethod
-    def hash_all(subcomps: List[SubmittedComponent]):
-        """
-        Calculate the hash of all files, discarding the results. Calling this should pre-fetch files from disk, in an
-        effort to speed up building the .zip.
-        """
-        for sc in subcomps:
-            sc.file_hash()
-
     def generate_submission_contents(self, z, prefix='', always_summary=True):
         """
         Assemble submissions and put in ZIP file.
@@ -456,14 +461,8 @@ class SubmissionInfo(object):
         # get SubmittedComponents and metadata
         found, individual_subcomps, last_submission = self.most_recent_submissions()
 
-        # start a thread to pre-fetch the second half of the files
-        subcomps_items = list(individual_subcomps.items())
-        all_subcomps = [sc for _, subcomps in subcomps_items for _, sc in subcomps]
-        t = threading.Thread(target=self.hash_all, args=(all_subcomps[len(all_subcomps)//2:],))
-        t.start()
-
         # Now add them to the ZIP
-        for slug, subcomps in subcomps_items:
+        for slug, subcomps in individual_subcomps.items():
             lastsub = last_submission[slug]
             p = os.path.join(prefix, slug)
             self._add_to_zip(z, self.activity, subcomps, lastsub.created_at,
@@ -1,7 +1,11 @@
+import errno
 import hashlib
+import shutil
+import tempfile
 from typing import Optional
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.core.validators import MaxValueValidator
 from django.db.models.fields.files import FieldFile
 from django.dispatch import receiver
@@ -153,12 +157,151 @@ def submission_upload_path(instance, filename):
     return upload_path(instance.component.activity.offering.slug, filename)
 
 
+BLOB_CHUNK = 64*1024
+
+
+def blob_path(sha256):
+    return os.path.join('blobs', sha256[:2], sha256[2:4], sha256)
+
+
+class SubmittedFileBlob(models.Model):
+    """
+    The stored contents of submitted files, found by their sha256.
+
+    Each SubmittedComponent's file is a hard link to the blob with its contents (or a copy, if the filesystem can't
+    link), so identical files submitted repeatedly only use disk once. refcount is the number of SubmittedComponents
+    using the blob: it is removed when that reaches zero.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'submission'
+
+    def __str__(self):
+        return self.sha256
+
+    @staticmethod
+    def full_path(sha256):
+        return UploadedFileStorage.path(blob_path(sha256))
+
+    @classmethod
+    def _add_reference(cls, sha256, size):
+        with transaction.atomic():
+            cls.objects.get_or_create(sha256=sha256, defaults={'size': size})
+            cls.objects.filter(sha256=sha256).update(refcount=F('refcount') + 1)
+
+    @classmethod
+    def release(cls, sha256):
+        """
+        Drop one reference to this blob, deleting it if it's no longer used.
+        """
+        with transaction.atomic():
+            cls.objects.filter(sha256=sha256).update(refcount=F('refcount') - 1)
+            deleted, _ = cls.objects.filter(sha256=sha256, refcount__lte=0).delete()
+        if deleted:
+            try:
+                os.remove(cls.full_path(sha256))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _link(src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                # including FileExistsError: never overwrite another file
+                raise
+            # the filesystem can't link these: copy, exclusively and as private as the blob itself
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as out, open(src, 'rb') as fh:
+                shutil.copyfileobj(fh, out, BLOB_CHUNK)
+
+    @classmethod
+    def store(cls, content, name):
+        """
+        Save the content (a django File) as the storage filename name, hashing it as it's written, and sharing the
+        disk space with any identical file already stored. Returns (name actually used, sha256 hexdigest).
+        """
+        known = getattr(content, 'sha256', None)
+        if known:
+            # hashed by SubmissionUploadHandler as it arrived: if we already have it, there's nothing to write
+            cls._add_reference(known, content.size)
+            path = cls.full_path(known)
+            if os.path.exists(path):
+                name = UploadedFileStorage.get_available_name(name)
+                cls._link(path, UploadedFileStorage.path(name))
+                return name, known
+            cls.release(known)
+
+        tmpdir = UploadedFileStorage.path(os.path.join('blobs', 'tmp'))
+        os.makedirs(tmpdir, exist_ok=True)
+        handle, tmpname = tempfile.mkstemp(dir=tmpdir)
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(handle, 'wb') as fh:
+                for data in content.chunks(BLOB_CHUNK):
+                    h.update(data)
+                    size += len(data)
+                    fh.write(data)
+            sha256 = h.hexdigest()
+
+            # reference the blob before putting the file in place, so a concurrent release can't remove it under us
+            cls._add_reference(sha256, size)
+            path = cls.full_path(sha256)
+            if os.path.exists(path):
+                os.remove(tmpname)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmpname, path)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+        name = UploadedFileStorage.get_available_name(name)
+        cls._link(path, UploadedFileStorage.path(name))
+        return name, sha256
+
+    @classmethod
+    def adopt(cls, filename):
+        """
+        Put the existing file at this full path into the store, replacing it with a link to the stored blob if its
+        contents are already there. Returns its sha256 hexdigest.
+        """
+        h = hashlib.sha256()
+        size = 0
+        with open(filename, 'rb') as fh:
+            for data in iter(lambda: fh.read(BLOB_CHUNK), b''):
+                h.update(data)
+                size += len(data)
+        sha256 = h.hexdigest()
+
+        cls._add_reference(sha256, size)
+        path = cls.full_path(sha256)
+        if not os.path.exists(path):
+            cls._link(filename, path)
+        elif not os.path.samefile(path, filename):
+            # link under a temporary name and rename over the original, so the file never disappears
+            tmpname = filename + '.blob-tmp'
+            cls._link(path, tmpname)
+            os.replace(tmpname, filename)
+        return sha256
+
+
 class SubmittedComponent(models.Model):
     """
     Part of a student's/group's submission
     """
     submission = models.ForeignKey(Submission, on_delete=models.PROTECT)
     submit_time = models.DateTimeField(auto_now_add = True)
+    sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True,
+                              help_text='hash of the file contents, if this component has a file')
     def get_time(self):
         "return the submit time of the component"
         return self.submit_time.strftime("%Y-%m-%d %H:%M:%S")
@@ -171,6 +314,17 @@ class SubmittedComponent(models.Model):
             return time
     def delete(self, *args, **kwargs):
         raise NotImplementedError("This object cannot be deleted because it is used as a foreign key.")
+    def save(self, *args, **kwargs):
+        f = self.get_fieldfile()
+        if f and not f._committed:
+            # newly-uploaded file: write it through the blob store, instead of letting the FileField save it
+            name = f.field.generate_filename(self, f.name)
+            f.name, self.sha256 = SubmittedFileBlob.store(f.file, name)
+            f._committed = True
+        elif f and self.sha256 is None and self.id is None:
+            # file saved directly by FieldFile.save
+            self.sha256 = SubmittedFileBlob.adopt(f.path)
+        super(SubmittedComponent, self).save(*args, **kwargs)
     def __lt__(self, other):
         return other.submit_time < self.submit_time
     class Meta:
@@ -216,6 +370,26 @@ class SubmittedComponent(models.Model):
             filename = os.path.join(prefix, filename)
         return filename
 
+    def file_digest(self):
+        """
+        The sha256 hexdigest of the submitted file contents, or None if this subclass doesn't contain a file.
+
+        Uses the hash stored when the file was submitted, if we have it.
+        """
+        if self.sha256:
+            return self.sha256
+        h = self.file_hash()
+        return h.hexdigest() if h else None
+
+    def identical_submissions(self):
+        """
+        The other SubmittedComponents for this component whose file is identical to this one.
+        """
+        if not self.sha256:
+            return SubmittedComponent.objects.none()
+        return SubmittedComponent.objects.filter(sha256=self.sha256, submission__activity_id=self.submission.activity_id) \
+            .exclude(id=self.id)
+
     def file_hash(self):
         """
         Create sha256 Hash of the submitted file contents, or None if this subclass doesn't contain a file
@@ -235,6 +409,15 @@ class SubmittedComponent(models.Model):
         return h
 
 
+@receiver(models.signals.post_delete, sender=SubmittedComponent)
+def release_file_blob(sender, instance, **kwargs):
+    """
+    Drop the deleted component's reference to its file's blob.
+    """
+    if instance.sha256:
+        SubmittedFileBlob.release(instance.sha256)
+
+
 # adapted from http://stackoverflow.com/questions/849142/how-to-limit-the-maximum-value-of-a-numeric-field-in-a-django-model
 class FileSizeField(models.PositiveIntegerField):
     def __init__(self, verbose_name=None, name=None, **kwargs):
@@ -254,6 +437,7 @@ class FileSizeField(models.PositiveIntegerField):
 
 GENERATOR_CHOICES = [ # first elements must be URL-safe slug-like things
     ('MOSS', 'MOSS'),
+    ('WINN', 'Local winnowing'),
 ]
 
 
@@ -301,6 +485,20 @@ class SimilarityData(models.Model):
         unique_together = [('result', 'label')]
 
 
+class SimilarityFingerprint(models.Model):
+    """
+    Winnowed fingerprints of one file's contents (see submission.winnow), kept so files are only fingerprinted once
+    no matter how many times they are compared.
+    """
+    sha256 = models.CharField(max_length=64, null=False, blank=False, help_text='hex sha256 of the file contents')
+    language = models.CharField(max_length=10, null=False, blank=False)
+    version = models.PositiveSmallIntegerField(help_text='submission.winnow.WINNOW_VERSION that created this')
+    data = models.BinaryField(help_text='packed (hash, first line, last line) fingerprints')
+
+    class Meta:
+        unique_together = [('sha256', 'language', 'version')]
+
+
 # based on https://stackoverflow.com/a/16041527/6871666
 @receiver(models.signals.post_delete, sender=SimilarityData)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
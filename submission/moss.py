@@ -1,22 +1,23 @@
 import itertools
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from django import forms
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.db import transaction
-from django.core.files import File
+from django.core.files.base import ContentFile
 from django.http import QueryDict, HttpResponse, HttpRequest
 from django.shortcuts import get_object_or_404, render, get_list_or_404
 from django.urls import reverse
 
 from coredata.models import CourseOffering
+from courselib.parallel import process_map
 from grades.models import Activity
 from submission.models.codefile import SubmittedCodefile
-from submission.models.base import SimilarityResult, SimilarityData
+from submission.models.base import SimilarityResult, SimilarityData, GENERATOR_CHOICES
 from submission.models import SubmissionInfo
 import bs4
-import io, os.path, tempfile, subprocess, re
+import datetime, hashlib, json, os.path, tempfile, time, subprocess, re
 
 
 # MOSS language choices. Incomplete: included ones I imagine we might use.
@@ -84,10 +85,13 @@ def _canonical_filename(filename: str, code_dir: str):
 match_base_re = re.compile(r'^(match(\d+))\.html$')
 match_top_re = re.compile(r'^match(\d+)-top\.html$')
 match_file_re = re.compile(r'^match(\d+)-([01])\.html$')
+report_url_re = re.compile(r'https?://\S+/results/\S+')
+MOSS_INGEST_BATCH = 500 # SimilarityData rows per INSERT
 
 
 @transaction.atomic
-def run_moss(main_activity: Activity, activities: List[Activity], language: str, result: SimilarityResult) -> SimilarityResult:
+def run_moss(main_activity: Activity, activities: List[Activity], language: str, result: SimilarityResult,
+             processes: Optional[int] = None) -> SimilarityResult:
     """
     Run MOSS for the main_activity's submissions.
     ... comparing past submission from everything in the activities list.
@@ -96,8 +100,6 @@ def run_moss(main_activity: Activity, activities: List[Activity], language: str,
     """
     assert language in MOSS_LANGUAGES
     assert main_activity in activities
-    icon_url_path = reverse('dashboard:moss_icon', kwargs={'filename': ''})
-
     tmpdir = tempfile.TemporaryDirectory()
     tmp = tmpdir.name
     code_dir = os.path.join(tmp, 'code')
@@ -108,9 +110,9 @@ def run_moss(main_activity: Activity, activities: List[Activity], language: str,
     extension = '.' + MOSS_LANGUAGES[language]
     moss_files = [] # files that we will give to MOSS
     file_submissions = {} # MOSS input file to submission_id, so we can recover the source later
-    for a in activities:
-        si = SubmissionInfo.for_activity(a)
-        si.get_all_components()
+    submission_infos = SubmissionInfo.for_activities(activities)
+    SubmissionInfo.load_components(submission_infos, all_components=True)
+    for a, si in zip(activities, submission_infos):
         _, individual_subcomps, _ = si.most_recent_submissions()
         for userid, components in individual_subcomps.items():
             prefix = os.path.join(code_dir, a.offering.slug, userid)
@@ -139,90 +141,172 @@ def run_moss(main_activity: Activity, activities: List[Activity], language: str,
     moss_pl = os.path.join(settings.MOSS_DISTRIBUTION_PATH, 'moss.pl')
     cmd = [moss_pl, '-l', language, '-o', moss_out_dir] + moss_files
     try:
-        res = subprocess.run(cmd, cwd=settings.MOSS_DISTRIBUTION_PATH)
+        res = subprocess.run(cmd, cwd=settings.MOSS_DISTRIBUTION_PATH, stdout=subprocess.PIPE,
+                             universal_newlines=True)
     except FileNotFoundError:
         raise MOSSError('System not correctly configured with the MOSS executable.')
     if res.returncode != 0:
         raise MOSSError('MOSS command failed: ' + str(cmd))
 
-    # try to deal with MOSS' [profanity suppressed] HTML, and produce SimilarityData objects to represent everything
-    for f in os.listdir(moss_out_dir):
-        if f == 'index.html':
-            data = open(os.path.join(moss_out_dir, f), 'rt', encoding='utf8').read()
-            soup = bs4.BeautifulSoup(data, 'lxml')
-            index_data = []
-            for tr in soup.find_all('tr'):
-                if tr.find('th'):
-                    continue
-                m = []
-                for a in tr.find_all('a'):
-                    label = a.get('href')
-                    fn, perc = a.string.split(' ')
-                    fn = _canonical_filename(fn, code_dir)
-                    m.append((label, fn, perc))
-
-                # Only display if one side is from the main_activity: leave the past behind.
-                if any(fn.startswith(offering_slug+'/') for _,fn,_ in m):
-                    index_data.append(m)
-
-            data = SimilarityData(result=result, label='index.html', file=None, config={})
-            data.config['index_data'] = index_data
-            data.save()
-
-        elif match_base_re.match(f):
+    report_url = report_url_re.search(res.stdout or '')
+    file_submissions = dict((_canonical_filename(fn, code_dir), sub_id) for fn, sub_id in file_submissions.items())
+    ingest_moss_output(moss_out_dir, code_dir, offering_slug, file_submissions, result,
+                       report_url=report_url.group(0) if report_url else None, processes=processes)
+
+    result.config['complete'] = True
+    result.save()
+    return result
+
+
+def _parse_moss_page(job):
+    """
+    Parse one file of MOSS output into what we keep: (label, content, input filename). Content is the index_data
+    list for index.html, or the HTML fragment worth displaying for others.
+
+    Runs in worker processes for ingest_moss_output, so must not touch the database.
+    """
+    path, code_dir, icon_url_path = job
+    f = os.path.basename(path)
+    try:
+        data = open(path, 'rt', encoding='utf8').read()
+    except UnicodeDecodeError:
+        data = open(path, 'rt', encoding='windows-1252').read()
+    soup = bs4.BeautifulSoup(data, 'lxml')
+
+    if f == 'index.html':
+        index_data = []
+        for tr in soup.find_all('tr'):
+            if tr.find('th'):
+                continue
+            m = []
+            for a in tr.find_all('a'):
+                label = a.get('href')
+                fn, perc = a.string.split(' ')
+                fn = _canonical_filename(fn, code_dir)
+                m.append((label, fn, perc))
+            index_data.append(m)
+        return f, index_data, None
+
+    elif match_top_re.match(f):
+        table = soup.find('table')
+        del table['bgcolor']
+        del table['border']
+        del table['cellspacing']
+        for th in table.find_all('th'):
+            if th.string is not None:
+                th.string = _canonical_filename(th.string, code_dir)
+        for img in table.find_all('img'):
+            src = img.get('src')
+            img['src'] = src.replace('../bitmaps/', icon_url_path)
+        return f, str(table), None
+
+    elif match_file_re.match(f):
+        # find the input filename, which leads to the submission
+        filename = None
+        for c in soup.find('body').children:
+            if isinstance(c, bs4.element.NavigableString):
+                c = str(c).strip()
+                if c.startswith(code_dir):
+                    filename = _canonical_filename(c, code_dir)
+                    break
+
+        # the only <pre> is the real content we care about
+        pre = soup.find('pre')
+        for img in pre.find_all('img'):
+            src = img.get('src')
+            img['src'] = src.replace('../bitmaps/', icon_url_path)
+        return f, str(pre), filename
+
+    raise ValueError('unexpected file produced by MOSS')
+
+
+def moss_report_key(moss_out_dir: str, code_dir: str, report_url: Optional[str] = None) -> str:
+    """
+    Key for the parsed-report cache: the MOSS report URL if we know it, or else a hash of the output (which
+    mentions the temporary code_dir, so that's ignored).
+    """
+    if report_url:
+        return report_url
+    digest = hashlib.sha256()
+    for f in sorted(os.listdir(moss_out_dir)):
+        digest.update(f.encode('utf8') + b'\0')
+        with open(os.path.join(moss_out_dir, f), 'rb') as fh:
+            digest.update(fh.read().replace(code_dir.encode('utf8'), b''))
+    return 'sha256:' + digest.hexdigest()
+
+
+def _report_cache_path(key: str) -> str:
+    return os.path.join(settings.MOSS_REPORT_CACHE_PATH, hashlib.sha256(key.encode('utf8')).hexdigest() + '.json')
+
+
+def parse_moss_output(moss_out_dir: str, code_dir: str, report_url: Optional[str] = None,
+                      processes: Optional[int] = None) -> List[Tuple[str, Any, Optional[str]]]:
+    """
+    Parse all of the MOSS output pages (in parallel), or get the results of parsing the same report before from
+    the cache.
+    """
+    key = moss_report_key(moss_out_dir, code_dir, report_url)
+    cache_path = _report_cache_path(key)
+    try:
+        with open(cache_path, 'rt', encoding='utf8') as fh:
+            cached = json.load(fh)
+        if cached['key'] == key:
+            os.utime(cache_path) # mark as recently used
+            return [tuple(p) for p in cached['pages']]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    icon_url_path = reverse('dashboard:moss_icon', kwargs={'filename': ''})
+    # matchN.html is just the frameset: the view reconstructs it
+    jobs = [(os.path.join(moss_out_dir, f), code_dir, icon_url_path) for f in sorted(os.listdir(moss_out_dir))
+            if not match_base_re.match(f)]
+    pages = process_map(_parse_moss_page, jobs, processes=processes)
+
+    os.makedirs(settings.MOSS_REPORT_CACHE_PATH, exist_ok=True)
+    with open(cache_path + '.tmp', 'wt', encoding='utf8') as fh:
+        json.dump({'key': key, 'pages': pages}, fh)
+    os.replace(cache_path + '.tmp', cache_path)
+    return pages
+
+
+def prune_moss_report_cache(age: datetime.timedelta = datetime.timedelta(days=30)):
+    """
+    Remove parsed reports that haven't been used recently from the cache.
+    """
+    try:
+        names = os.listdir(settings.MOSS_REPORT_CACHE_PATH)
+    except FileNotFoundError:
+        return
+    cutoff = time.time() - age.total_seconds()
+    for n in names:
+        path = os.path.join(settings.MOSS_REPORT_CACHE_PATH, n)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
             pass
 
-        elif match_top_re.match(f):
-            data = open(os.path.join(moss_out_dir, f), 'rt', encoding='utf8').read()
-            soup = bs4.BeautifulSoup(data, 'lxml')
-            table = soup.find('table')
-
-            del table['bgcolor']
-            del table['border']
-            del table['cellspacing']
-            for th in table.find_all('th'):
-                if th.string is not None:
-                    th.string = _canonical_filename(th.string, code_dir)
-            for img in table.find_all('img'):
-                src = img.get('src')
-                img['src'] = src.replace('../bitmaps/', icon_url_path)
-
-            file = File(file=io.BytesIO(str(table).encode('utf8')), name=f)
-            data = SimilarityData(result=result, label=f, file=file, config={})
-            data.save()
-
-        elif match_file_re.match(f):
-            try:
-                data = open(os.path.join(moss_out_dir, f), 'rt', encoding='utf8').read()
-            except UnicodeDecodeError:
-                data = open(os.path.join(moss_out_dir, f), 'rt', encoding='windows-1252').read()
-            soup = bs4.BeautifulSoup(data, 'lxml')
-
-            # find the input filename, which leads to the submission
-            for c in soup.find('body').children:
-                if isinstance(c, bs4.element.NavigableString):
-                    c = str(c).strip()
-                    if c.startswith(code_dir):
-                        filename = c
-                        break
-            submission_id = file_submissions[filename]
-
-            # the only <pre> is the real content we care about
-            pre = soup.find('pre')
-            for img in pre.find_all('img'):
-                src = img.get('src')
-                img['src'] = src.replace('../bitmaps/', icon_url_path)
-
-            file = File(file=io.BytesIO(str(pre).encode('utf8')), name=f)
-            data = SimilarityData(result=result, label=f, file=file, submission_id=submission_id, config={})
-            data.save()
 
+def ingest_moss_output(moss_out_dir: str, code_dir: str, offering_slug: str, file_submissions: Dict[str, int],
+                       result: SimilarityResult, report_url: Optional[str] = None, processes: Optional[int] = None):
+    """
+    Produce SimilarityData objects to represent everything MOSS produced in moss_out_dir.
+
+    file_submissions maps input filenames (relative to code_dir) to their submission_id.
+    """
+    rows = []
+    for label, content, filename in parse_moss_output(moss_out_dir, code_dir, report_url, processes=processes):
+        if label == 'index.html':
+            # Only display if one side is from the main_activity: leave the past behind.
+            index_data = [m for m in content if any(fn.startswith(offering_slug+'/') for _,fn,_ in m)]
+            rows.append(SimilarityData(result=result, label=label, file=None, config={'index_data': index_data}))
         else:
-            raise ValueError('unexpected file produced by MOSS')
+            submission_id = file_submissions[filename] if filename else None
+            data = SimilarityData(result=result, label=label, submission_id=submission_id, config={})
+            data.file.save(label, ContentFile(content.encode('utf8')), save=False)
+            rows.append(data)
 
-    result.config['complete'] = True
-    result.save()
-    return result
+    SimilarityData.objects.bulk_create(rows, batch_size=MOSS_INGEST_BATCH)
 
 
 @transaction.atomic
@@ -250,7 +334,9 @@ class MOSS(object):
         self.result = result
 
     class CreationForm(forms.Form):
-        language = forms.ChoiceField(label='MOSS language', choices=MOSS_LANGUAGES_CHOICES)
+        generator = forms.ChoiceField(label='Checker', choices=GENERATOR_CHOICES, initial='MOSS',
+            help_text='MOSS sends the code to the MOSS server; local winnowing compares it on this server')
+        language = forms.ChoiceField(label='Language', choices=MOSS_LANGUAGES_CHOICES)
         other_offering_activities = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, required=False,
             help_text='Also compare against submissions for these activities from other sections')
 
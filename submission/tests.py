@@ -1,8 +1,10 @@
 #from django.test import TestCase
 from django.test import TestCase
 
-from submission.models import URL, Archive, Code, StudentSubmission, select_all_components, ALL_TYPE_CLASSES
+from submission.models import URL, Archive, Code, StudentSubmission, select_all_components, ALL_TYPE_CLASSES, \
+    SubmittedComponent, SubmittedFileBlob, SubmissionInfo, get_component
 from submission.models.code import SubmittedCode
+from submission.models.archive import SubmittedArchive
 from submission.forms import filetype
 from grades.models import NumericActivity, Activity
 from groups.models import Group, GroupMember
@@ -10,9 +12,16 @@ from coredata.tests import create_offering, validate_content
 from coredata.models import Member, Person, CourseOffering
 from django.urls import reverse
 from courselib.testing import Client, test_views, basic_page_tests, TEST_COURSE_SLUG
-import datetime, tempfile, os
-
-import base64, io
+from courselib.zipstream import ZipStream
+from submission.archive_cache import archive_cache_stats, cached_archives, evict, ARCHIVE_CACHE_STATS
+from coredata import panel
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+import datetime, tempfile, os, zipfile
+
+import base64, io, hashlib, errno
+from unittest import mock
 TGZ_FILE = base64.b64decode('H4sIAI7Wr0sAA+3OuxHCMBAE0CtFJUjoVw8BODfQP3bgGSKIcPResjO3G9w9/i9vRmt7ltnzZx6ilNrr7PVS9vscbUTKJ/wWr8fzuqYUy3pbvu1+9QAAAAAAAAAAAHCiNyHUDpAAKAAA')
 GZ_FILE = base64.b64decode('H4sICIjWr0sAA2YAAwAAAAAAAAAAAA==')
 ZIP_FILE = base64.b64decode('UEsDBAoAAAAAAMB6fDwAAAAAAAAAAAAAAAABABwAZlVUCQADiNavSzTYr0t1eAsAAQToAwAABOgDAABQSwECHgMKAAAAAADAenw8AAAAAAAAAAAAAAAAAQAYAAAAAAAAAAAApIEAAAAAZlVUBQADiNavS3V4CwABBOgDAAAE6AMAAFBLBQYAAAAAAQABAEcAAAA7AAAAAAA=')
@@ -91,11 +100,86 @@ class SubmissionTest(TestCase):
         c2.save()
         c3 = Code.Component(activity=a1, title="Code File", position=3, max_size=2000, allowed=".py")
         c3.save()
-        comps = select_all_components(a1)
+        with self.assertNumQueries(4): # one to find the types present, and one for each
+            comps = select_all_components(a1)
         self.assertEqual(len(comps), 3)
         self.assertEqual(comps[0].title, 'Archive File') # make sure position=1 is first
         self.assertEqual(str(comps[1].Type.name), "Code")
         self.assertEqual(str(comps[2].Type.name), "URL")
+        self.assertEqual(get_component(activity=a1, id=c3.id), c3)
+        self.assertIsInstance(get_component(activity=a1, id=c3.id), Code.Component)
+        self.assertIsNone(get_component(activity=a2, id=c3.id))
+
+    def test_load_components(self):
+        """
+        Check that SubmissionInfo.load_components finds the same components as one-at-a-time, in constant queries.
+        """
+        _, course = create_offering()
+        activities = []
+        for i in range(2):
+            a = NumericActivity(name="Assignment %i" % (i,), short_name="A%i" % (i,), status="RLS", offering=course,
+                                position=i, max_grade=15, due_date=datetime.datetime.now() + datetime.timedelta(days=1))
+            a.save()
+            activities.append(a)
+        a1, a2 = activities
+        c1 = URL.Component(activity=a1, title="URL Link", position=2)
+        c1.save()
+        c2 = Code.Component(activity=a1, title="Code File", position=1, max_size=2000, allowed=".py")
+        c2.save()
+        c3 = URL.Component(activity=a2, title="URL Link", position=1)
+        c3.save()
+        c4 = URL.Component(activity=a2, title="Old Link", position=2, deleted=True)
+        c4.save()
+
+        def submit(student_count):
+            for i in range(student_count):
+                m = Member.objects.get(person__userid="0aaa%i" % (i,), offering=course)
+                for a, comps in [(a1, [c1, c2]), (a2, [c3, c4])]:
+                    sub = StudentSubmission(member=m, activity=a)
+                    sub.save()
+                    for c in comps:
+                        if isinstance(c, URL.Component):
+                            URL.SubmittedComponent(submission=sub, component=c, url='http://example.com/%i' % (i,)).save()
+                        else:
+                            sc = Code.SubmittedComponent(submission=sub, component=c)
+                            sc.code.save('a%i.py' % (i,), ContentFile(b'pass\n'))
+
+        def load():
+            infos = SubmissionInfo.for_activities(activities)
+            SubmissionInfo.load_components(infos, most_recent=True, all_components=True)
+            # the objects needed to build the ZIP file are all there
+            for si in infos:
+                for sub, subcomps in si.submissions_and_components():
+                    sub.file_slug()
+                    for comp, sc in subcomps:
+                        if sc:
+                            sc.submission.created_at, sc.component.slug
+            return infos
+
+        for i in range(5):
+            Member(person=Person.objects.get(userid="0aaa%i" % (i,)), offering=course, role="STUD", credits=3,
+                   career="UGRD", added_reason="UNK").save()
+        submit(2)
+        # the submissions, then for both components and submitted components: one query to find the types present
+        # and one each for Code and URL
+        with self.assertNumQueries(7):
+            load()
+        submit(5)
+        with self.assertNumQueries(7):
+            infos = load()
+
+        for si, a in zip(infos, activities):
+            single = SubmissionInfo.for_activity(a)
+            single.get_all_components()
+            self.assertEqual(si.components, single.components)
+            self.assertEqual(si.all_submitted_components, single.all_submitted_components)
+        self.assertEqual(infos[1].components, [c3])
+        self.assertEqual(len(infos[0].submissions), 7)
+        self.assertEqual(infos[0].submitted_components[1].url, 'http://example.com/4')
+
+        student = SubmissionInfo(student=Person.objects.get(userid="0aaa1"), activity=a1)
+        student.get_most_recent_components()
+        self.assertEqual([sc.submission for sc in student.submitted_components], [student.submissions[0]] * 2)
 
     def test_component_view_page(self):
         _, course = create_offering()
@@ -291,6 +375,393 @@ class SubmissionTest(TestCase):
         self.assertEqual(code.code.read(), codecontents)
         code.code.close()
             
+    def test_upload_validation(self):
+        """
+        Check the checks done on uploads as they arrive.
+        """
+        from submission import upload
+        # a small zip bomb: highly compressible, with the limits lowered to match
+        bomb = io.BytesIO()
+        with zipfile.ZipFile(bomb, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            z.writestr('readme.txt', b'Hello\n')
+            z.writestr('zeros.txt', b'\0' * 1000000)
+        bomb = bomb.getvalue()
+
+        with mock.patch('submission.upload.ZIP_RATIO_MIN_SIZE', 100000):
+            scanner = upload.ZipHeaderScanner()
+            with self.assertRaises(upload.UploadRejected):
+                for i in range(0, len(bomb), 7):
+                    scanner.feed(bomb[i:i+7])
+            # the first entry was accepted before the bomb was found
+            self.assertEqual(scanner.entries, 2)
+            with self.assertRaises(upload.UploadRejected):
+                upload.check_zip_limits(io.BytesIO(bomb))
+        upload.check_zip_limits(io.BytesIO(bomb))
+
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2,
+                             max_grade=15, due_date=datetime.datetime.now() + datetime.timedelta(hours=1), group=False)
+        a1.save()
+        c = Archive.Component(activity=a1, title="Archive File", position=1, max_size=100)
+        c.save()
+        Member(person=Person.objects.get(userid="0aaa0"), offering=course, role="STUD", credits=3, career="UGRD",
+               added_reason="UNK").save()
+        client = Client()
+        client.login_user("0aaa0")
+        url = reverse('offering:submission:show_components',
+                      kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+
+        def submit(contents, name='stuff.zip'):
+            fh = io.BytesIO(contents)
+            fh.name = name
+            return client.post(url, {"%i-archive" % (c.id): fh})
+
+        with mock.patch('submission.upload.ZIP_RATIO_MIN_SIZE', 100000):
+            response = submit(bomb)
+        self.assertContains(response, 'suspiciously compressible')
+        response = submit(b'%PDF-1.4\n' + b'x' * 1000, name='stuff.pdf')
+        self.assertContains(response, 'Incorrect file type')
+        self.assertNotContains(response, 'File contents appear to be') # ... rejected by the handler, not the form
+        response = submit(b'PK\003\004' + b'x' * 200000)
+        self.assertContains(response, 'File size exceeded max size')
+        self.assertFalse(SubmittedArchive.objects.exists())
+
+        response = submit(bomb)
+        self.assertEqual(response.status_code, 302)
+        archive = SubmittedArchive.objects.get()
+        self.assertEqual(archive.sha256, hashlib.sha256(bomb).hexdigest())
+        self.assertEqual(archive.archive.read(), bomb)
+
+    def test_zip_stream(self):
+        """
+        Check the streamed ZIP archives of submissions.
+        """
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2,
+                             max_grade=15, due_date=datetime.datetime.now() - datetime.timedelta(hours=1), group=False)
+        a1.save()
+        Member(person=Person.objects.get(userid="ggbaker"), offering=course, role="INST", career="NONS",
+               added_reason="UNK").save()
+        c = Code.Component(activity=a1, title="Code File", position=1, max_size=20000, allowed=".py")
+        c.save()
+        ar = Archive.Component(activity=a1, title="Archive", position=2, max_size=20000)
+        ar.save()
+
+        codecontents = b'print("Hello World!")\n' * 1000
+        for u in ["0aaa0", "0aaa1"]:
+            m = Member(person=Person.objects.get(userid=u), offering=course, role="STUD", credits=3, career="UGRD",
+                       added_reason="UNK")
+            m.save()
+            sub = StudentSubmission(member=m, activity=a1)
+            sub.save()
+            code = SubmittedCode(submission=sub, component=c)
+            code.code.save('hello.py', ContentFile(codecontents))
+            arch = SubmittedArchive(submission=sub, component=ar)
+            arch.archive.save('stuff.zip', ContentFile(ZIP_FILE))
+
+        # ZipStream.stream is a generator: nothing is written before the response is consumed
+        z = ZipStream()
+        z.writestr('a.txt', 'a')
+        z.write_later(lambda z: z.writestr('b.txt', 'b'))
+        z.writestr('c.txt', 'c')
+        z.write_iter('d.csv', (s for s in ['x,y\n', 'z,w\n']))
+        data = b''.join(z.stream())
+        zf = zipfile.ZipFile(io.BytesIO(data))
+        self.assertEqual(zf.namelist(), ['a.txt', 'b.txt', 'c.txt', 'd.csv'])
+        self.assertEqual(zf.read('d.csv'), b'x,y\nz,w\n')
+        self.assertIsNone(zf.testzip())
+
+        client = Client()
+        client.login_user("ggbaker")
+        url = reverse('offering:submission:download_activity_files',
+                      kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+        with self.settings(ARCHIVE_CACHE_MAX_SIZE=0):
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        zf = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(zf.testzip())
+        names = zf.namelist()
+        self.assertEqual(set(names), {'0aaa0/hello.py', '0aaa0/stuff.zip', '0aaa0/LATE.txt',
+                                      '0aaa1/hello.py', '0aaa1/stuff.zip', '0aaa1/LATE.txt', 'summary.csv'})
+        self.assertEqual(zf.read('0aaa1/hello.py'), codecontents)
+        self.assertEqual(zf.getinfo('0aaa1/hello.py').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(zf.read('0aaa1/stuff.zip'), ZIP_FILE)
+        self.assertEqual(zf.getinfo('0aaa1/stuff.zip').compress_type, zipfile.ZIP_STORED)
+
+        url = reverse('offering:submission:download_file',
+                      kwargs={'course_slug': course.slug, 'activity_slug': a1.slug, 'userid': '0aaa0'})
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        zf = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(set(zf.namelist()), {'hello.py', 'stuff.zip', 'LATE.txt'})
+        self.assertEqual(zf.read('hello.py'), codecontents)
+
+    def test_archive_cache(self):
+        """
+        Check that activity ZIP files are reused and extended from the cache.
+        """
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2,
+                             max_grade=15, due_date=datetime.datetime.now() + datetime.timedelta(hours=1), group=False)
+        a1.save()
+        Member(person=Person.objects.get(userid="ggbaker"), offering=course, role="INST", career="NONS",
+               added_reason="UNK").save()
+        c = Code.Component(activity=a1, title="Code File", position=1, max_size=2000, allowed=".py")
+        c.save()
+        members = {}
+        for u in ["0aaa0", "0aaa1", "0aaa2"]:
+            members[u] = Member(person=Person.objects.get(userid=u), offering=course, role="STUD", credits=3,
+                                career="UGRD", added_reason="UNK")
+            members[u].save()
+
+        def submit(userid, contents):
+            sub = StudentSubmission(member=members[userid], activity=a1)
+            sub.save()
+            code = SubmittedCode(submission=sub, component=c)
+            code.code.save('hello.py', ContentFile(contents))
+
+        client = Client()
+        client.login_user("ggbaker")
+        url = reverse('offering:submission:download_activity_files',
+                      kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+
+        def download():
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return b''.join(response.streaming_content)
+
+        with tempfile.TemporaryDirectory() as cachedir, self.settings(ARCHIVE_CACHE_PATH=cachedir):
+            cache.delete_many(['archive-cache-' + s for s in ARCHIVE_CACHE_STATS])
+            submit("0aaa0", b'print("zero")\n')
+            submit("0aaa1", b'print("one")\n')
+            first = download()
+            self.assertEqual(archive_cache_stats(), {'hit': 0, 'append': 0, 'rebuild': 1})
+            self.assertEqual(download(), first)
+            self.assertEqual(archive_cache_stats(), {'hit': 1, 'append': 0, 'rebuild': 1})
+
+            # a new student's submission is appended without touching the files already there
+            submit("0aaa2", b'print("two")\n')
+            second = download()
+            self.assertEqual(archive_cache_stats(), {'hit': 1, 'append': 1, 'rebuild': 1})
+            zf = zipfile.ZipFile(io.BytesIO(second))
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()),
+                             ['0aaa0/hello.py', '0aaa1/hello.py', '0aaa2/hello.py', 'summary.csv'])
+            self.assertEqual(zf.read('0aaa2/hello.py'), b'print("two")\n')
+            self.assertEqual(len(zf.read('summary.csv').splitlines()), 4)
+            offset = min(zi.header_offset for zi in zf.infolist() if zi.filename == '0aaa2/hello.py')
+            self.assertEqual(second[:offset], first[:offset])
+
+            # a resubmission supersedes a file that's in the archive
+            submit("0aaa0", b'print("zero again")\n')
+            zf = zipfile.ZipFile(io.BytesIO(download()))
+            self.assertEqual(archive_cache_stats(), {'hit': 1, 'append': 1, 'rebuild': 2})
+            self.assertEqual(len(zf.namelist()), 4)
+            self.assertEqual(zf.read('0aaa0/hello.py'), b'print("zero again")\n')
+
+            info = dict(panel.archive_cache_info())
+            self.assertEqual(info['Cached archives'], 1)
+            self.assertEqual(info['Hit rate'], '25.0%')
+
+            evict(max_size=0)
+            self.assertEqual(cached_archives(), [])
+            download()
+            self.assertEqual(archive_cache_stats(), {'hit': 1, 'append': 1, 'rebuild': 3})
+
+            # changes to the components are noticed too, even with no new submissions
+            c.deleted = True
+            c.save()
+            zf = zipfile.ZipFile(io.BytesIO(download()))
+            self.assertEqual(archive_cache_stats(), {'hit': 1, 'append': 1, 'rebuild': 4})
+            self.assertEqual(zf.namelist(), ['summary.csv'])
+
+    def test_file_blobs(self):
+        """
+        Check that identical submitted files share their storage.
+        """
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2,
+                             max_grade=15, due_date=datetime.datetime.now() + datetime.timedelta(hours=1), group=False)
+        a1.save()
+        c = Code.Component(activity=a1, title="Code File", position=1, max_size=2000, allowed=".py")
+        c.save()
+        for u in ["0aaa0", "0aaa1", "0aaa2"]:
+            Member(person=Person.objects.get(userid=u), offering=course, role="STUD", credits=3, career="UGRD",
+                   added_reason="UNK").save()
+
+        # submit the same file twice, and something else once
+        client = Client()
+        url = reverse('offering:submission:show_components',
+                      kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+        codecontents = b'print("Hello World!")\n'
+        for u, contents in [("0aaa0", codecontents), ("0aaa1", codecontents), ("0aaa2", b'print("Bye")\n')]:
+            client.login_user(u)
+            fh = io.BytesIO(contents)
+            fh.name = 'hello.py'
+            response = client.post(url, {"%i-code" % (c.id): fh})
+            self.assertEqual(response.status_code, 302)
+
+        codes = list(SubmittedCode.objects.order_by('id'))
+        digest = hashlib.sha256(codecontents).hexdigest()
+        self.assertEqual([code.sha256 for code in codes[:2]], [digest, digest])
+        self.assertEqual([os.path.basename(code.code.name) for code in codes], ['hello.py'] * 3)
+        self.assertTrue(os.path.samefile(codes[0].code.path, codes[1].code.path))
+        self.assertFalse(os.path.samefile(codes[0].code.path, codes[2].code.path))
+        self.assertEqual(codes[1].code.read(), codecontents)
+        self.assertEqual(SubmittedFileBlob.objects.get(sha256=digest).refcount, 2)
+        self.assertEqual(codes[1].file_digest(), digest)
+        self.assertEqual(list(codes[0].identical_submissions()), [codes[1].submittedcomponent_ptr])
+
+        # deleting components drops the references, and the blob when it's unused
+        SubmittedCode.objects.filter(id=codes[0].id).delete()
+        self.assertEqual(SubmittedFileBlob.objects.get(sha256=digest).refcount, 1)
+        SubmittedCode.objects.filter(id=codes[1].id).delete()
+        self.assertFalse(SubmittedFileBlob.objects.filter(sha256=digest).exists())
+        self.assertFalse(os.path.exists(SubmittedFileBlob.full_path(digest)))
+
+        # a file from before the blob store
+        SubmittedComponent.objects.filter(id=codes[2].id).update(sha256=None)
+        SubmittedFileBlob.objects.all().delete()
+        out = io.StringIO()
+        call_command('backfill_file_blobs', '--recount', stdout=out)
+        self.assertIn('1 files added', out.getvalue())
+        self.assertIn('0 blob reference counts corrected', out.getvalue())
+        codes[2].refresh_from_db()
+        self.assertEqual(codes[2].sha256, hashlib.sha256(b'print("Bye")\n').hexdigest())
+        self.assertEqual(SubmittedFileBlob.objects.get(sha256=codes[2].sha256).refcount, 1)
+        self.assertTrue(os.path.samefile(codes[2].code.path, SubmittedFileBlob.full_path(codes[2].sha256)))
+
+        # where the filesystem can't link, a private copy; an existing file is never overwritten
+        src = SubmittedFileBlob.full_path(codes[2].sha256)
+        dst = os.path.join(os.path.dirname(codes[2].code.path), 'copied.py')
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            SubmittedFileBlob._link(src, dst)
+        self.assertFalse(os.path.samefile(src, dst))
+        self.assertEqual(open(dst, 'rb').read(), b'print("Bye")\n')
+        self.assertEqual(os.stat(dst).st_mode & 0o777, 0o600)
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            self.assertRaises(FileExistsError, SubmittedFileBlob._link, src, dst)
+        self.assertRaises(FileExistsError, SubmittedFileBlob._link, src, dst)
+        self.assertEqual(open(dst, 'rb').read(), b'print("Bye")\n')
+        os.remove(dst)
+
+    def test_winnow(self):
+        """
+        Check the local similarity checker.
+        """
+        from submission.models.base import SimilarityResult, SimilarityData, SimilarityFingerprint
+        from submission.models import Codefile
+        from submission import winnow
+        program = 'def total(values):\n    result = 0\n    for v in values:\n        if v > 0:\n' \
+                  '            result = result + v * 2\n    return result\n\nprint(total([1, 2, 3]))\n'
+        renamed = program.replace('values', 'xs').replace('result', 'acc')
+        self.assertEqual(winnow.fingerprint_text('python', program), winnow.fingerprint_text('python', renamed))
+        self.assertNotEqual(winnow.fingerprint_text('python', program),
+                            winnow.fingerprint_text('python', 'import sys\nwhile True:\n    sys.exit(1)\n' * 3))
+
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2,
+                             max_grade=15, due_date=datetime.datetime.now() + datetime.timedelta(hours=1), group=False)
+        a1.save()
+        c = Codefile.Component(activity=a1, title="Code File", position=1, max_size=2000, filename=".py",
+                               filename_type='EXT')
+        c.save()
+        client = Client()
+        url = reverse('offering:submission:show_components',
+                      kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+        other = 'import sys\n\nclass Thing(object):\n    def __init__(self):\n        self.x = {}\n' \
+                '    def get(self, k):\n        return self.x.get(k, None)\n'
+        for u, contents in [("0aaa0", program), ("0aaa1", renamed), ("0aaa2", other)]:
+            Member(person=Person.objects.get(userid=u), offering=course, role="STUD", credits=3, career="UGRD",
+                   added_reason="UNK").save()
+            client.login_user(u)
+            fh = io.BytesIO(contents.encode('utf8'))
+            fh.name = 'prog.py'
+            response = client.post(url, {"%i-code" % (c.id): fh})
+            self.assertEqual(response.status_code, 302)
+
+        result = SimilarityResult(activity=a1, generator='WINN', config={'language': 'python'})
+        result.save()
+        winnow.run_winnow(a1, [a1], 'python', result, processes=1)
+        self.assertTrue(result.config['complete'])
+        self.assertEqual(SimilarityFingerprint.objects.count(), 3)
+        index = SimilarityData.objects.get(result=result, label='index.html').config['index_data']
+        self.assertEqual(len(index), 1)
+        self.assertEqual(sorted(fn for _, fn, _ in index[0]),
+                         [course.slug + '/0aaa0/prog.py', course.slug + '/0aaa1/prog.py'])
+        self.assertEqual([perc for _, _, perc in index[0]], ['(100%)', '(100%)'])
+        left = SimilarityData.objects.get(result=result, label='match0-0.html')
+        self.assertIn('<a name="0"></a>', left.file.read().decode('utf8'))
+        self.assertIsNotNone(left.submission_id)
+
+        # the result pages display like MOSS'
+        Member(person=Person.objects.get(userid="ggbaker"), offering=course, role="INST", career="NONS",
+               added_reason="UNK").save()
+        client.login_user("ggbaker")
+        for path in ['', 'match0.html', 'match0-top.html', 'match0-1.html']:
+            response = client.get(reverse('grades:similarity:similarity_result',
+                kwargs={'course_slug': course.slug, 'activity_slug': a1.slug, 'result_slug': 'WINN', 'path': path}))
+            self.assertEqual(response.status_code, 200)
+
+        # second time: fingerprints come from the index, not the files
+        SimilarityData.objects.filter(result=result).delete()
+        with mock.patch('submission.winnow._fingerprint_file', side_effect=AssertionError('refingerprinted')):
+            winnow.run_winnow(a1, [a1], 'python', result, processes=1)
+        self.assertEqual(len(SimilarityData.objects.get(result=result, label='index.html').config['index_data']), 1)
+
+    def test_moss_ingest(self):
+        """
+        Check parsing and caching of (recorded) MOSS output.
+        """
+        from submission.models.base import SimilarityResult, SimilarityData
+        from submission import moss
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2,
+                             max_grade=15, due_date=datetime.datetime.now(), group=False)
+        a1.save()
+        outdir = os.path.join(os.path.dirname(__file__), 'testfiles', 'moss-output')
+        code_dir = '/tmp/tmpk2x9moss/code'
+        file_submissions = dict(('%s/%s/prog.py' % (slug, u), None) for slug, u in
+                                [('2020sp-cmpt-120-d1', '0aaa0'), ('2020sp-cmpt-120-d1', '0aaa1'),
+                                 ('2019fa-cmpt-120-d1', '0aaa2'), ('2019fa-cmpt-120-d1', '0aaa3')])
+
+        with tempfile.TemporaryDirectory() as cachedir, self.settings(MOSS_REPORT_CACHE_PATH=cachedir):
+            result = SimilarityResult(activity=a1, generator='MOSS', config={})
+            result.save()
+            with self.assertNumQueries(1):
+                moss.ingest_moss_output(outdir, code_dir, '2020sp-cmpt-120-d1', file_submissions, result, processes=1)
+            self.assertEqual(SimilarityData.objects.filter(result=result).count(), 10)
+            index = SimilarityData.objects.get(result=result, label='index.html').config['index_data']
+            # the match only between past offerings is dropped
+            self.assertEqual([[fn for _, fn, _ in m] for m in index],
+                             [['2020sp-cmpt-120-d1/0aaa0/prog.py', '2020sp-cmpt-120-d1/0aaa1/prog.py'],
+                              ['2020sp-cmpt-120-d1/0aaa0/prog.py', '2019fa-cmpt-120-d1/0aaa2/prog.py']])
+            top = SimilarityData.objects.get(result=result, label='match1-top.html').file.read().decode('utf8')
+            self.assertIn('<th>2019fa-cmpt-120-d1/0aaa2/prog.py (91%)</th>', top)
+            self.assertNotIn('../bitmaps/', top)
+            left = SimilarityData.objects.get(result=result, label='match0-0.html').file.read().decode('utf8')
+            self.assertTrue(left.startswith('<pre>'))
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+
+            # the same report again comes from the cache
+            SimilarityData.objects.filter(result=result).delete()
+            with mock.patch('submission.moss._parse_moss_page', side_effect=AssertionError('reparsed')):
+                moss.ingest_moss_output(outdir, code_dir, '2020sp-cmpt-120-d1', file_submissions, result)
+            self.assertEqual(SimilarityData.objects.filter(result=result).count(), 10)
+
+            # ... even if MOSS was run in a different temporary directory
+            with tempfile.TemporaryDirectory() as otherdir:
+                for f in os.listdir(outdir):
+                    with open(os.path.join(outdir, f)) as src, open(os.path.join(otherdir, f), 'w') as dst:
+                        dst.write(src.read().replace(code_dir, '/tmp/other/code'))
+                self.assertEqual(moss.moss_report_key(outdir, code_dir),
+                                 moss.moss_report_key(otherdir, '/tmp/other/code'))
+                self.assertNotEqual(moss.moss_report_key(outdir, code_dir),
+                                    moss.moss_report_key(outdir, code_dir, report_url='http://moss.example/results/1'))
+            SimilarityData.objects.filter(result=result).delete()
+
     def test_pages(self):
         "Test a bunch of page views"
         offering = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
@@ -0,0 +1,200 @@
+"""
+Validate submission uploads as they arrive, instead of after the whole file has been received.
+
+SubmissionUploadHandler replaces Django's upload handlers for the submission form. As each chunk arrives, it counts
+the size against the component's limit, checks the first bytes against the signatures of the component's allowed
+file types, walks the local headers of ZIP files to enforce the zip-bomb limits, and hashes the content (so the blob
+store doesn't have to read it again). Once an upload is rejected, the rest of it is discarded rather than written
+to disk. The reason is left on the uploaded file as upload_error, to be reported by SubmissionForm.
+
+When the upload is complete, the ZIP central directory (which is at the end of the file) is checked against the
+same limits. check_zip_limits also does that for files that didn't come through the handler.
+"""
+
+import hashlib
+import struct
+import zipfile
+
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+ZIP_MAX_ENTRIES = 10000
+ZIP_MAX_UNCOMPRESSED = 2*1024*1024*1024 # bytes, total of all entries
+ZIP_MAX_RATIO = 200 # uncompressed/compressed size of an entry...
+ZIP_RATIO_MIN_SIZE = 10*1024*1024 # ... that's at least this big: small files of repeated text can legitimately exceed it
+
+# file types from submission.forms.filetype that can be recognized from their first bytes
+SIGNATURES = {
+    'ZIP': [b'PK\003\004', b'PK00'],
+    'OD-TEXT': [b'PK\003\004'],
+    'OD-PRES': [b'PK\003\004'],
+    'OD-SS': [b'PK\003\004'],
+    'OD-GRA': [b'PK\003\004'],
+    'RAR': [b'Rar!'],
+    'TGZ': [b'\037\213'],
+    'GZIP': [b'\037\213'],
+    'PDF': [b'%PDF'],
+    'JPEG': [b'\377\330'],
+    'PNG': [b'\211PNG'],
+    'GIF': [b'GIF8'],
+}
+SIGNATURE_LENGTH = 4
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_HEADER_SIG = b'PK\003\004'
+
+
+class UploadRejected(ValueError):
+    pass
+
+
+def check_entry_limits(entries, uncompressed, compressed_size, uncompressed_size):
+    """
+    Check the zip-bomb limits for an archive with this many entries and this much uncompressed content so far, and
+    an entry with these sizes.
+    """
+    if entries > ZIP_MAX_ENTRIES:
+        raise UploadRejected('Archive contains too many files (more than %i).' % (ZIP_MAX_ENTRIES,))
+    if uncompressed > ZIP_MAX_UNCOMPRESSED:
+        raise UploadRejected('Archive contents are too large (more than %i MB uncompressed).'
+                             % (ZIP_MAX_UNCOMPRESSED // 1024 // 1024,))
+    if uncompressed_size >= ZIP_RATIO_MIN_SIZE and uncompressed_size > ZIP_MAX_RATIO * max(compressed_size, 1):
+        raise UploadRejected('Archive contains a file that is suspiciously compressible.')
+
+
+def check_zip_limits(fh):
+    """
+    Check the zip-bomb limits against the ZIP file's central directory. Only the directory is read, not the
+    compressed data. Files that aren't ZIP are ignored: the file type checks will deal with them.
+    """
+    fh.seek(0)
+    if fh.read(SIGNATURE_LENGTH) not in SIGNATURES['ZIP']:
+        return
+    fh.seek(0)
+    try:
+        infos = zipfile.ZipFile(fh, 'r').infolist()
+    except (zipfile.BadZipfile, ValueError):
+        return
+    finally:
+        fh.seek(0)
+
+    uncompressed = 0
+    for i, info in enumerate(infos, start=1):
+        uncompressed += info.file_size
+        check_entry_limits(i, uncompressed, info.compress_size, info.file_size)
+
+
+class ZipHeaderScanner(object):
+    """
+    Walk the local file headers of a ZIP file as its bytes arrive, checking the entry sizes they declare. Stops
+    quietly at anything it doesn't follow (sizes in a data descriptor or zip64 record, the central directory): the
+    central directory check after the upload catches anything missed here.
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.skip = 0 # bytes of compressed data still to pass over
+        self.entries = 0
+        self.uncompressed = 0
+        self.done = False
+
+    def feed(self, data):
+        while data and not self.done:
+            if self.skip:
+                n = min(self.skip, len(data))
+                self.skip -= n
+                data = data[n:]
+                continue
+
+            self.buffer += data
+            data = b''
+            if len(self.buffer) < _LOCAL_HEADER.size:
+                return
+            sig, _, flags, _, _, _, _, csize, usize, fnlen, extralen = \
+                _LOCAL_HEADER.unpack_from(self.buffer)
+            if sig != _LOCAL_HEADER_SIG or flags & 0x08 or 0xFFFFFFFF in (csize, usize):
+                self.done = True
+                self.buffer = b''
+                return
+
+            self.entries += 1
+            self.uncompressed += usize
+            check_entry_limits(self.entries, self.uncompressed, csize, usize)
+
+            # continue with whatever follows the header
+            self.skip = fnlen + extralen + csize
+            data = self.buffer[_LOCAL_HEADER.size:]
+            self.buffer = b''
+
+
+class SubmissionUploadHandler(TemporaryFileUploadHandler):
+    """
+    Upload handler for the submission form, validating each file as it's received.
+
+    limits_for_field(field_name) should return (maximum size in bytes, allowed file types) for that form field, or
+    None if it's not a submission component upload. Allowed types may be None if they can't be checked by signature.
+    """
+    def __init__(self, request, limits_for_field):
+        super().__init__(request)
+        self.limits_for_field = limits_for_field
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.limits = self.limits_for_field(field_name)
+        self.error = None
+        self.received = 0
+        self.head = b''
+        self.sha256 = hashlib.sha256()
+        self.zip_scanner = None
+
+    def _check_chunk(self, raw_data):
+        max_size, allowed_types = self.limits
+        if self.received > max_size:
+            raise UploadRejected('File size exceeded max size, component can not be uploaded.')
+
+        if len(self.head) < SIGNATURE_LENGTH:
+            self.head += raw_data[:SIGNATURE_LENGTH - len(self.head)]
+            if len(self.head) == SIGNATURE_LENGTH:
+                self._check_signature(allowed_types)
+
+        if self.zip_scanner:
+            self.zip_scanner.feed(raw_data)
+
+    def _check_signature(self, allowed_types):
+        if self.head in SIGNATURES['ZIP']:
+            self.zip_scanner = ZipHeaderScanner()
+        if not allowed_types or any(t not in SIGNATURES for t in allowed_types):
+            # can't rule anything out by signature
+            return
+        if not any(self.head.startswith(sig) for t in allowed_types for sig in SIGNATURES[t]):
+            raise UploadRejected('Incorrect file type. Allowed file types are: %s.' % (", ".join(allowed_types),))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.error:
+            # already rejected: don't bother keeping the rest
+            return None
+        if self.limits:
+            try:
+                self._check_chunk(raw_data)
+            except UploadRejected as e:
+                self.error = str(e)
+                return None
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        if self.limits and not self.error:
+            try:
+                if len(self.head) < SIGNATURE_LENGTH:
+                    # short file: check what we have
+                    self._check_signature(self.limits[1])
+                check_zip_limits(self.file)
+            except UploadRejected as e:
+                self.error = str(e)
+
+        self.file.size = self.received
+        self.file.upload_error = self.error
+        if not self.error:
+            self.file.sha256 = self.sha256.hexdigest()
+            self.file.zip_checked = bool(self.limits)
+        return self.file
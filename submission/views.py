@@ -2,6 +2,7 @@ import os
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.db.models import Q
 
 from coredata.models import Member, CourseOffering, Person
@@ -10,11 +11,13 @@ from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpRequest
 from courselib.auth import requires_course_by_slug,requires_course_staff_by_slug, ForbiddenResponse, NotFoundResponse
 from courselib.search import find_member, find_userid_or_emplid
 from grades.models import Activity
-from submission.forms import make_form_from_list
+from submission.forms import make_form_from_list, upload_limits
+from submission.upload import SubmissionUploadHandler
 from courselib.auth import is_course_staff_by_slug, is_course_member_by_slug
 from submission.models import StudentSubmission, GroupSubmission, SubmissionComponent
 from submission.models import select_all_components, SubmissionInfo, get_component, find_type_by_label, ALL_TYPE_CLASSES
 from submission.moss import MOSS, MOSSError, run_moss_as_task
+from submission.winnow import run_winnow_as_task
 from django.urls import reverse
 from django.contrib import messages
 from groups.models import Group, GroupMember
@@ -27,8 +30,18 @@ from courselib.search import find_userid_or_emplid
 from submission.models.base import SimilarityResult
 
 
+@csrf_exempt
 @login_required
 def show_components(request, course_slug, activity_slug):
+    if request.method == 'POST' and not is_course_staff_by_slug(request, course_slug):
+        # validate uploads as they arrive: has to happen before anything (like the CSRF check) looks at request.POST
+        activity = get_object_or_404(Activity, offering__slug=course_slug, slug=activity_slug, deleted=False)
+        request.upload_handlers = [SubmissionUploadHandler(request, upload_limits(select_all_components(activity)))]
+    return _show_components(request, course_slug, activity_slug)
+
+
+@csrf_protect
+def _show_components(request, course_slug, activity_slug):
     #if course staff
     if is_course_staff_by_slug(request, course_slug):
         return _show_components_staff(request, course_slug, activity_slug)
@@ -365,7 +378,6 @@ def download_activity_files(request, course_slug, activity_slug):
     offering = get_object_or_404(CourseOffering, slug=course_slug)
     activity = get_object_or_404(offering.activity_set, slug=activity_slug, deleted=False)
     submission_info = SubmissionInfo.for_activity(activity)
-    submission_info.get_all_components()
     return submission_info.generate_activity_zip()
 
 @requires_course_staff_by_slug
@@ -487,10 +499,14 @@ def similarity(request, course_slug, activity_slug):
                 other_ids = moss_form.cleaned_data['other_offering_activities']
                 other_activities = Activity.objects.filter(id__in=other_ids)
                 activities = [activity] + list(other_activities)
-                result = run_moss_as_task(activities=activities, language=moss_form.cleaned_data['language'])
-                messages.add_message(request, messages.SUCCESS, 'MOSS report started.')
+                generator = moss_form.cleaned_data['generator']
+                if generator == 'WINN':
+                    result = run_winnow_as_task(activities=activities, language=moss_form.cleaned_data['language'])
+                else:
+                    result = run_moss_as_task(activities=activities, language=moss_form.cleaned_data['language'])
+                messages.add_message(request, messages.SUCCESS, '%s report started.' % (result.get_generator_display(),))
                 l = LogEntry(userid=request.user.username,
-                             description=("ran MOSS for %s in %s") % (activity, offering),
+                             description=("ran %s for %s in %s") % (result.get_generator_display(), activity, offering),
                              related_object=activity)
                 l.save()
                 return HttpResponseRedirect(
@@ -521,7 +537,8 @@ def similarity_result(request: HttpRequest, course_slug, activity_slug, result_s
     activity = get_object_or_404(offering.activity_set, slug=activity_slug, deleted=False)
     result = get_object_or_404(SimilarityResult, activity=activity, generator=result_slug)
 
-    if result.generator == 'MOSS':
+    if result.generator in ['MOSS', 'WINN']:
+        # local winnowing results are stored in the same format as MOSS'
         helper = MOSS(offering, activity, result)
     else:
         raise NotImplementedError()
@@ -0,0 +1,365 @@
+"""
+A local code-similarity checker: an in-process replacement for sending files to MOSS.
+
+Each file is reduced to a token stream (identifiers, literals and comments normalized away, so renaming variables
+doesn't hide anything), hashed as overlapping k-grams, and winnowed to a set of fingerprints as described in
+Schleimer, Wilkerson and Aiken, "Winnowing: Local Algorithms for Document Fingerprinting" (the algorithm behind
+MOSS). Files that share many fingerprints are reported.
+
+Fingerprints depend only on the file contents and language, so they are stored in SimilarityFingerprint under the
+file's sha256: files from past offerings are only ever tokenized once. The results are stored as SimilarityData in
+the same shape as MOSS' (index.html, matchN-top.html, matchN-0.html, matchN-1.html) so the MOSS views display them.
+"""
+
+import hashlib
+import itertools
+import os
+import re
+import struct
+from collections import defaultdict
+from typing import List
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils.html import escape
+
+from courselib.parallel import process_map
+
+from grades.models import Activity
+from submission.models import SubmissionInfo
+from submission.models.base import SimilarityResult, SimilarityData, SimilarityFingerprint
+from submission.models.codefile import SubmittedCodefile
+from submission.moss import MOSS_LANGUAGES, MOSSError
+
+WINNOW_VERSION = 1 # increment if tokenizing/fingerprinting changes, so stored fingerprints aren't reused
+KGRAM = 12 # tokens in each hashed k-gram: shorter matches are ignored
+WINDOW = 8 # winnowing window: any match of at least KGRAM+WINDOW-1 tokens is guaranteed to be found
+MAX_MATCHES = 250 # matches reported, like moss -n
+MAX_FILES_PER_FINGERPRINT = 10 # fingerprints in more files than this are probably starter code, like moss -m
+MATCH_COLOURS = ['#FF0000', '#00FF00', '#0000FF', '#00FFFF', '#FF00FF', '#FF8000', '#8000FF', '#808000']
+
+C_KEYWORDS = {'auto', 'break', 'case', 'char', 'const', 'continue', 'default', 'do', 'double', 'else', 'enum',
+              'extern', 'float', 'for', 'goto', 'if', 'int', 'long', 'register', 'return', 'short', 'signed', 'sizeof',
+              'static', 'struct', 'switch', 'typedef', 'union', 'unsigned', 'void', 'volatile', 'while'}
+CPP_KEYWORDS = C_KEYWORDS | {'bool', 'catch', 'class', 'delete', 'false', 'friend', 'inline', 'namespace', 'new',
+                             'operator', 'private', 'protected', 'public', 'template', 'this', 'throw', 'true', 'try',
+                             'typename', 'using', 'virtual'}
+JAVA_KEYWORDS = {'abstract', 'boolean', 'break', 'byte', 'case', 'catch', 'char', 'class', 'continue', 'default',
+                 'do', 'double', 'else', 'enum', 'extends', 'final', 'finally', 'float', 'for', 'if', 'implements',
+                 'import', 'instanceof', 'int', 'interface', 'long', 'new', 'null', 'package', 'private', 'protected',
+                 'public', 'return', 'short', 'static', 'super', 'switch', 'this', 'throw', 'throws', 'try', 'void',
+                 'while', 'true', 'false'}
+CSHARP_KEYWORDS = JAVA_KEYWORDS | {'as', 'base', 'bool', 'foreach', 'in', 'is', 'namespace', 'out', 'override',
+                                   'readonly', 'ref', 'string', 'using', 'var', 'virtual'}
+JS_KEYWORDS = {'break', 'case', 'catch', 'class', 'const', 'continue', 'default', 'delete', 'do', 'else', 'export',
+               'extends', 'false', 'finally', 'for', 'function', 'if', 'import', 'in', 'instanceof', 'let', 'new',
+               'null', 'return', 'super', 'switch', 'this', 'throw', 'true', 'try', 'typeof', 'undefined', 'var',
+               'void', 'while', 'yield', 'async', 'await', 'of'}
+PYTHON_KEYWORDS = {'and', 'as', 'assert', 'async', 'await', 'break', 'class', 'continue', 'def', 'del', 'elif',
+                   'else', 'except', 'False', 'finally', 'for', 'from', 'global', 'if', 'import', 'in', 'is', 'lambda',
+                   'None', 'nonlocal', 'not', 'or', 'pass', 'raise', 'return', 'True', 'try', 'while', 'with', 'yield'}
+RUBY_KEYWORDS = {'and', 'begin', 'break', 'case', 'class', 'def', 'do', 'else', 'elsif', 'end', 'ensure', 'false',
+                 'for', 'if', 'in', 'module', 'next', 'nil', 'not', 'or', 'redo', 'rescue', 'retry', 'return', 'self',
+                 'super', 'then', 'true', 'unless', 'until', 'when', 'while', 'yield'}
+HASKELL_KEYWORDS = {'case', 'class', 'data', 'deriving', 'do', 'else', 'if', 'import', 'in', 'infix', 'instance',
+                    'let', 'module', 'newtype', 'of', 'then', 'type', 'where'}
+OCAML_KEYWORDS = {'and', 'as', 'begin', 'do', 'done', 'else', 'end', 'exception', 'for', 'fun', 'function', 'if',
+                  'in', 'let', 'match', 'module', 'mutable', 'of', 'open', 'rec', 'then', 'to', 'try', 'type', 'val',
+                  'when', 'while', 'with'}
+
+_C_COMMENTS = [r'//[^\n]*', r'/\*.*?\*/']
+_HASH_COMMENTS = [r'#[^\n]*']
+_C_STRINGS = [r'"(?:\\.|[^"\\\n])*"', r"'(?:\\.|[^'\\\n])*'"]
+_PY_STRINGS = [r'"""(?:\\.|.)*?"""', r"'''(?:\\.|.)*?'''"] + _C_STRINGS
+_JS_STRINGS = _C_STRINGS + [r'`(?:\\.|[^`\\])*`']
+
+# language: (comment patterns, string literal patterns, keywords)
+LANGUAGE_SYNTAX = {
+    'c': (_C_COMMENTS, _C_STRINGS, C_KEYWORDS),
+    'cc': (_C_COMMENTS, _C_STRINGS, CPP_KEYWORDS),
+    'java': (_C_COMMENTS, _C_STRINGS, JAVA_KEYWORDS),
+    'csharp': (_C_COMMENTS, _C_STRINGS, CSHARP_KEYWORDS),
+    'javascript': (_C_COMMENTS, _JS_STRINGS, JS_KEYWORDS),
+    'python': (_HASH_COMMENTS, _PY_STRINGS, PYTHON_KEYWORDS),
+    'ruby': (_HASH_COMMENTS, _C_STRINGS, RUBY_KEYWORDS),
+    'haskell': ([r'--[^\n]*', r'\{-.*?-\}'], [r'"(?:\\.|[^"\\\n])*"'], HASKELL_KEYWORDS),
+    'ocaml': ([r'\(\*.*?\*\)'], [r'"(?:\\.|[^"\\\n])*"'], OCAML_KEYWORDS),
+}
+assert set(LANGUAGE_SYNTAX) == set(MOSS_LANGUAGES)
+
+_token_res = {}
+
+
+def _token_re(language):
+    if language not in _token_res:
+        comments, strings, _ = LANGUAGE_SYNTAX[language]
+        _token_res[language] = re.compile(
+            r'(?P<comment>%s)|(?P<string>%s)|(?P<number>\d[\w.]*)|(?P<ident>[A-Za-z_]\w*)|(?P<op>[^\s\w])'
+            % ('|'.join(comments), '|'.join(strings)), re.DOTALL)
+    return _token_res[language]
+
+
+def tokenize(language, text):
+    """
+    Normalized tokens of this source code, as a list of (token, line number).
+    """
+    keywords = LANGUAGE_SYNTAX[language][2]
+    tokens = []
+    line = 1
+    pos = 0
+    for m in _token_re(language).finditer(text):
+        line += text.count('\n', pos, m.start())
+        pos = m.start()
+        kind = m.lastgroup
+        if kind == 'ident':
+            tok = m.group() if m.group() in keywords else 'V'
+        elif kind == 'number':
+            tok = 'N'
+        elif kind == 'string':
+            tok = 'S'
+        elif kind == 'op':
+            tok = m.group()
+        else:
+            continue
+        tokens.append((tok, line))
+    return tokens
+
+
+def _hash(gram):
+    return struct.unpack('<q', hashlib.blake2b('\x00'.join(gram).encode('utf8'), digest_size=8).digest())[0]
+
+
+def fingerprint_text(language, text):
+    """
+    Winnowed fingerprints of this source code, as a list of (hash, first line, last line).
+    """
+    tokens = tokenize(language, text)
+    if len(tokens) < KGRAM:
+        return []
+    words = [t for t, _ in tokens]
+    lines = [l for _, l in tokens]
+    hashes = [_hash(words[i:i+KGRAM]) for i in range(len(tokens) - KGRAM + 1)]
+
+    fingerprints = []
+    last = None
+    for start in range(max(1, len(hashes) - WINDOW + 1)):
+        window = hashes[start:start+WINDOW]
+        # rightmost minimal hash in the window
+        m = min(window)
+        i = start + len(window) - 1 - window[::-1].index(m)
+        if i != last:
+            fingerprints.append((m, lines[i], lines[i+KGRAM-1]))
+            last = i
+    return fingerprints
+
+
+_FINGERPRINT = struct.Struct('<qii')
+
+
+def pack_fingerprints(fingerprints):
+    return b''.join(_FINGERPRINT.pack(*f) for f in fingerprints)
+
+
+def unpack_fingerprints(data):
+    return list(_FINGERPRINT.iter_unpack(bytes(data)))
+
+
+def _fingerprint_file(job):
+    language, path = job
+    with open(path, 'rb') as fh:
+        text = fh.read().decode('utf8', errors='replace')
+    return pack_fingerprints(fingerprint_text(language, text))
+
+
+def file_fingerprints(language, subcomps, processes=None):
+    """
+    Fingerprints for these SubmittedCodefiles, as a dict of sha256 -> fingerprint list.
+
+    Stored fingerprints are used where we have them; others are calculated and stored.
+    """
+    digests = {}
+    for sc in subcomps:
+        digests.setdefault(sc.file_digest(), sc.code.path)
+
+    stored = SimilarityFingerprint.objects.filter(sha256__in=list(digests.keys()), language=language,
+                                                  version=WINNOW_VERSION)
+    fingerprints = dict((f.sha256, unpack_fingerprints(f.data)) for f in stored)
+
+    missing = [d for d in digests if d not in fingerprints]
+    packed = process_map(_fingerprint_file, [(language, digests[d]) for d in missing], processes=processes)
+    new = [SimilarityFingerprint(sha256=d, language=language, version=WINNOW_VERSION, data=p)
+           for d, p in zip(missing, packed)]
+    SimilarityFingerprint.objects.bulk_create(new, ignore_conflicts=True)
+    for d, p in zip(missing, packed):
+        fingerprints[d] = unpack_fingerprints(p)
+    return fingerprints
+
+
+class _Document(object):
+    def __init__(self, filename, subcomp, fingerprints, main):
+        self.filename = filename
+        self.subcomp = subcomp
+        self.fingerprints = fingerprints
+        self.main = main
+        self.hashes = set(h for h, _, _ in fingerprints)
+
+
+def _regions(doc, shared):
+    """
+    Merged line ranges of the document's fingerprints with hashes in shared, as a list of (first, last, hashes).
+    """
+    spans = sorted((s, e, h) for h, s, e in doc.fingerprints if h in shared)
+    regions = []
+    for s, e, h in spans:
+        if regions and s <= regions[-1][1] + 1:
+            regions[-1][1] = max(regions[-1][1], e)
+            regions[-1][2].add(h)
+        else:
+            regions.append([s, e, {h}])
+    return regions
+
+
+def _percent(doc, shared):
+    if not doc.fingerprints:
+        return 0
+    return int(round(100.0 * sum(1 for h, _, _ in doc.fingerprints if h in shared) / len(doc.fingerprints)))
+
+
+def find_matches(documents):
+    """
+    Pairs of documents with fingerprints in common (and at least one from the main activity), most similar first, as
+    a list of (doc0, doc1, shared hashes).
+    """
+    index = defaultdict(list)
+    for i, doc in enumerate(documents):
+        for h in doc.hashes:
+            index[h].append(i)
+
+    shared = defaultdict(set)
+    for h, docs in index.items():
+        if len(docs) < 2 or len(docs) > MAX_FILES_PER_FINGERPRINT:
+            continue
+        for i, j in itertools.combinations(docs, 2):
+            if documents[i].main or documents[j].main:
+                shared[(i, j)].add(h)
+
+    matches = [(documents[i], documents[j], hs) for (i, j), hs in shared.items()]
+    matches.sort(key=lambda m: (-max(_percent(m[0], m[2]), _percent(m[1], m[2])), m[0].filename, m[1].filename))
+    return matches[:MAX_MATCHES]
+
+
+def _source_html(text, regions):
+    """
+    MOSS-style matchN-[01].html content: the source in a <pre>, with matched regions anchored and coloured.
+    """
+    lines = text.splitlines()
+    starts = dict((s, (r, e)) for r, (s, e, _) in enumerate(regions))
+    out = ['<pre>']
+    end = None
+    for i, line in enumerate(lines, start=1):
+        if i in starts:
+            r, end = starts[i]
+            out.append('<a name="%i"></a><font color="%s">' % (r, MATCH_COLOURS[r % len(MATCH_COLOURS)]))
+        out.append(escape(line) + '\n')
+        if end is not None and i >= end:
+            out.append('</font>')
+            end = None
+    if end is not None:
+        out.append('</font>')
+    out.append('</pre>')
+    return ''.join(out)
+
+
+def _top_html(n, doc0, doc1, regions0, regions1, perc0, perc1):
+    """
+    MOSS-style matchN-top.html content: a table linking the corresponding regions of the two files.
+    """
+    rows = ['<table><tr><th>%s (%i%%)</th><th>%s (%i%%)</th><th>Fingerprints</th></tr>'
+            % (escape(doc0.filename), perc0, escape(doc1.filename), perc1)]
+    for r0, (s0, e0, hs0) in enumerate(regions0):
+        # the region of the other file sharing the most with this one
+        best = max(range(len(regions1)), key=lambda r1: len(hs0 & regions1[r1][2]), default=None)
+        if best is None:
+            continue
+        s1, e1, _ = regions1[best]
+        colour = MATCH_COLOURS[r0 % len(MATCH_COLOURS)]
+        rows.append('<tr><td><a href="match%i-0.html#%i" target="0"><font color="%s">%i-%i</font></a></td>'
+                    '<td><a href="match%i-1.html#%i" target="1"><font color="%s">%i-%i</font></a></td><td>%i</td></tr>'
+                    % (n, r0, colour, s0, e0, n, best, colour, s1, e1, len(hs0 & regions1[best][2])))
+    rows.append('</table>')
+    return ''.join(rows)
+
+
+def _read(subcomp):
+    with open(subcomp.code.path, 'rb') as fh:
+        return fh.read().decode('utf8', errors='replace')
+
+
+@transaction.atomic
+def run_winnow(main_activity: Activity, activities: List[Activity], language: str, result: SimilarityResult,
+               processes=None) -> SimilarityResult:
+    """
+    Compare the main_activity's Codefile submissions with each other, and with everything in the activities list,
+    looking only at files in the given language. Results are stored in result, like run_moss.
+    """
+    assert language in MOSS_LANGUAGES
+    assert main_activity in activities
+    extension = '.' + MOSS_LANGUAGES[language]
+
+    submission_infos = SubmissionInfo.for_activities(activities)
+    SubmissionInfo.load_components(submission_infos, all_components=True)
+    files = [] # (filename, SubmittedCodefile, is main activity)
+    for a, si in zip(activities, submission_infos):
+        _, individual_subcomps, _ = si.most_recent_submissions()
+        for userid, components in individual_subcomps.items():
+            for comp, sub in components:
+                if isinstance(sub, SubmittedCodefile) and sub.code.name.endswith(extension):
+                    filename = sub.file_filename(sub.code, os.path.join(a.offering.slug, userid))
+                    files.append((filename, sub, a.id == main_activity.id))
+
+    if not files:
+        raise MOSSError('No files found for that language to analyze.')
+
+    fingerprints = file_fingerprints(language, [sub for _, sub, _ in files], processes=processes)
+    documents = [_Document(filename, sub, fingerprints[sub.file_digest()], main) for filename, sub, main in files]
+
+    data = []
+    index_data = []
+    for n, (doc0, doc1, shared) in enumerate(find_matches(documents)):
+        regions0, regions1 = _regions(doc0, shared), _regions(doc1, shared)
+        perc0, perc1 = _percent(doc0, shared), _percent(doc1, shared)
+        label = 'match%i.html' % (n,)
+        index_data.append([(label, doc0.filename, '(%i%%)' % (perc0,)), (label, doc1.filename, '(%i%%)' % (perc1,))])
+
+        top = SimilarityData(result=result, label='match%i-top.html' % (n,), config={})
+        top.file.save(top.label, ContentFile(_top_html(n, doc0, doc1, regions0, regions1, perc0, perc1).encode('utf8')),
+                      save=False)
+        data.append(top)
+        for side, doc, regions in [(0, doc0, regions0), (1, doc1, regions1)]:
+            d = SimilarityData(result=result, label='match%i-%i.html' % (n, side),
+                               submission_id=doc.subcomp.submission_id, config={})
+            d.file.save(d.label, ContentFile(_source_html(_read(doc.subcomp), regions).encode('utf8')),
+                        save=False)
+            data.append(d)
+
+    data.append(SimilarityData(result=result, label='index.html', file=None, config={'index_data': index_data}))
+    SimilarityData.objects.bulk_create(data)
+
+    result.config['complete'] = True
+    result.save()
+    return result
+
+
+@transaction.atomic
+def run_winnow_as_task(activities: List[Activity], language: str) -> SimilarityResult:
+    """
+    Start run_winnow() in a Celery task, like run_moss_as_task.
+    """
+    activity = activities[0]
+    SimilarityResult.objects.filter(activity=activity, generator='WINN').delete()
+    result = SimilarityResult(activity=activity, generator='WINN', config={'language': language, 'complete': False})
+    result.save()
+
+    from submission.tasks import run_winnow_task
+    run_winnow_task.delay(activity.id, [a.id for a in activities], language, result.id)
+    return result